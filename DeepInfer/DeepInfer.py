@@ -1,23 +1,27 @@
 import queue
 import json
+import logging
 import platform
 import os
 import re
 import subprocess
 import shutil
 import threading
-from collections import OrderedDict
+import unittest
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from glob import glob
-from time import sleep
+from time import sleep, time
 
-from __main__ import qt, ctk, slicer
+try:
+    from __main__ import qt, ctk, slicer
+    from slicer.util import getNode, saveNode
+except ImportError:
+    # outside of Slicer only the headless file based pipeline is available, see runHeadless
+    qt = ctk = slicer = None
 
 # To avoid the overhead of importing SimpleITK during application
-# startup, the import of SimpleITK is delayed until it is needed.
-import SimpleITK as sitk
-import sitkUtils
-
-from slicer.util import getNode, saveNode
+# startup, SimpleITK and sitkUtils are imported where they are used.
 
 
 ICON_DIR = os.path.dirname(os.path.realpath(__file__)) + '/Resources/Icons/'
@@ -29,19 +33,28 @@ DEEPINFER_DIR = os.path.join(home, '.deepinfer')
 if not os.path.isdir(DEEPINFER_DIR):
     os.mkdir(DEEPINFER_DIR)
 
+# the cloud model descriptions are kept between sessions as a local mirror of the registry
 JSON_CLOUD_DIR = os.path.join(DEEPINFER_DIR, 'json', 'cloud')
-if os.path.isdir(JSON_CLOUD_DIR):
-    shutil.rmtree(JSON_CLOUD_DIR)
-os.makedirs(JSON_CLOUD_DIR)
+if not os.path.isdir(JSON_CLOUD_DIR):
+    os.makedirs(JSON_CLOUD_DIR)
 
 JSON_LOCAL_DIR = os.path.join(DEEPINFER_DIR, 'json', 'local')
 if not os.path.isdir(JSON_LOCAL_DIR):
     os.makedirs(JSON_LOCAL_DIR)
 
+# every job works in its own sub directory, stale ones are removed in the background
+# by DeepInferLogic.removeStaleJobDirs instead of wiping the directory at import time
 TMP_PATH = os.path.join(DEEPINFER_DIR, '.tmp')
-if os.path.isdir(TMP_PATH):
-    shutil.rmtree(TMP_PATH)
-os.mkdir(TMP_PATH)
+if not os.path.isdir(TMP_PATH):
+    os.mkdir(TMP_PATH)
+
+CACHE_DIR = os.path.join(DEEPINFER_DIR, 'cache')
+
+# the fastest thread count of each model on each host, see ThreadTuner
+TUNING_PATH = os.path.join(DEEPINFER_DIR, 'tuning.json')
+
+# containers prefix their machine readable progress records with this tag, see DeepInferJob.updateProgress
+PROGRESS_TAG = 'DEEPINFER_PROGRESS'
 
 #
 # DeepInfer
@@ -137,6 +150,69 @@ class DeepInferWidget:
         dockerForm.addRow("Docker Executable Path:", self.dockerPath)
         self.testDockerButton = qt.QPushButton('Test!')
         dockerForm.addRow("Test Docker Configuration:", self.testDockerButton)
+        self.warmSessionCheckBox = qt.QCheckBox()
+        self.warmSessionCheckBox.toolTip = "Keep the model container running between runs. " \
+                                           "Only used for models that support warm sessions."
+        dockerForm.addRow("Keep Model Container Running:", self.warmSessionCheckBox)
+        self.idleTimeoutSpinBox = qt.QSpinBox()
+        self.idleTimeoutSpinBox.setRange(1, 24 * 60)
+        self.idleTimeoutSpinBox.setValue(WarmSessionManager.idleTimeout // 60)
+        self.idleTimeoutSpinBox.suffix = ' min'
+        self.idleTimeoutSpinBox.toolTip = "Stop a warm model container after it has been idle this long."
+        dockerForm.addRow("Idle Timeout:", self.idleTimeoutSpinBox)
+        self.compressExchangeCheckBox = qt.QCheckBox()
+        self.compressExchangeCheckBox.toolTip = "Compress the volumes passed to and from the model containers. " \
+                                                "Faster if the home directory is on a network disk. " \
+                                                "Only used for models that support compressed formats."
+        dockerForm.addRow("Compress Exchange Files:", self.compressExchangeCheckBox)
+        self.scratchPath = ctk.ctkPathLineEdit()
+        self.scratchPath.filters = ctk.ctkPathLineEdit.Dirs
+        self.scratchPath.toolTip = "Directory for the files passed to and from the model containers, " \
+                                   "e.g. a local disk if the home directory is on a network disk. " \
+                                   "Empty to use {}.".format(TMP_PATH)
+        dockerForm.addRow("Scratch Directory:", self.scratchPath)
+        self.sharedMemoryCheckBox = qt.QCheckBox()
+        self.sharedMemoryCheckBox.toolTip = "Pass the files of jobs that fit into memory through {}.".format(
+            ScratchSpace.SHARED_MEMORY)
+        self.sharedMemoryCheckBox.enabled = os.path.isdir(ScratchSpace.SHARED_MEMORY)
+        dockerForm.addRow("Use Shared Memory:", self.sharedMemoryCheckBox)
+        self.cpusSpinBox = qt.QDoubleSpinBox()
+        self.cpusSpinBox.setRange(0, 256)
+        self.cpusSpinBox.setSingleStep(0.5)
+        self.cpusSpinBox.specialValueText = "Model default"
+        self.cpusSpinBox.toolTip = "CPU cores each model container may use, and the number of threads " \
+                                   "of the numeric libraries in it."
+        dockerForm.addRow("CPUs Per Job:", self.cpusSpinBox)
+        self.memorySpinBox = qt.QDoubleSpinBox()
+        self.memorySpinBox.setRange(0, 1024)
+        self.memorySpinBox.suffix = ' GB'
+        self.memorySpinBox.specialValueText = "Model default"
+        self.memorySpinBox.toolTip = "Memory limit of each model container."
+        dockerForm.addRow("Memory Per Job:", self.memorySpinBox)
+        self.tuneThreadsCheckBox = qt.QCheckBox()
+        self.tuneThreadsCheckBox.toolTip = "Run each model once at several thread counts the first time it is " \
+                                           "used on this computer and use the fastest count from then on."
+        dockerForm.addRow("Tune Thread Count:", self.tuneThreadsCheckBox)
+        self.cacheCheckBox = qt.QCheckBox()
+        self.cacheCheckBox.checked = True
+        self.cacheCheckBox.toolTip = "Reuse the stored outputs when a model is run again on the same inputs " \
+                                     "with the same parameters."
+        dockerForm.addRow("Cache Results:", self.cacheCheckBox)
+        cacheLayout = qt.QHBoxLayout()
+        self.cacheSizeSpinBox = qt.QDoubleSpinBox()
+        self.cacheSizeSpinBox.setRange(0.1, 1024)
+        self.cacheSizeSpinBox.setValue(10)
+        self.cacheSizeSpinBox.suffix = ' GB'
+        self.cacheSizeSpinBox.toolTip = "Least recently used results are removed beyond this size."
+        cacheLayout.addWidget(self.cacheSizeSpinBox)
+        self.cacheStatusLabel = qt.QLabel("")
+        cacheLayout.addWidget(self.cacheStatusLabel)
+        cacheLayout.addStretch(1)
+        self.clearCacheButton = qt.QPushButton('Clear')
+        cacheLayout.addWidget(self.clearCacheButton)
+        dockerForm.addRow("Cache Size:", cacheLayout)
+        self.resultCache = None
+        self.threadTuner = None
         if platform.system() == 'Darwin':
             self.dockerPath.setCurrentPath('/usr/local/bin/docker')
         if platform.system() == 'Linux':
@@ -197,9 +273,41 @@ class DeepInferWidget:
         self.downloadButton = qt.QPushButton('Download')
         self.downloadButton.enabled = False
         self.downloadButton.visible = False
+        self.downloadButton.toolTip = "Pull the docker image of the selected model in the background. The model " \
+                                      "is added to the local models when the pull has finished."
         hBoXLayout.addStretch(1)
         hBoXLayout.addWidget(self.connectButton)
         hBoXLayout.addWidget(self.downloadButton)
+        pullSettingsWidget = qt.QWidget()
+        modelRepoVBLayout2.addWidget(pullSettingsWidget)
+        pullForm = qt.QFormLayout(pullSettingsWidget)
+        self.concurrentPullsSpinBox = qt.QSpinBox()
+        self.concurrentPullsSpinBox.setRange(1, 8)
+        self.concurrentPullsSpinBox.setValue(2)
+        self.concurrentPullsSpinBox.toolTip = "Number of docker images pulled at once."
+        pullForm.addRow("Concurrent Pulls:", self.concurrentPullsSpinBox)
+        self.pullBandwidthSpinBox = qt.QDoubleSpinBox()
+        self.pullBandwidthSpinBox.setRange(0, 10000)
+        self.pullBandwidthSpinBox.suffix = ' MB/s'
+        self.pullBandwidthSpinBox.specialValueText = "Unlimited"
+        self.pullBandwidthSpinBox.toolTip = "Further pulls are only started while the running ones download " \
+                                            "slower than this."
+        pullForm.addRow("Pull Bandwidth Limit:", self.pullBandwidthSpinBox)
+        self.siteListPath = ctk.ctkPathLineEdit()
+        self.siteListPath.nameFilters = ["Site lists (*.json)"]
+        self.siteListPath.toolTip = "Json file listing the models every workstation of the site should have, " \
+                                    "see SitePrePull."
+        pullForm.addRow("Site Model List:", self.siteListPath)
+        self.prePullCheckBox = qt.QCheckBox()
+        self.prePullCheckBox.toolTip = "Pull the missing models of the site list during the off-hours it gives."
+        pullForm.addRow("Pre-pull Off-hours:", self.prePullCheckBox)
+        self.pullManager = None
+        self.pullPolling = False
+        self.reportedPulls = set()
+        self.modelStatusItems = dict()
+        self.prePullInterval = 10 * 60
+        self.prePullTimerActive = False
+        self.cloudCatalog = ModelCatalog(JSON_CLOUD_DIR)
         self.populateModelRegistryTable()
 
 
@@ -238,7 +346,9 @@ class DeepInferWidget:
         # model selector
         self.modelSelector = qt.QComboBox()
         modelsFormLayout.addRow("Model:", self.modelSelector)
-        self.populateLocalModels()
+        self.localCatalog = ModelCatalog(JSON_LOCAL_DIR)
+        # the model list is filled once the panel is shown
+        qt.QTimer.singleShot(0, self.populateLocalModels)
 
         # connections
         self.modelSelector.connect('currentIndexChanged(int)', self.onModelSelect)
@@ -254,6 +364,86 @@ class DeepInferWidget:
         parametersFormLayout = qt.QFormLayout(parametersCollapsibleButton)
         self.modelParameters = ModelParameters(parametersCollapsibleButton)
 
+        #
+        # Batch Area
+        #
+        batchCollapsibleButton = ctk.ctkCollapsibleGroupBox()
+        batchCollapsibleButton.setTitle("Batch")
+        batchCollapsibleButton.collapsed = True
+        self.layout.addWidget(batchCollapsibleButton)
+        batchFormLayout = qt.QFormLayout(batchCollapsibleButton)
+        self.batchInputSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.batchInputSelector.nodeTypes = ["vtkMRMLScalarVolumeNode", ]
+        self.batchInputSelector.addEnabled = False
+        self.batchInputSelector.removeEnabled = False
+        self.batchInputSelector.showHidden = False
+        self.batchInputSelector.setMRMLScene(slicer.mrmlScene)
+        self.batchInputSelector.setToolTip("Pick the volumes to run the model on. Each checked volume replaces "
+                                           "the first input volume of the model, the other parameters are "
+                                           "taken from the Model Parameters section.")
+        batchFormLayout.addRow("Input Volumes:", self.batchInputSelector)
+        self.batchTable = qt.QTableWidget()
+        self.batchTable.setColumnCount(3)
+        self.batchTable.setHorizontalHeaderLabels(['Input', 'Status', 'Time (s)'])
+        self.batchTable.horizontalHeader().setStretchLastSection(True)
+        self.batchTable.verticalHeader().setDefaultSectionSize(20)
+        self.batchTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.batchTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+        batchFormLayout.addRow(self.batchTable)
+        self.throughputLabel = qt.QLabel("")
+        batchFormLayout.addRow("Throughput:", self.throughputLabel)
+        self.concurrencySpinBox = qt.QSpinBox()
+        self.concurrencySpinBox.setRange(1, 64)
+        self.concurrencySpinBox.setValue(1)
+        self.concurrencySpinBox.toolTip = "Maximum number of model containers running at once. The number " \
+                                          "is further limited by the CPU cores and the memory of this machine."
+        batchFormLayout.addRow("Concurrent Jobs:", self.concurrencySpinBox)
+        self.batchViewsCheckBox = qt.QCheckBox()
+        self.batchViewsCheckBox.toolTip = "Show the outputs of each batch job in the slice views when it " \
+                                          "finishes. Faster unchecked, the outputs are still added to the scene."
+        batchFormLayout.addRow("Update Views:", self.batchViewsCheckBox)
+        batchButtonsLayout = qt.QHBoxLayout()
+        self.cancelJobsButton = qt.QPushButton("Cancel Selected")
+        self.cancelJobsButton.toolTip = "Cancel the selected jobs."
+        batchButtonsLayout.addWidget(self.cancelJobsButton)
+        batchButtonsLayout.addStretch(1)
+        self.batchButton = qt.QPushButton("Run Batch")
+        self.batchButton.toolTip = "Run the model on all checked volumes."
+        batchButtonsLayout.addWidget(self.batchButton)
+        batchFormLayout.addRow(batchButtonsLayout)
+        self.batchJobs = dict()
+
+        #
+        # Timing Area
+        #
+        timingCollapsibleButton = ctk.ctkCollapsibleGroupBox()
+        timingCollapsibleButton.setTitle("Timing")
+        timingCollapsibleButton.collapsed = True
+        self.layout.addWidget(timingCollapsibleButton)
+        timingFormLayout = qt.QFormLayout(timingCollapsibleButton)
+        # stage times of the last completed jobs
+        self.timingHistory = deque(maxlen=50)
+        self.lastTrace = None
+        self.timingTable = qt.QTableWidget()
+        self.timingTable.setColumnCount(5)
+        self.timingTable.setHorizontalHeaderLabels(['Stage', 'Last (s)', 'Mean (s)', 'Max (s)', ''])
+        self.timingTable.horizontalHeader().setStretchLastSection(True)
+        self.timingTable.verticalHeader().setDefaultSectionSize(20)
+        self.timingTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.timingTable.toolTip = "Time spent in each stage by the last {} completed jobs.".format(
+            self.timingHistory.maxlen)
+        timingFormLayout.addRow(self.timingTable)
+        timingButtonsLayout = qt.QHBoxLayout()
+        timingButtonsLayout.addStretch(1)
+        self.exportTimingButton = qt.QPushButton("Export JSON")
+        self.exportTimingButton.toolTip = "Save the timing records of the last run."
+        timingButtonsLayout.addWidget(self.exportTimingButton)
+        self.exportTraceButton = qt.QPushButton("Export Trace")
+        self.exportTraceButton.toolTip = "Save the last run in the Chrome trace event format, " \
+                                         "for chrome://tracing or Perfetto."
+        timingButtonsLayout.addWidget(self.exportTraceButton)
+        timingFormLayout.addRow(timingButtonsLayout)
+
         # Add vertical spacer
         self.layout.addStretch(1)
 
@@ -303,57 +493,52 @@ class DeepInferWidget:
         self.testDockerButton.connect('clicked(bool)', self.onTestDockerButton)
         self.restoreDefaultsButton.connect('clicked(bool)', self.onRestoreDefaultsButton)
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.batchButton.connect('clicked(bool)', self.onBatchButton)
+        self.cancelJobsButton.connect('clicked(bool)', self.onCancelJobsButton)
+        self.clearCacheButton.connect('clicked(bool)', self.onClearCacheButton)
+        self.exportTimingButton.connect('clicked(bool)', lambda checked: self.onExportTiming(False))
+        self.exportTraceButton.connect('clicked(bool)', lambda checked: self.onExportTiming(True))
         self.cancelButton.connect('clicked(bool)', self.onCancelButton)
         self.modelRegistryTable.connect('itemSelectionChanged()', self.onCloudModelSelect)
+        self.prePullCheckBox.connect('toggled(bool)', self.onPrePullToggled)
 
         # Initlial Selection
         self.modelSelector.currentIndexChanged(self.modelSelector.currentIndex)
 
+        # query docker and clean up after earlier sessions without holding up the panel
+        self.dockerPath.connect('currentPathChanged(QString)', self.refreshDockerState)
+        self.refreshDockerState()
+        self.scratchPath.connect('currentPathChanged(QString)', lambda path: self.removeStaleJobDirs())
+        self.removeStaleJobDirs()
+
+    def removeStaleJobDirs(self):
+        """Clean up after earlier sessions in the configured scratch location, in the background"""
+        roots = ScratchSpace(self.scratchPath.currentPath).roots()
+        thread = threading.Thread(target=DeepInferLogic.removeStaleJobDirs, args=(roots,))
+        thread.daemon = True
+        thread.start()
+
     def cleanup(self):
-        pass
+        if self.logic:
+            self.logic.abort = True
+        WarmSessionManager.stopAll()
 
-    def getAllDigests(self):
-        cmd = []
-        cmd.append(self.dockerPath.currentPath)
-        cmd.append('images')
-        cmd.append('--digests')
-        # print(cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        digest_index = 2
-        digests = []
-        try:
-            while True:
-                slicer.app.processEvents()
-                line = p.stdout.readline()
-                if not line:
-                    break
-                line = line.split()
-                if 'DIGEST' in line:
-                    digest_index = line.index('DIGEST')
-                else:
-                    digests.append(line[digest_index])
-        except Exception as e:
-            print("Exception: {}".format(e))
-        return digests
+    def refreshDockerState(self, dockerPath=None):
+        self.dockerState = DockerState.get(self.dockerPath.currentPath)
+        self.dockerStateThread = self.dockerState.refresh()
+        qt.QTimer.singleShot(100, self.onDockerStatePoll)
+
+    def onDockerStatePoll(self):
+        if self.dockerStateThread.is_alive():
+            qt.QTimer.singleShot(100, self.onDockerStatePoll)
+            return
+        # mark the models whose image is missing
+        self.onSearch(self.searchBox.text)
 
     def populateLocalModels(self):
-        digests = self.getAllDigests()
-        jsonFiles = glob(JSON_LOCAL_DIR + "/*.json")
-        jsonFiles.sort(cmp=lambda x, y: cmp(os.path.basename(x), os.path.basename(y)))
-        self.jsonModels = []
-        for fname in jsonFiles:
-            with open(fname, "r") as fp:
-                j = json.load(fp, object_pairs_hook=OrderedDict)
-            self.jsonModels.append(j)
-            # if j['docker']['digest'] in digests:
-            #     self.jsonModels.append(j)
-            # else:
-            #     os.remove(fname)
-        # add all the models listed in the json files
-
-        for idx, j in enumerate(self.jsonModels):
-            name = j["name"]
-            self.modelSelector.addItem(name, idx)
+        # only the json files that changed since the last call are parsed
+        self.localCatalog.update()
+        self.onSearch(self.searchBox.text)
 
     def onCloudModelSelect(self):
         self.downloadButton.enabled = False
@@ -364,73 +549,98 @@ class DeepInferWidget:
                 self.selectedModelPath = self.modelTableItems[item]
 
     def onLogicRunStop(self):
-        self.applyButton.setEnabled(True)
+        self.lastTrace = self.logic.trace
+        self.updateCacheStatus()
         self.restoreDefaultsButton.setEnabled(True)
         self.cancelButton.setEnabled(False)
         self.logic = None
         self.progress.hide()
 
     def onLogicRunStart(self):
-        self.applyButton.setEnabled(False)
+        # Apply and Run Batch stay enabled, further runs are queued on the running logic
         self.restoreDefaultsButton.setEnabled(False)
 
     def onSearch(self, searchText):
-        # add all the models listed in the json files
+        # every word has to start a word of the model name, organ or task. case insensitive
+        fileNames = self.localCatalog.search(searchText)
+        selected = None
+        if self.modelSelector.currentIndex >= 0:
+            selected = self.modelSelector.itemData(self.modelSelector.currentIndex)
+        # rebuild the list without signals, the parameters are only recreated if the selected model changes
+        self.modelSelector.blockSignals(True)
         self.modelSelector.clear()
-        # split text on whitespace of and string search
-        searchTextList = searchText.split()
-        for idx, j in enumerate(self.jsonModels):
-            lname = j["name"].lower()
-            # require all elements in list, to add to select. case insensitive
-            if reduce(lambda x, y: x and (lname.find(y.lower()) != -1), [True] + searchTextList):
-                self.modelSelector.addItem(j["name"], idx)
+        for idx, fileName in enumerate(fileNames):
+            entry = self.localCatalog.entries[fileName]
+            label = entry['name']
+            otherFields = [field for field in self.localCatalog.matchedFields(fileName, searchText) if field != 'name']
+            if otherFields:
+                label += ' ({})'.format(', '.join(entry[field] for field in otherFields))
+            tip = '<br>'.join('{}: {}'.format(field.capitalize(), self.localCatalog.highlight(entry[field], searchText))
+                              for field in ModelCatalog.FIELDS if entry[field])
+            # unknown until the images have been listed
+            imagePresent = self.dockerState.hasImage(entry['repository'], entry['digest'])
+            if imagePresent is False:
+                label += ' - image not pulled'
+                tip += '<br>The docker image of this model is not on this machine, ' \
+                       'it is downloaded when the model is run.'
+            self.modelSelector.addItem(label, fileName)
+            self.modelSelector.setItemData(idx, tip, qt.Qt.ToolTipRole)
+            if imagePresent is False:
+                self.modelSelector.setItemData(idx, qt.QColor('gray'), qt.Qt.ForegroundRole)
+        index = fileNames.index(selected) if selected in fileNames else (0 if fileNames else -1)
+        self.modelSelector.setCurrentIndex(index)
+        self.modelSelector.blockSignals(False)
+        if (fileNames[index] if index >= 0 else None) != selected:
+            self.onModelSelect(index)
 
     def onModelSelect(self, selectorIndex):
         # print("on model select")
         self.modelParameters.destroy()
         if selectorIndex < 0:
             return
-        jsonIndex = self.modelSelector.itemData(selectorIndex)
-        json_model = self.jsonModels[jsonIndex]
+        json_model = self.localCatalog.load(self.modelSelector.itemData(selectorIndex))
         self.modelParameters.create(json_model)
 
-        if "briefdescription" in self.jsonModels[jsonIndex]:
-            tip = self.jsonModels[jsonIndex]["briefdescription"]
+        if "briefdescription" in json_model:
+            tip = json_model["briefdescription"]
             tip = tip.rstrip()
             self.modelSelector.setToolTip(tip)
         else:
             self.modelSelector.setToolTip("")
 
     def onConnectButton(self):
+        self.modelRegistryTable.visible = True
+        self.downloadButton.visible = True
+        self.connectButton.visible = False
+        self.connectButton.enabled = False
+        self.registrySyncResult = None
+        # sync on a worker thread and poll for the result, so that slow proxies do not block the GUI
+        self.registrySyncThread = threading.Thread(target=self.syncRegistry)
+        self.registrySyncThread.daemon = True
+        self.registrySyncThread.start()
+        qt.QTimer.singleShot(100, self.onRegistrySyncPoll)
+
+    def syncRegistry(self):
         try:
-            self.modelRegistryTable.visible = True
-            self.downloadButton.visible = True
-            self.connectButton.visible = False
-            self.connectButton.enabled = False
-            import urllib2
-            url = 'https://api.github.com/repos/DeepInfer/Model-Registry/contents/'
-            response = urllib2.urlopen(url)
-            data = json.load(response)
-            for item in data:
-                if 'json' in item['name']:
-                    # print(item['name'])
-                    url = item['url']
-                    response = urllib2.urlopen(url)
-                    data = json.load(response)
-                    dl_url = data['download_url']
-                    print("downloading: {}...".format(dl_url))
-                    response = urllib2.urlopen(dl_url)
-                    content = response.read()
-                    outputPath = os.path.join(JSON_CLOUD_DIR, dl_url.split('/')[-1])
-                    with open(outputPath, 'w') as f:
-                        f.write(content)
-            self.populateModelRegistryTable()
+            self.registrySyncResult = RegistrySync().sync()
         except Exception as e:
-            print("Exception occured: {}".format(e))
-            self.connectButton.enabled = True
+            self.registrySyncResult = e
+
+    def onRegistrySyncPoll(self):
+        if self.registrySyncThread.is_alive():
+            qt.QTimer.singleShot(100, self.onRegistrySyncPoll)
+            return
+        result = self.registrySyncResult
+        if isinstance(result, Exception):
+            print("Exception occured: {}".format(result))
             self.modelRegistryTable.visible = False
             self.downloadButton.visible = False
             self.connectButton.visible = True
+        else:
+            downloaded, unchanged, removed = result
+            print("Model registry: {} downloaded, {} unchanged, {} removed".format(
+                len(downloaded), len(unchanged), len(removed)))
+            self.populateModelRegistryTable()
         self.connectButton.enabled = True
 
     def onTestDockerButton(self):
@@ -447,133 +657,99 @@ class DeepInferWidget:
                                                               'installation and make sure that it is configured to '
                                                               'be run by non-root user.')
 
+    def getPullManager(self):
+        dockerState = DockerState.get(self.dockerPath.currentPath)
+        if not self.pullManager or self.pullManager.dockerState is not dockerState:
+            self.pullManager = PullManager(dockerState)
+        self.pullManager.maxConcurrentPulls = self.concurrentPullsSpinBox.value
+        self.pullManager.bandwidthLimit = int(self.pullBandwidthSpinBox.value * 1024 ** 2)
+        return self.pullManager
+
     def onDownloadButton(self):
-        with open(self.selectedModelPath) as json_data:
-            model = json.load(json_data)
-        size = model['docker']['size']
-        model_name = model['name']
-        dockerhub_address = model['docker']['dockerhub_repository'] + '@' + model['docker']['digest']
-        if platform.system() == 'Windows':
-            terminal = 'Command Prompt or PowerShell, but not PowerShell ISE'
+        # the image is pulled in the background, the model shows up in the local models when it is done
+        task = self.getPullManager().pull(self.selectedModelPath)
+        print("Pulling {}".format(task.reference()))
+        self.startPullPolling()
+
+    def startPullPolling(self):
+        if not self.pullPolling:
+            self.pullPolling = True
+            self.progressDownload.show()
+            qt.QTimer.singleShot(200, self.onPullPoll)
+
+    def onPullPoll(self):
+        pullManager = self.pullManager
+        pullManager.schedule()
+        for task in pullManager.tasks:
+            statusItem = self.modelStatusItems.get(task.modelPath)
+            if statusItem:
+                if task.status == 'pulling':
+                    statusItem.setText('Pulling {:.0f}%'.format(100 * task.progress()))
+                else:
+                    statusItem.setText({'queued': 'Queued', 'completed': 'Downloaded', 'failed': 'Failed',
+                                        'cancelled': 'Cancelled'}[task.status])
+                statusItem.setToolTip(task.error or '')
+            if task.status in ('completed', 'failed', 'cancelled') and task not in self.reportedPulls:
+                self.reportedPulls.add(task)
+                if task.status == 'completed':
+                    self.populateLocalModels()
+        self.progressDownload.setValue(int(100 * pullManager.progress()))
+        if pullManager.active():
+            qt.QTimer.singleShot(200, self.onPullPoll)
         else:
-            terminal = 'terminal'
-        message_title = '1. Copy the following command from the box below.\n' \
-                        '2. Open the {}, paste and run the copied command.\n' \
-                        '3. Wait until the docker image download is finished.\n' \
-                        '4. Restart 3D Slicer.\n' \
-                        '5. You should see the downloaded model in the \"Local Models\" section.\n' \
-                        '(Please note that the size of the \"{}\" docker image is {}.\n' \
-                        'Make sure that you have enough storage space on your machine.)'.format(terminal, model_name, size)
-        pull_command = 'docker pull {}'.format(dockerhub_address)
-        mainWindow = slicer.util.mainWindow()
-        downloadWidget = qt.QWidget()
-        layout = qt.QVBoxLayout()
-        downloadWidget.setLayout(layout)
-        popupGeometry = qt.QRect()
-        if mainWindow:
-            width = 400
-            height = 200
-            popupGeometry.setWidth(width)
-            popupGeometry.setHeight(height)
-            downloadWidget.setGeometry(popupGeometry)
-
-        pos = mainWindow.pos
-        downloadWidget.move(pos.x() + (mainWindow.width - downloadWidget.width) / 2,
-                            pos.y() + (mainWindow.height - downloadWidget.height) / 2)
-
-        titleLabel = qt.QLabel(message_title)
-        layout.addWidget(titleLabel)
-        te = qt.QTextEdit(pull_command)
-        te.readOnly = True
-        layout.addWidget(te)
-        closeButton = qt.QPushButton('Close')
-        layout.addWidget(closeButton)
-        downloadWidget.show()
-        def hide_download():
-            downloadWidget.hide()
-        closeButton.connect('clicked(bool)', hide_download)
-        shutil.copy(self.selectedModelPath, os.path.join(JSON_LOCAL_DIR, os.path.basename(self.selectedModelPath)))
-
+            self.pullPolling = False
+            self.progressDownload.setValue(0)
+            self.progressDownload.hide()
 
-    '''
-    def onDownloadButton(self):
-        with open(self.selectedModelPath) as json_data:
-            model = json.load(json_data)
-        size = model['docker']['size']
-        resoponse = self.Question("The size of the selected image to download is {}. Are you sure you want to proceed?".format(size),
-                      title="Download", parent=None)
-        if resoponse:
-            cmd = []
-            cmd.append(self.dockerPath.currentPath)
-            cmd.append('pull')
-            cmd.append(model['docker']['dockerhub_repository'] + '@' + model['docker']['digest'])
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            print(cmd)
-            parts = dict()
+    def onPrePullTimer(self):
+        """Pull the models of the site list that are missing during off-hours, checked every few minutes"""
+        if not self.prePullCheckBox.checked:
+            self.prePullTimerActive = False
+            return
+        if self.siteListPath.currentPath:
             try:
-                while True:
-                    self.progressDownload.show()
-                    slicer.app.processEvents()
-                    line = p.stdout.readline()
-                    if not line:
-                        break
-                    line = line.rstrip()
-                    print(line)
-                    part = line.split(':')[0]
-                    if len(part) == 12:
-                        parts[part] = line.split(':')[1]
-                    if parts.keys():
-                        print('-'*100)
-                        print(parts)
-                        n_parts = len(parts.keys())
-                        n_completed = len([status for status in parts.values() if status == ' Pull complete'])
-                        self.progressDownload.setValue(int((100*n_completed)/n_parts))
+                if SitePrePull(self.siteListPath.currentPath, self.getPullManager()).check():
+                    self.startPullPolling()
+            except (IOError, OSError, ValueError) as e:
+                print("Could not read the site list: {}".format(e))
+        qt.QTimer.singleShot(self.prePullInterval * 1000, self.onPrePullTimer)
 
-            except Exception as e:
-                print("Exception: {}".format(e))
-            print(parts)
-            self.progressDownload.setValue(0)
-            self.progressDownload.hide()
-            shutil.copy(self.selectedModelPath, os.path.join(JSON_LOCAL_DIR, os.path.basename(self.selectedModelPath)))
-            self.populateLocalModels()
-        else:
-            print("Download was canceled!")
+    def onPrePullToggled(self, checked):
+        if checked and not self.prePullTimerActive:
+            self.prePullTimerActive = True
+            self.onPrePullTimer()
 
-    '''
     def Question(self, text, title="", parent=None):
         return qt.QMessageBox.question(parent, title, text,
                                    qt.QMessageBox.Yes, qt.QMessageBox.No) == qt.QMessageBox.Yes
 
     def populateModelRegistryTable(self):
         self.modelTableItems = dict()
+        self.modelStatusItems = dict()
         # print("populate Model Registry Table")
-        model_files = glob(JSON_CLOUD_DIR+'/*.json')
-        self.modelRegistryTable.setRowCount(len(model_files))
-        n = 0
-        model_files = [os.path.join(JSON_CLOUD_DIR, model_file) for model_file in model_files]
-        for model_file in model_files:
-            with open(model_file) as json_data:
-                model = json.load(json_data)
-            keys = model.keys()
-            for key in keys:
-                if key == 'name':
-                    nameTableItem = qt.QTableWidgetItem(str(model['name']))
-                    self.modelTableItems[nameTableItem] = model_file
-                    self.modelRegistryTable.setItem(n, 0, nameTableItem)
-                if key == 'organ':
-                    organ = qt.QTableWidgetItem(str(model['organ']))
-                    self.modelRegistryTable.setItem(n, 1, organ)
-                if key == 'task':
-                    task = qt.QTableWidgetItem(str(model['task']))
-                    self.modelRegistryTable.setItem(n, 2, task)
-            n += 1
+        self.cloudCatalog.update()
+        fileNames = self.cloudCatalog.search()
+        # rows would move while they are filled otherwise
+        self.modelRegistryTable.sortingEnabled = False
+        self.modelRegistryTable.setRowCount(len(fileNames))
+        for n, fileName in enumerate(fileNames):
+            entry = self.cloudCatalog.entries[fileName]
+            nameTableItem = qt.QTableWidgetItem(entry['name'])
+            self.modelTableItems[nameTableItem] = os.path.join(JSON_CLOUD_DIR, fileName)
+            self.modelRegistryTable.setItem(n, 0, nameTableItem)
+            self.modelRegistryTable.setItem(n, 1, qt.QTableWidgetItem(entry['organ']))
+            self.modelRegistryTable.setItem(n, 2, qt.QTableWidgetItem(entry['task']))
+            statusItem = qt.QTableWidgetItem('')
+            self.modelStatusItems[os.path.join(JSON_CLOUD_DIR, fileName)] = statusItem
+            self.modelRegistryTable.setItem(n, 3, statusItem)
+        self.modelRegistryTable.sortingEnabled = True
 
     def onRestoreDefaultsButton(self):
         self.onModelSelect(self.modelSelector.currentIndex)
 
     def onApplyButton(self):
         print('onApply')
-        self.logic = DeepInferLogic()
+        self.createLogic()
         # try:
         self.currentStatusLabel.text = "Starting"
         self.modelParameters.prerun()
@@ -592,6 +768,104 @@ class DeepInferWidget:
                                     msg)
         '''
 
+    def createBatchOutputs(self, inputNode):
+        """Create (or reuse) output nodes named after the input node for a batch job"""
+        outputs = dict()
+        iodict = self.modelParameters.iodict
+        for item in iodict:
+            if iodict[item]["iotype"] != "output":
+                continue
+            if iodict[item]["type"] == "volume":
+                if iodict[item].get("voltype") == 'LabelMap':
+                    className = 'vtkMRMLLabelMapVolumeNode'
+                else:
+                    className = 'vtkMRMLScalarVolumeNode'
+            elif iodict[item]["type"] == "point_vec":
+                className = 'vtkMRMLMarkupsFiducialNode'
+            else:
+                continue
+            name = '{}-{}'.format(inputNode.GetName(), item)
+            node = slicer.mrmlScene.GetFirstNodeByName(name)
+            if not node or not node.IsA(className):
+                node = slicer.mrmlScene.AddNewNodeByClass(className, name)
+            outputs[item] = node
+        return outputs
+
+    def onBatchButton(self):
+        iodict = self.modelParameters.iodict
+        batchInputs = [item for item in sorted(iodict)
+                       if iodict[item]["iotype"] == "input" and iodict[item]["type"] == "volume"]
+        inputNodes = self.batchInputSelector.checkedNodes()
+        if not batchInputs or not inputNodes:
+            return
+        self.modelParameters.prerun()
+        jobs = []
+        for inputNode in inputNodes:
+            inputs = dict(self.modelParameters.inputs)
+            inputs[batchInputs[0]] = inputNode
+            outputs = self.createBatchOutputs(inputNode)
+            job = DeepInferJob.fromModelParameters(self.modelParameters, inputs, outputs, inputNode.GetName())
+            job.updateViews = self.batchViewsCheckBox.checked
+            jobs.append(job)
+        if not self.logic:
+            # a new run starts with an empty table, jobs added to a running batch are appended
+            self.batchTable.setRowCount(0)
+            self.batchJobs = dict()
+            self.throughputLabel.text = ''
+        for job in jobs:
+            row = self.batchTable.rowCount
+            self.batchTable.insertRow(row)
+            self.batchJobs[job.id] = (row, job)
+            self.batchTable.setItem(row, 0, qt.QTableWidgetItem(job.name))
+            self.batchTable.setItem(row, 1, qt.QTableWidgetItem(job.status))
+            self.batchTable.setItem(row, 2, qt.QTableWidgetItem(''))
+        self.createLogic()
+        self.currentStatusLabel.text = "Starting"
+        self.logic.runBatch(jobs)
+
+    def createLogic(self):
+        """Create the logic for a new run, or reuse the running one so that the job is queued"""
+        if not self.logic:
+            self.logic = DeepInferLogic()
+        self.logic.useWarmSession = self.warmSessionCheckBox.checked
+        self.logic.maxConcurrentJobs = self.concurrencySpinBox.value
+        self.logic.compressExchange = self.compressExchangeCheckBox.checked
+        self.logic.scratch.setLocation(self.scratchPath.currentPath)
+        self.logic.scratch.useSharedMemory = self.sharedMemoryCheckBox.checked
+        self.logic.resultCache = self.getResultCache() if self.cacheCheckBox.checked else None
+        self.logic.resourceOverrides = dict()
+        if self.cpusSpinBox.value:
+            self.logic.resourceOverrides['cpus'] = self.cpusSpinBox.value
+        if self.memorySpinBox.value:
+            self.logic.resourceOverrides['memory'] = '{}m'.format(int(self.memorySpinBox.value * 1024))
+        if self.tuneThreadsCheckBox.checked and not self.threadTuner:
+            self.threadTuner = ThreadTuner()
+        self.logic.threadTuner = self.threadTuner if self.tuneThreadsCheckBox.checked else None
+        WarmSessionManager.idleTimeout = self.idleTimeoutSpinBox.value * 60
+
+    def getResultCache(self):
+        if not self.resultCache:
+            self.resultCache = ResultCache()
+        self.resultCache.maxSize = int(self.cacheSizeSpinBox.value * 1024 ** 3)
+        return self.resultCache
+
+    def updateCacheStatus(self):
+        if self.resultCache:
+            self.cacheStatusLabel.text = '{0:.2f} GB used, {1} hits, {2} misses'.format(
+                self.resultCache.size() / float(1024 ** 3), self.resultCache.hits, self.resultCache.misses)
+
+    def onClearCacheButton(self):
+        self.getResultCache().clear()
+        self.updateCacheStatus()
+
+    def onCancelJobsButton(self):
+        if not self.logic:
+            return
+        rows = set([index.row() for index in self.batchTable.selectedIndexes()])
+        for row, job in self.batchJobs.values():
+            if row in rows:
+                self.logic.cancelJob(job)
+
     def onCancelButton(self):
         self.currentStatusLabel.text = "Aborting"
         if self.logic:
@@ -610,13 +884,62 @@ class DeepInferWidget:
     def onLogicEventAbort(self):
         self.currentStatusLabel.text = "Aborted"
 
-    def onLogicEventProgress(self, progress):
-        self.currentStatusLabel.text = "Running ({0:6.5f})".format(progress)
+    def onLogicEventFailed(self, reason):
+        self.currentStatusLabel.text = "Failed: {}".format(reason)
+
+    def onLogicEventProgress(self, progress, status=''):
+        self.currentStatusLabel.text = "Running {0:.0f}%{1}".format(progress * 100, ' (' + status + ')' if status else '')
         self.progress.setValue(progress * 1000)
 
     def onLogicEventIteration(self, nIter):
         print("Iteration ", nIter)
 
+    def onLogicJobStatus(self, job):
+        if job.status == 'completed':
+            self.timingHistory.append(dict(job.timings))
+            self.updateTimingTable()
+        if job.id not in self.batchJobs:
+            return
+        row, _ = self.batchJobs[job.id]
+        self.batchTable.item(row, 1).setText(job.status)
+        duration = job.duration()
+        if duration is not None:
+            self.batchTable.item(row, 2).setText('{0:.1f}'.format(duration))
+        if self.logic:
+            completed = len([j for j in self.logic.jobs if j.status == 'completed'])
+            self.throughputLabel.text = '{0} of {1} done, {2:.2f} cases/min'.format(
+                completed, len(self.logic.jobs), self.logic.throughput())
+
+    def updateTimingTable(self):
+        stages = [stage for stage in RunTrace.STAGES if any([stage in timings for timings in self.timingHistory])]
+        means = dict()
+        for stage in stages:
+            values = [timings.get(stage, 0) for timings in self.timingHistory]
+            means[stage] = (self.timingHistory[-1].get(stage, 0), sum(values) / len(values), max(values))
+        longest = max([mean for last, mean, longest in means.values()] + [1e-6])
+        self.timingTable.setRowCount(len(stages))
+        for row, stage in enumerate(stages):
+            last, mean, longestStage = means[stage]
+            # a text bar of the mean, relative to the slowest stage
+            bar = u'\u2588' * int(round(20 * mean / longest))
+            for column, text in enumerate([stage, '{0:.2f}'.format(last), '{0:.2f}'.format(mean),
+                                           '{0:.2f}'.format(longestStage), bar]):
+                self.timingTable.setItem(row, column, qt.QTableWidgetItem(text))
+
+    def onExportTiming(self, chromeTrace):
+        trace = self.logic.trace if self.logic else self.lastTrace
+        if not trace:
+            return
+        path = qt.QFileDialog.getSaveFileName(None, "Export Trace" if chromeTrace else "Export Timing",
+                                              "deepinfer.trace.json" if chromeTrace else "deepinfer-timing.json",
+                                              "JSON files (*.json)")
+        if not path:
+            return
+        if chromeTrace:
+            trace.writeChromeTrace(path)
+        else:
+            trace.writeJSON(path)
+
 #
 # DeepInferLogic
 #
@@ -632,10 +955,46 @@ class DeepInferLogic:
     def __init__(self):
         self.main_queue = queue.Queue()
         self.main_queue_running = False
-        self.thread = threading.Thread()
+        self.main_queue_lock = threading.Lock()
+        self.main_queue_wakeup_pending = False
+        self.main_queue_sockets = None
+        self.main_queue_notifier = None
+        self.main_queue_batch_size = 100
+        self.workers = dict()
         self.abort = False
-        modules = slicer.modules
-        if hasattr(modules, 'DeepInferWidget'):
+        # why the remaining jobs of a run cannot be run, e.g. the docker daemon is not running
+        self.failure = None
+        # pipeline directory -> its lock, see ScratchSpace.lock
+        self.pipelineLocks = dict()
+        self.stopping = False
+        self.useWarmSession = False
+        self.volumeExchange = VolumeExchange()
+        # prefer compressed exchange formats, for slow or network disks
+        self.compressExchange = False
+        self.scratch = ScratchSpace()
+        self.resultCache = None
+        # user settings that replace the resources of the models, see ContainerResources
+        self.resourceOverrides = dict()
+        self.threadTuner = None
+        self.jobs = []
+        self.pendingJobs = FairJobQueue()
+        self.readyJobs = deque()
+        self.runningJobs = []
+        self.maxConcurrentJobs = 1
+        # cancelled jobs whose containers are being stopped, they no longer take a slot
+        self.stoppingJobs = []
+        self.abortPollInterval = 0.1
+        self.stopTimeout = 10
+        self.memoryBudget = int(0.75 * self.physicalMemory())
+        self.daemonRunning = None
+        self.daemonLock = threading.Lock()
+        self.batchStartTime = time()
+        self.progressInterval = 0.1
+        self.lastProgressEvent = 0
+        self.trace = RunTrace()
+        # without a widget and an event loop, see wait
+        self.headless = slicer is None
+        if slicer and hasattr(slicer.modules, 'DeepInferWidget'):
             self.dockerPath = slicer.modules.DeepInferWidget.dockerPath.currentPath
         else:
             if platform.system() == 'Darwin':
@@ -654,8 +1013,12 @@ class DeepInferLogic:
     def __del__(self):
         if self.main_queue_running:
             self.main_queue_stop()
-        if self.thread.is_alive():
-            self.thread.join()
+        for thread in list(self.workers.values()):
+            thread.join()
+        if self.main_queue_notifier:
+            self.main_queue_notifier.setEnabled(False)
+        for sock in self.main_queue_sockets or []:
+            sock.close()
 
     def setDockerPath(self, path):
         self.dockerPath = path
@@ -663,247 +1026,3702 @@ class DeepInferLogic:
     def yieldPythonGIL(self, seconds=0):
         sleep(seconds)
 
-    def cmdCheckAbort(self, p):
-        if self.abort:
+    def watchContainer(self, p, job, containerName, finished):
+        """Stop the container as soon as its job is aborted. Runs on its own thread while
+        executeDocker reads the container output, which may block for a long time."""
+        while not finished.wait(self.abortPollInterval):
+            if self.isAborted(job):
+                self.stopContainer(p, containerName)
+                return
+
+    def stopContainer(self, p, containerName):
+        """Kill the container, not just the docker client, and wait for the client to exit"""
+        if containerName and not DockerState.get(self.dockerPath).killContainer(containerName, self.stopTimeout):
+            print("Could not kill container {}".format(containerName))
+        try:
+            p.wait(self.stopTimeout)
+        except subprocess.TimeoutExpired:
+            print("{} did not stop within {} s, killing the docker client".format(containerName, self.stopTimeout))
             p.kill()
-            self.cmdAbortEvent()
+            # the container may have been started in the meantime, e.g. after pulling its image
+            if containerName:
+                DockerState.get(self.dockerPath).killContainer(containerName, self.stopTimeout)
+
+    def postWidgetEvent(self, methodName, *args):
+        """Queue a call to a widget method so that it is run on the main thread"""
+        if self.headless:
+            return
+
+        def widgetEvent():
+            if hasattr(slicer.modules, 'DeepInferWidget'):
+                getattr(slicer.modules.DeepInferWidget, methodName)(*args)
+        self.main_queue_post(widgetEvent)
 
     def cmdStartEvent(self):
-        if hasattr(slicer.modules, 'DeepInferWidget'):
-            widget = slicer.modules.DeepInferWidget
-            widget.onLogicEventStart()
-        self.yieldPythonGIL()
+        self.postWidgetEvent('onLogicEventStart')
 
     def cmdProgressEvent(self, progress):
-        if hasattr(slicer.modules, 'DeepInferWidget'):
-            widget = slicer.modules.DeepInferWidget
-            widget.onLogicEventProgress(progress)
-        self.yieldPythonGIL()
+        self.postWidgetEvent('onLogicEventProgress', progress, self.progressStatus())
 
     def cmdAbortEvent(self):
-        if hasattr(slicer.modules, 'DeepInferWidget'):
-            widget = slicer.modules.DeepInferWidget
-            widget.onLogicEventAbort()
-        self.yieldPythonGIL()
+        self.postWidgetEvent('onLogicEventAbort')
 
     def cmdEndEvent(self):
-        if hasattr(slicer.modules, 'DeepInferWidget'):
-            widget = slicer.modules.DeepInferWidget
-            widget.onLogicEventEnd()
-        self.yieldPythonGIL()
+        self.postWidgetEvent('onLogicEventEnd')
 
-    def checkDockerDaemon(self):
-        cmd = list()
-        cmd.append(self.dockerPath)
-        cmd.append('ps')
-        print(cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        slicer.app.processEvents()
-        line = p.stdout.readline()
-        if line[:9] == 'CONTAINER':
-            return True
-        return False
+    def cmdFailEvent(self, reason):
+        self.postWidgetEvent('onLogicEventFailed', reason)
 
-    def executeDocker(self, dockerName, modelName, dataPath, iodict, inputs, params):
-        try:
-            assert self.checkDockerDaemon(), "Docker Daemon is not running"
-        except Exception as e:
-            print(e.message)
-            self.abort = True
-
-        modules = slicer.modules
-        if hasattr(modules, 'DeepInferWidget'):
-            widgetPresent = True
-        else:
-            widgetPresent = False
+    def checkDockerDaemon(self):
+        # cached between runs, docker is only asked again after DockerState.ttl seconds
+        return DockerState.get(self.dockerPath).isDaemonRunning()
 
-        if widgetPresent:
-            self.cmdStartEvent()
+    def exportInputs(self, iodict, inputs, params, workDir, exchangeFormat='nrrd', preprocessing=None):
+        """Write the input nodes to the job directory, cropped and resampled by preprocessing
+        if given. Must be called from the main thread."""
         inputDict = dict()
-        outputDict = dict()
         paramDict = dict()
         for item in iodict:
             if iodict[item]["iotype"] == "input":
-                if iodict[item]["type"] == "volume":
-                    # print(inputs[item])
-                    input_node_name = inputs[item].GetName()
-                    #try:
-                    img = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(input_node_name))
-                    fileName = item + '.nrrd'
+                if isinstance(inputs[item], str):
+                    # headless runs pass file names instead of nodes
+                    fileName = item + self.fileExtension(inputs[item])
+                    inputDict[item] = fileName
+                    self.linkOrCopy(inputs[item], os.path.join(workDir, fileName))
+                elif iodict[item]["type"] == "volume":
+                    fileName = item + VolumeExchange.FORMATS[exchangeFormat]
                     inputDict[item] = fileName
-                    sitk.WriteImage(img, str(os.path.join(TMP_PATH, fileName)))
-                    #except Exception as e:
-                    #    print(e.message)
+                    if preprocessing:
+                        array = preprocessing.apply(slicer.util.arrayFromVolume(inputs[item]),
+                                                    iodict[item].get("voltype") == 'LabelMap')
+                        self.volumeExchange.writeArray(array, self.vtkMatrix(preprocessing.outputIJKToRAS),
+                                                       os.path.join(workDir, fileName), exchangeFormat, True)
+                    else:
+                        self.volumeExchange.write(inputs[item], os.path.join(workDir, fileName), None,
+                                                  exchangeFormat)
                 elif iodict[item]["type"] == "point_vec":
                     input_node_name = inputs[item].GetName()
                     fidListNode = getNode(input_node_name)
                     fileName = item + '.fcsv'
                     inputDict[item] = fileName
-                    output_path = str(os.path.join(TMP_PATH, fileName))
+                    output_path = str(os.path.join(workDir, fileName))
                     saveNode(fidListNode, output_path)
-            elif iodict[item]["iotype"] == "output":
-                if iodict[item]["type"] == "volume":
-                      outputDict[item] = item + '.nrrd'
-                elif iodict[item]["type"] == "point_vec":
-                    outputDict[item] = item + '.fcsv'
             elif iodict[item]["iotype"] == "parameter":
                 paramDict[item] = str(params[item])
+        outputDict = self.createOutputDict(iodict, exchangeFormat)
+        return inputDict, outputDict, paramDict
+
+    @staticmethod
+    def fileExtension(path):
+        name = os.path.basename(path)
+        for extension in ('.nii.gz', '.seg.nrrd'):
+            if name.endswith(extension):
+                return extension
+        return os.path.splitext(name)[1]
+
+    @staticmethod
+    def linkOrCopy(source, destination):
+        try:
+            os.link(source, destination)
+        except (AttributeError, OSError):
+            shutil.copy(source, destination)
 
-        if not dataPath:
-            dataPath = '/home/deepinfer/data'
-
-        print('docker run command:')
-        cmd = list()
-        cmd.append(self.dockerPath)
-        cmd.extend(('run', '-t', '-v'))
-        cmd.append(TMP_PATH + ':' + dataPath)
-        cmd.append(dockerName)
+    def createOutputDict(self, iodict, exchangeFormat='nrrd'):
+        """File names of the outputs of a model"""
+        outputDict = dict()
+        for item in iodict:
+            if iodict[item]["iotype"] == "output":
+                if iodict[item]["type"] == "volume":
+                    outputDict[item] = item + VolumeExchange.FORMATS[exchangeFormat]
+                elif iodict[item]["type"] == "point_vec":
+                    outputDict[item] = item + '.fcsv'
+        return outputDict
+
+    def prepareJob(self, job):
+        """Export the inputs of a job and build its container arguments. Must be called from the main thread."""
+        job.exchangeFormat = self.chooseExchangeFormat(job)
+        job.resources = self.jobResources(job)
+        # cached outputs are also on the preprocessed grid and are pasted back the same way
+        job.volumePreprocessing = self.createPreprocessing(job)
+        # warm session containers have the configured scratch root mounted
+        warm = self.useWarmSession and job.warmSession
+        if job.tiling and not job.volumePreprocessing and self.canTile(job):
+            # the scratch space needed depends on the tiles that run at once
+            self.createTileGrid(job, warm)
+        job.scratchRoot = self.scratch.allocate(job, allowSharedMemory=not warm)
+        job.workDir = os.path.join(job.scratchRoot, job.id)
+        os.makedirs(job.workDir)
+        job.workDirLock = self.scratch.lock(job.workDir)
+        if job.pipelineDir and job.pipelineDir not in self.pipelineLocks:
+            if not os.path.isdir(job.pipelineDir):
+                os.makedirs(job.pipelineDir)
+            self.pipelineLocks[job.pipelineDir] = self.scratch.lock(job.pipelineDir)
+        # models without a digest may change under the same name, their results are not cached
+        if self.resultCache and job.digest:
+            with self.trace.span('cache lookup', job):
+                job.cacheKey = self.resultCache.computeKey(job)
+                job.cached = self.resultCache.lookup(job.cacheKey, job.workDir,
+                                                     self.createOutputDict(job.iodict, job.exchangeFormat).values())
+            if job.cached:
+                return
+        dataPath = job.dataPath or '/home/deepinfer/data'
+        if self.useWarmSession and job.warmSession:
+            job.session = WarmSessionManager.get(self.dockerPath, job.dockerImageName, dataPath, self.scratch.root,
+                                                 job.resources)
+        # the scratch root is mounted, every job reads and writes its own sub directory
+        jobDataPath = dataPath + '/' + job.id
+        if job.tileGrid:
+            self.prepareTiles(job, dataPath, jobDataPath)
+            return
+        with self.trace.span('export', job):
+            inputDict, outputDict, paramDict = self.exportInputs(job.iodict, job.inputs, job.params, job.workDir,
+                                                                 job.exchangeFormat, job.volumePreprocessing)
+        # rough working set of a model: a few copies of its input voxels
+        job.memoryEstimate = 4 * sum([os.path.getsize(os.path.join(job.workDir, fileName))
+                                      for fileName in inputDict.values()])
+        job.modelArgs = self.createModelArguments(job.modelName, jobDataPath, job.iodict,
+                                                  inputDict, outputDict, paramDict)
+        job.containerName = 'deepinfer-' + job.id
+        job.cmd = self.createJobCommand(job)
+        # the first job of a model that has no tuned thread count on this host finds it
+        job.tuneThreads = bool(self.threadTuner) and 'threads' not in self.resourceOverrides and \
+            self.threadTuner.claim(job)
+
+    def chooseExchangeFormat(self, job):
+        """The exchange format of a job, the fastest one its model supports"""
+        allowed = None
+        if any([isinstance(path, str) for path in list(job.inputs.values()) + list(job.outputs.values())]):
+            # outputs of headless runs are converted with SimpleITK, and there is no
+            # input node to take the geometry of npy outputs from
+            allowed = ('nrrd', 'nrrd-gzip', 'nii', 'nii.gz')
+        exchangeFormat = self.volumeExchange.chooseFormat(job.exchangeFormats, self.compressExchange, allowed)
+        if exchangeFormat != 'nrrd':
+            print("{} exchanges volumes as {}".format(job.name, exchangeFormat))
+        return exchangeFormat
+
+    def jobResources(self, job):
+        """The resources of a job: those of its model, replaced by the user settings, with the
+        tuned thread count of this host. Models that declare neither cpus nor threads share
+        the cores with the other jobs that may run at once."""
+        import multiprocessing
+        resources = dict(job.resources)
+        resources.update(self.resourceOverrides)
+        tuned = self.threadTuner.lookup(job) if self.threadTuner else None
+        if tuned and 'threads' not in self.resourceOverrides:
+            resources['threads'] = tuned
+        elif ContainerResources.threads(resources) is None and self.maxConcurrentJobs > 1:
+            resources['threads'] = max(1, multiprocessing.cpu_count() // self.maxConcurrentJobs)
+        return resources
+
+    def createPreprocessing(self, job):
+        """The cropping and resampling of the inputs of a job its model declares, see
+        VolumePreprocessing. None if there is none or the inputs cannot be preprocessed."""
+        import numpy as np
+        if not job.preprocessing:
+            return None
+        if any([isinstance(node, str) for node in list(job.inputs.values()) + list(job.outputs.values())]):
+            print("{} reads and writes files, exporting its inputs as they are".format(job.name))
+            return None
+        volumes = [job.inputs[item] for item in job.iodict
+                   if job.iodict[item]["iotype"] == "input" and job.iodict[item]["type"] == "volume"]
+        geometries = [(node.GetImageData().GetDimensions(),
+                       tuple(self.volumeExchange.regionIJKToRAS(node).GetElement(row, col)
+                             for row in range(3) for col in range(4))) for node in volumes]
+        if len(set(geometries)) != 1:
+            print("{} has inputs of different geometry, exporting its inputs as they are".format(job.name))
+            return None
+        points = None
+        roi = job.preprocessing.get('roi')
+        if roi:
+            if not job.inputs.get(roi):
+                raise ValueError('No region of interest given for {}'.format(roi))
+            points = VolumePreprocessing.roiPoints(job.inputs[roi])
+        dimensions, elements = geometries[0]
+        ijkToRAS = np.array(elements + (0, 0, 0, 1)).reshape(4, 4)
+        return VolumePreprocessing(job.preprocessing, dimensions, ijkToRAS, points)
+
+    @staticmethod
+    def vtkMatrix(array):
+        import vtk
+        matrix = vtk.vtkMatrix4x4()
+        for row in range(4):
+            for col in range(4):
+                matrix.SetElement(row, col, array[row][col])
+        return matrix
+
+    def canTile(self, job):
+        """Tiling needs volume nodes as inputs and outputs, and inputs of the same size"""
+        volumes = [item for item in job.iodict if job.iodict[item]["iotype"] in ("input", "output")]
+        if any([isinstance(node, str) for node in list(job.inputs.values()) + list(job.outputs.values())]):
+            print("{} reads and writes files, running it on the whole volume".format(job.name))
+            return False
+        if any([job.iodict[item]["type"] != "volume" for item in volumes]):
+            print("{} has point inputs or outputs, running it on the whole volume".format(job.name))
+            return False
+        inputs = [job.inputs[item] for item in volumes if job.iodict[item]["iotype"] == "input"]
+        if not inputs or len(set([inputNode.GetImageData().GetDimensions() for inputNode in inputs])) != 1:
+            print("{} has inputs of different sizes, running it on the whole volume".format(job.name))
+            return False
+        return True
+
+    def createTileGrid(self, job, warm=False):
+        """Split the inputs of a job into tiles, see VolumeTiling"""
+        import numpy as np
+        iodict = job.iodict
+        inputItems = [item for item in iodict if iodict[item]["iotype"] == "input"]
+        referenceNode = job.inputs[inputItems[0]]
+        job.tileGrid = VolumeTiling(referenceNode.GetImageData().GetDimensions(),
+                                    job.tiling.get('tile_size', [128, 128, 128]), job.tiling.get('overlap', 0))
+        # a warm session runs one tile at a time
+        job.tileWorkers = 1 if warm else max(1, int(job.tiling.get('parallel', 1)))
+        tileVoxels = np.prod([s.stop - s.start for s in job.tileGrid.region(0)])
+        tileBytes = 0
+        for item in inputItems:
+            imageData = job.inputs[item].GetImageData()
+            tileBytes += tileVoxels * imageData.GetScalarSize() * imageData.GetNumberOfScalarComponents()
+        job.memoryEstimate = 4 * int(tileBytes) * job.tileWorkers
+
+    def prepareTiles(self, job, dataPath, jobDataPath):
+        """Build the container commands of the tiles of a job. The inputs of a tile are only
+        written when a tile worker is free to run it, see exportTile."""
+        iodict = job.iodict
+        inputItems = [item for item in iodict if iodict[item]["iotype"] == "input"]
+        outputDict = self.createOutputDict(iodict, job.exchangeFormat)
+        paramDict = dict([(item, str(job.params[item])) for item in iodict if iodict[item]["iotype"] == "parameter"])
+        inputDict = dict([(item, item + VolumeExchange.FORMATS[job.exchangeFormat]) for item in inputItems])
+        # the tiles that run at once share the cores of the job
+        tileResources = ContainerResources.share(job.resources, job.tileWorkers)
+        for index in range(len(job.tileGrid)):
+            tileName = 'tile{}'.format(index)
+            modelArgs = self.createModelArguments(job.modelName, jobDataPath + '/' + tileName, iodict,
+                                                  inputDict, outputDict, paramDict)
+            containerName = 'deepinfer-{}-{}'.format(job.id, tileName)
+            job.tiles.append({'index': index, 'dir': os.path.join(job.workDir, tileName), 'inputs': inputDict,
+                              'modelArgs': modelArgs, 'container': containerName,
+                              'cmd': self.createDockerCommand(job.dockerImageName, dataPath, modelArgs,
+                                                              job.scratchRoot, containerName, tileResources)})
+
+    def exportTile(self, job, tile):
+        """Write the inputs of a tile. Called on the main thread."""
+        os.mkdir(tile['dir'])
+        region = job.tileGrid.region(tile['index'])
+        for item, fileName in tile['inputs'].items():
+            self.volumeExchange.write(job.inputs[item], os.path.join(tile['dir'], fileName), region,
+                                      job.exchangeFormat)
+
+    def requestTileExport(self, job, tile):
+        """Have the main thread write the inputs of a tile and wait for it. Returns False if
+        the job was aborted, the export failed or main_queue stopped. Called from a tile worker."""
+        exported = threading.Event()
+
+        def export():
+            try:
+                if not self.isAborted(job):
+                    with self.trace.span('export', job):
+                        self.exportTile(job, tile)
+            except Exception as e:
+                print("Exception while exporting tile {} of {}: {}".format(tile['index'], job.name, e))
+                job.tileError = e
+                job.abort = True
+            exported.set()
+        self.main_queue_post(export)
+        # main_queue_stop joins the workers on the main thread, which then never exports
+        while not exported.wait(0.1):
+            if self.isAborted(job) or not self.main_queue_running:
+                return False
+        return not self.isAborted(job)
+
+    def createModelArguments(self, modelName, dataPath, iodict, inputDict, outputDict, paramDict):
+        """Arguments passed to the model entry point inside the container"""
+        args = list()
         for key in inputDict.keys():
-            cmd.append('--' + key)
-            cmd.append(dataPath + '/' + inputDict[key])
+            args.append('--' + key)
+            args.append(dataPath + '/' + inputDict[key])
         for key in outputDict.keys():
-            cmd.append('--' + key)
-            cmd.append(dataPath + '/' + outputDict[key])
+            args.append('--' + key)
+            args.append(dataPath + '/' + outputDict[key])
         if modelName:
-            cmd.append('--ModelName')
-            cmd.append(modelName)
+            args.append('--ModelName')
+            args.append(modelName)
         for key in paramDict.keys():
             if iodict[key]["type"] == "bool":
-                if paramDict[key]:
-                    cmd.append('--' + key)
+                # stored as 0 or 1, see ModelParameters.parseParameter
+                if paramDict[key] not in ('0', 'False'):
+                    args.append('--' + key)
             else:
-                cmd.append('--' + key)
-                cmd.append(paramDict[key])
-        print('-'*100)
-        print(cmd)
-
-        # TODO: add a line to check wether the docker image is present or not. If not ask user to download it.
-        # try:
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        progress = 0
+                args.append('--' + key)
+                args.append(paramDict[key])
+        return args
+
+    def createJobCommand(self, job, containerName=None, resources=None):
+        """The docker command of a job that is neither tiled nor run in a warm session"""
+        return self.createDockerCommand(job.dockerImageName, job.dataPath or '/home/deepinfer/data', job.modelArgs,
+                                        job.scratchRoot, containerName or job.containerName,
+                                        resources or job.resources)
+
+    def createDockerCommand(self, dockerName, dataPath, modelArgs, scratchRoot=TMP_PATH, containerName=None,
+                            resources=None):
+        cmd = list()
+        cmd.append(self.dockerPath)
+        cmd.extend(('run', '-t', '--rm'))
+        if containerName:
+            # named, so that it can be killed when the job is cancelled
+            cmd.extend(('--name', containerName))
+        cmd.extend(ContainerResources.dockerOptions(resources or {}))
+        cmd.append('-v')
+        cmd.append(scratchRoot + ':' + dataPath)
+        cmd.append(dockerName)
+        cmd.extend(modelArgs)
+        logging.debug('docker run command: %s', cmd)
+        return cmd
+
+    def onContainerOutput(self, job, line):
+        if job.tiles:
+            # the progress of a tiled job is the fraction of its tiles that are done
+            if not line.startswith(PROGRESS_TAG):
+                print(line.rstrip())
+            return
+        stage = job.stage()
+        if not job.updateProgress(line):
+            print(line.rstrip())
+        # stage changes are always shown, other updates at most every progressInterval seconds
+        now = time()
+        if job.stage() != stage or now - self.lastProgressEvent >= self.progressInterval:
+            self.lastProgressEvent = now
+            self.cmdProgressEvent(self.overallProgress())
+
+    def progressStatus(self):
+        """Stage and remaining time of the running jobs, for the status label"""
+        jobs = list(self.runningJobs)
+        stages = [job.stage() for job in jobs if job.stage()]
+        status = ', '.join(sorted(set(stages)))
+        etas = [job.eta for job in jobs if job.eta is not None]
+        if etas:
+            status += (' - ' if status else '') + '{:.0f} s left'.format(max(etas))
+        return status
+
+    def executeDocker(self, cmd, job=None, containerName=None, category='pipeline'):
+        """Run the container and forward its output. Called from a worker thread."""
+        start = time()
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        finished = threading.Event()
+        watcher = threading.Thread(target=self.watchContainer, args=(p, job, containerName, finished))
+        watcher.daemon = True
+        watcher.start()
         # print('executing')
-        while True:
-            progress += 0.15
-            slicer.app.processEvents()
-            self.cmdCheckAbort(p)
-            if widgetPresent:
-                self.cmdProgressEvent(progress)
-            line = p.stdout.readline()
-            if not line:
+        # the container has started once it prints its first line
+        computeStart = None
+        try:
+            while True:
+                line = p.stdout.readline()
+                if not line:
                     break
-            print(line)
-
-
-    def thread_doit(self, modelParameters):
-        iodict = modelParameters.iodict
-        inputs = modelParameters.inputs
-        params = modelParameters.params
-        outputs = modelParameters.outputs
-        dockerName = modelParameters.dockerImageName
-        modelName = modelParameters.modelName
-        dataPath = modelParameters.dataPath
-        #try:
-        self.main_queue_start()
-        self.executeDocker(dockerName, modelName, dataPath, iodict, inputs, params)
-        if not self.abort:
-            self.updateOutput(iodict, outputs)
-            self.main_queue_stop()
+                if computeStart is None:
+                    computeStart = time()
+                    self.trace.add('container start', start, computeStart, job, category)
+                if not self.isAborted(job):
+                    self.onContainerOutput(job, line)
+            p.wait()
+        finally:
+            finished.set()
+            watcher.join()
+        if computeStart is None:
+            self.trace.add('container start', start, time(), job, category)
+        else:
+            self.trace.add('compute', computeStart, time(), job, category)
+        return p.returncode
+
+    def executeJob(self, job):
+        """Run the container of a job. Called from a worker thread."""
+        job.progress = 0
+        self.cmdProgressEvent(self.overallProgress())
+        if job.tiles:
+            return self.executeTiles(job)
+        if job.session:
+            with self.trace.span('compute', job):
+                return job.session.submit(job.modelArgs, lambda line: self.onContainerOutput(job, line),
+                                          lambda: self.isAborted(job))
+        if job.tuneThreads:
+            with self.trace.span('thread tuning', job):
+                self.tuneJobThreads(job)
+            if self.isAborted(job):
+                return None
+        return self.executeDocker(job.cmd, job, job.containerName)
+
+    def tuneJobThreads(self, job):
+        """Run the container of a job at each candidate thread count, store the fastest one
+        and use it for the actual run. Called from a worker thread."""
+        import math
+        import multiprocessing
+        maxThreads = int(math.ceil(job.cpus())) if 'cpus' in job.resources else multiprocessing.cpu_count()
+        candidates = ThreadTuner.candidates(maxThreads)
+        seconds = dict()
+        try:
+            for threads in candidates:
+                containerName = '{}-threads{}'.format(job.containerName, threads)
+                cmd = self.createJobCommand(job, containerName, dict(job.resources, threads=threads))
+                start = time()
+                # the trial runs are traced apart from the stages of the job
+                returnCode = self.executeDocker(cmd, job, containerName, 'tuning')
+                if returnCode != 0 or self.isAborted(job):
+                    print("Thread tuning of {} stopped".format(job.name))
+                    return
+                seconds[threads] = time() - start
+                print("{} took {:.1f} s with {} threads".format(job.name, seconds[threads], threads))
+        finally:
+            # the progress starts over for the actual run
+            job.progress = 0
+            job.stages = []
+            job.eta = None
+            if len(seconds) < len(candidates):
+                self.threadTuner.release(job)
+        job.resources['threads'] = self.threadTuner.store(job, seconds)
+        job.cmd = self.createJobCommand(job)
+
+    def executeTiles(self, job):
+        """Run the tiles of a job, tileWorkers at a time. Each tile is blended into the
+        outputs on the main thread as soon as it is done. Called from a worker thread."""
+        from multiprocessing.pool import ThreadPool
+        lock = threading.Lock()
+        done = [0]
+
+        def runTile(tile):
+            if self.isAborted(job) or not self.requestTileExport(job, tile):
+                return None
+            if job.session:
+                with self.trace.span('compute', job):
+                    returnCode = job.session.submit(tile['modelArgs'], lambda line: self.onContainerOutput(job, line),
+                                                    lambda: self.isAborted(job))
+            else:
+                returnCode = self.executeDocker(tile['cmd'], job, tile['container'])
+            if returnCode == 0 and not self.isAborted(job):
+                self.main_queue_post(lambda: self.importTile(job, tile))
+            with lock:
+                done[0] += 1
+                job.progress = done[0] / float(len(job.tiles))
+            self.cmdProgressEvent(self.overallProgress())
+            return returnCode
+
+        pool = ThreadPool(job.tileWorkers)
+        try:
+            returnCodes = pool.map(runTile, job.tiles, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [returnCode for returnCode in returnCodes if returnCode]
+        return failed[0] if failed else 0
+
+    def importTile(self, job, tile):
+        """Blend the outputs of a tile into the output nodes. Called on the main thread."""
+        if self.isAborted(job) or job.tileError:
+            return
+        try:
+            with self.trace.span('import', job):
+                self.blendTile(job, tile)
+        except Exception as e:
+            print("Exception while blending tile {} of {}: {}".format(tile['index'], job.name, e))
+            job.tileError = e
+            job.abort = True
+        shutil.rmtree(tile['dir'], ignore_errors=True)
+
+    def blendTile(self, job, tile):
+        for item, fileName in self.createOutputDict(job.iodict, job.exchangeFormat).items():
+            tileArray = self.volumeExchange.readArray(os.path.join(tile['dir'], fileName))
+            array = job.tileOutputs.get(item)
+            if array is None:
+                array = self.allocateTiledOutput(job, job.outputs[item], tileArray)
+                job.tileOutputs[item] = array
+            job.tileGrid.blend(array, tileArray, tile['index'])
+
+    def discardTiledOutputs(self, job):
+        """Remove the partly blended outputs of a tiled job that did not complete"""
+        for item in job.tileOutputs:
+            job.outputs[item].SetAndObserveImageData(None)
+        job.tileOutputs = dict()
+
+    def allocateTiledOutput(self, job, outputNode, tileArray):
+        """Give the output node the geometry of the inputs and a zero filled buffer of the tile type"""
+        import numpy as np
+        import vtk
+        referenceNode = [job.inputs[item] for item in job.iodict if job.iodict[item]["iotype"] == "input"][0]
+        ijkToRAS = vtk.vtkMatrix4x4()
+        referenceNode.GetIJKToRASMatrix(ijkToRAS)
+        outputNode.SetIJKToRASMatrix(ijkToRAS)
+        if tileArray.ndim != 3:
+            raise ValueError('Tiled models must have scalar volume outputs')
+        array = self.volumeExchange.allocate(outputNode, job.tileGrid.dimensions, tileArray.dtype)
+        array[:] = 0
+        return array
+
+    def isAborted(self, job=None):
+        return self.abort or (job is not None and job.abort)
+
+    def ensureDockerDaemon(self):
+        """Check the docker daemon once per run, from whichever worker gets there first"""
+        with self.daemonLock:
+            if not self.daemonRunning:
+                try:
+                    with self.trace.span('docker check'):
+                        self.daemonRunning = self.checkDockerDaemon()
+                except Exception as e:
+                    print("Exception while checking the docker daemon: {}".format(e))
+                    self.daemonRunning = False
+            return self.daemonRunning
+
+    def setJobStatus(self, job, status):
+        job.status = status
+        if status == 'running':
+            job.startTime = time()
+        elif status in ('completed', 'failed', 'aborted'):
+            job.endTime = time()
+            self.removePipelineDir(job)
+        self.postWidgetEvent('onLogicJobStatus', job)
+
+    def removePipelineDir(self, job):
+        """Remove the intermediate files of a pipeline once all of its stages are done"""
+        if job.pipelineDir and all([other.status in ('completed', 'failed', 'aborted') for other in self.jobs
+                                    if other.pipelineDir == job.pipelineDir]):
+            if job.pipelineDir in self.pipelineLocks:
+                self.pipelineLocks.pop(job.pipelineDir).close()
+            shutil.rmtree(job.pipelineDir, ignore_errors=True)
+
+    def overallProgress(self):
+        if not self.jobs:
+            return 0
+        finished = len([job for job in self.jobs if job.status in ('importing', 'completed', 'failed', 'aborted')])
+        running = sum([min(job.progress, 1.0) for job in list(self.runningJobs)])
+        return (finished + running) / float(len(self.jobs))
+
+    def canStartJob(self, job):
+        """Admission control: at most maxConcurrentJobs at once, and together the running
+        jobs may not ask for more CPU cores than the host has or more memory than the budget.
+        A job is always allowed to start when nothing else is running."""
+        import multiprocessing
+        if not self.runningJobs:
+            return True
+        if len(self.runningJobs) >= self.maxConcurrentJobs:
+            return False
+        jobs = self.runningJobs + [job]
+        if sum([j.cpus() for j in jobs]) > multiprocessing.cpu_count():
+            return False
+        if self.memoryBudget and sum([j.memory() for j in jobs]) > self.memoryBudget:
+            return False
+        return True
+
+    def schedule(self):
+        """Start ready jobs while there are free slots and keep one job exported ahead.
+        Called on the main thread."""
+        if not self.abort and not self.failure:
+            self.skipBlockedJobs()
+            self.startReadyJobs()
+            if not self.readyJobs and self.pendingJobs and self.exportNextJob():
+                self.startReadyJobs()
+                # export one job per pass so the main thread stays responsive
+                self.main_queue_post(self.schedule)
+                return
+        self.finishIfDone()
+
+    def startReadyJobs(self):
+        while self.readyJobs and self.canStartJob(self.readyJobs[0]):
+            self.startJob(self.readyJobs.popleft())
+
+    def exportNextJob(self):
+        """Export the next pending job whose dependencies have completed. Returns False if
+        all pending jobs wait for others. Called on the main thread."""
+        job = self.pendingJobs.pop(lambda job: all([other.status == 'completed' for other in job.dependencies]))
+        if job is None:
+            return False
+        self.setJobStatus(job, 'exporting')
+        try:
+            self.prepareJob(job)
+        except Exception as e:
+            print("Exception while exporting {}: {}".format(job.name, e))
+            self.setJobStatus(job, 'failed')
+            self.cleanupJob(job)
+            return True
+        if job.cached:
+            # no container needed, the cached outputs are imported right away
+            self.importJob(job)
+            return True
+        self.setJobStatus(job, 'ready')
+        job.readyTime = time()
+        self.readyJobs.append(job)
+        return True
+
+    def skipBlockedJobs(self):
+        """Drop the pending jobs that depend on a job that failed or was aborted"""
+        while True:
+            job = self.pendingJobs.pop(lambda job: any([other.status in ('failed', 'aborted')
+                                                        for other in job.dependencies]))
+            if job is None:
+                return
+            aborted = any([other.status == 'aborted' for other in job.dependencies])
+            print("{} skipped, a job it depends on did not complete".format(job.name))
+            self.setJobStatus(job, 'aborted' if aborted else 'failed')
+
+    def startJob(self, job):
+        self.trace.add('queued', job.readyTime, time(), job)
+        if job.cmd and self.threadTuner and not job.tuneThreads and 'threads' not in self.resourceOverrides:
+            # the model may have been tuned while the job was waiting
+            tuned = self.threadTuner.lookup(job)
+            if tuned and tuned != job.resources.get('threads'):
+                job.resources['threads'] = tuned
+                job.cmd = self.createJobCommand(job)
+        self.runningJobs.append(job)
+        self.setJobStatus(job, 'running')
+        thread = threading.Thread(target=self.thread_doit, args=(job,))
+        thread.daemon = True
+        self.workers[job.id] = thread
+        thread.start()
+
+    def cancelJob(self, job):
+        """Cancel a single job, whether it is waiting or running. Called on the main thread."""
+        if job in self.readyJobs:
+            self.readyJobs.remove(job)
+            self.setJobStatus(job, 'aborted')
+            self.cleanupJob(job)
+        elif self.pendingJobs.remove(job):
+            self.setJobStatus(job, 'aborted')
+        elif job in self.runningJobs:
+            # the worker kills the container and reports back through onJobFinished,
+            # the slot of the job is given to the next one right away
+            job.abort = True
+            self.runningJobs.remove(job)
+            self.stoppingJobs.append(job)
+            self.setJobStatus(job, 'aborted')
+        self.schedule()
+
+    def finishIfDone(self):
+        if self.runningJobs or self.stoppingJobs or self.stopping:
+            return
+        if self.abort:
+            for job in list(self.readyJobs) + self.pendingJobs.clear():
+                self.setJobStatus(job, 'aborted')
+                self.cleanupJob(job)
+            self.readyJobs.clear()
+            self.cmdAbortEvent()
+        elif self.failure:
+            for job in list(self.readyJobs) + self.pendingJobs.clear():
+                print("{} not run: {}".format(job.name, self.failure))
+                self.setJobStatus(job, 'failed')
+                self.cleanupJob(job)
+            self.readyJobs.clear()
+            self.cmdFailEvent(self.failure)
+        elif self.readyJobs or self.pendingJobs:
+            return
+        else:
             self.cmdEndEvent()
+        self.stopping = True
+        self.main_queue_post(self.main_queue_stop)
 
-        '''
+    def importJob(self, job):
+        self.setJobStatus(job, 'importing')
+        try:
+            if job.tiles:
+                self.updateTiledOutput(job)
+            # stored before the outputs of headless runs are moved out of the job directory
+            if job.cacheKey and not job.cached:
+                with self.trace.span('cache store', job):
+                    self.resultCache.store(job.cacheKey, job.workDir,
+                                           self.createOutputDict(job.iodict, job.exchangeFormat).values())
+            if not job.tiles:
+                self.updateOutput(job.iodict, job.outputs, job.workDir, job)
+            self.setJobStatus(job, 'completed')
         except Exception as e:
-            msg = e.message
-            qt.QMessageBox.critical(slicer.util.mainWindow(), "Exception during execution of ", msg)
-            slicer.modules.DeepInferWidget.applyButton.enabled = True
-            slicer.modules.DeepInferWidget.progress.hide = True
-            self.abort = True
-            self.yieldPythonGIL()
-        '''
+            print("Exception while importing {}: {}".format(job.name, e))
+            self.setJobStatus(job, 'failed')
+        self.cleanupJob(job)
+
+    def cleanupJob(self, job):
+        if job.workDirLock:
+            job.workDirLock.close()
+            job.workDirLock = None
+        if job.workDir:
+            shutil.rmtree(job.workDir, ignore_errors=True)
+        self.scratch.release(job)
+        if job.tuneThreads and self.threadTuner:
+            # the job may have been cancelled before it was tuned
+            self.threadTuner.release(job)
+
+    def onJobFinished(self, job, returnCode, failure=None):
+        """Import or discard the results of a job that has finished. A failure that affects
+        all jobs, such as a stopped docker daemon, stops the run. Called on the main thread."""
+        if failure and not self.failure:
+            print("Stopping the run: {}".format(failure))
+            self.failure = failure
+        if job in self.stoppingJobs:
+            self.stoppingJobs.remove(job)
+        else:
+            self.runningJobs.remove(job)
+        self.workers.pop(job.id, None)
+        if job.stages:
+            print("{} stage times: {}".format(job.name, ', '.join(
+                '{} {:.1f} s'.format(name, seconds) for name, seconds in job.stageTimes())))
+            self.trace.addModelStages(job)
+        if job.tileError:
+            self.setJobStatus(job, 'failed')
+            self.discardTiledOutputs(job)
+            self.cleanupJob(job)
+        elif self.isAborted(job):
+            self.setJobStatus(job, 'aborted')
+            self.discardTiledOutputs(job)
+            self.cleanupJob(job)
+        elif returnCode:
+            print("{} exited with code {}".format(job.name, returnCode))
+            # the daemon may have stopped or the image may be gone
+            DockerState.get(self.dockerPath).invalidate()
+            self.setJobStatus(job, 'failed')
+            self.cleanupJob(job)
+        else:
+            # the scene may only be modified from the main thread
+            self.importJob(job)
+        self.schedule()
+
+    def thread_doit(self, job):
+        returnCode = None
+        failure = None
+        if not self.ensureDockerDaemon():
+            failure = "the docker daemon is not running"
+            returnCode = -1
+        else:
+            try:
+                returnCode = self.executeJob(job)
+            except Exception as e:
+                print("Exception during execution of {}: {}".format(job.name, e))
+                returnCode = -1
+        self.main_queue_post(lambda: self.onJobFinished(job, returnCode, failure))
+
     def main_queue_start(self):
         """Begins monitoring of main_queue for callables"""
         self.main_queue_running = True
-        slicer.modules.DeepInferWidget.onLogicRunStart()
+        if self.headless:
+            # the callables are run by wait
+            return
+        if hasattr(slicer.modules, 'DeepInferWidget'):
+            slicer.modules.DeepInferWidget.onLogicRunStart()
+        if self.main_queue_notifier is None:
+            self.main_queue_connect()
         qt.QTimer.singleShot(0, self.main_queue_process)
 
+    def main_queue_connect(self):
+        """The workers wake the main thread by writing to a socket pair watched by a
+        QSocketNotifier, so the main thread only runs when there is work."""
+        import socket
+        self.main_queue_sockets = socket.socketpair()
+        for sock in self.main_queue_sockets:
+            sock.setblocking(False)
+        self.main_queue_notifier = qt.QSocketNotifier(self.main_queue_sockets[0].fileno(), qt.QSocketNotifier.Read)
+        self.main_queue_notifier.connect('activated(int)', lambda fd: self.main_queue_process())
+
+    def main_queue_post(self, f):
+        """Queue a callable to be run on the main thread. Safe to call from any thread."""
+        self.main_queue.put(f)
+        with self.main_queue_lock:
+            if self.main_queue_wakeup_pending or self.main_queue_sockets is None:
+                return
+            self.main_queue_wakeup_pending = True
+        try:
+            self.main_queue_sockets[1].send(b'x')
+        except (IOError, OSError):
+            # the main thread is already being woken up
+            pass
+
     def main_queue_stop(self):
         """End monitoring of main_queue for callables"""
         self.main_queue_running = False
-        if self.thread.is_alive():
-            self.thread.join()
-        slicer.modules.DeepInferWidget.onLogicRunStop()
+        for thread in list(self.workers.values()):
+            if thread is not threading.current_thread():
+                thread.join()
+        if not self.headless and hasattr(slicer.modules, 'DeepInferWidget'):
+            slicer.modules.DeepInferWidget.onLogicRunStop()
+
+    def wait(self):
+        """Run the queued callables on the calling thread until all jobs are done.
+        Used by headless runs, which have no event loop."""
+        while self.main_queue_running:
+            try:
+                f = self.main_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                if callable(f):
+                    f()
+            except Exception as e:
+                import sys
+                sys.stderr.write("ModelLogic error in main_queue: \"{0}\"".format(e))
 
     def main_queue_process(self):
         """processes the main_queue of callables"""
-        try:
-            while not self.main_queue.empty():
+        if self.main_queue_sockets:
+            try:
+                self.main_queue_sockets[0].recv(4096)
+            except (IOError, OSError):
+                pass
+        # cleared before draining, so a callable queued from now on wakes the main thread again
+        with self.main_queue_lock:
+            self.main_queue_wakeup_pending = False
+        for i in range(self.main_queue_batch_size):
+            try:
                 f = self.main_queue.get_nowait()
+            except queue.Empty:
+                break
+            # a failing callable must not strand the ones queued after it,
+            # their workers may not post again
+            try:
                 if callable(f):
                     f()
+            except Exception as e:
+                import sys
+                sys.stderr.write("ModelLogic error in main_queue: \"{0}\"".format(e))
+        else:
+            # let the application handle its events before the rest of the batch
+            qt.QTimer.singleShot(0, self.main_queue_process)
 
-            if self.main_queue_running:
-                # Yield the GIL to allow other thread to do some python work.
-                # This is needed since pyQt doesn't yield the python GIL
-                self.yieldPythonGIL(.01)
-                qt.QTimer.singleShot(0, self.main_queue_process)
-
-        except Exception as e:
-            import sys
-            sys.stderr.write("ModelLogic error in main_queue: \"{0}\"".format(e))
-
-            # if there was an error try to resume
-            if not self.main_queue.empty() or self.main_queue_running:
-                qt.QTimer.singleShot(0, self.main_queue_process)
-
-    def updateOutput(self, iodict, outputs):
+    def updateOutput(self, iodict, outputs, workDir=TMP_PATH, job=None):
         # print('updateOutput method')
         output_volume_files = dict()
         output_fiduciallist_files = dict()
+        outputDict = self.createOutputDict(iodict, job.exchangeFormat if job else 'nrrd')
         for item in iodict:
             if iodict[item]["iotype"] == "output":
                 if iodict[item]["type"] == "volume":
-                    fileName = str(os.path.join(TMP_PATH, item + '.nrrd'))
+                    fileName = str(os.path.join(workDir, outputDict[item]))
                     output_volume_files[item] = fileName
                 if iodict[item]["type"] == "point_vec":
-                    fileName = str(os.path.join(TMP_PATH, item + '.fcsv'))
+                    fileName = str(os.path.join(workDir, outputDict[item]))
                     output_fiduciallist_files[item] = fileName
+        for item, fileName in list(output_volume_files.items()) + list(output_fiduciallist_files.items()):
+            if isinstance(outputs[item], str):
+                with self.trace.span('import', job):
+                    self.moveOutputFile(fileName, outputs[item])
+                output_volume_files.pop(item, None)
+                output_fiduciallist_files.pop(item, None)
+        # pipeline outputs that are also passed on to later stages, see Pipeline
+        nodeCopies = []
+        for item, targets in (job.outputCopies.items() if job else []):
+            for target in targets:
+                if isinstance(target, str):
+                    with self.trace.span('import', job):
+                        self.moveOutputFile(outputs[item], target, copy=True)
+                else:
+                    nodeCopies.append((item, target))
+        if not output_volume_files and not output_fiduciallist_files and not nodeCopies:
+            # headless runs have no nodes to update
+            return
+        # the nodes are updated in one batch, the views once at the end
+        shownNodes = []
+        scene = slicer.mrmlScene
+        scene.StartState(scene.BatchProcessState)
+        try:
+            self.importOutputNodes(iodict, outputs, output_volume_files, output_fiduciallist_files, nodeCopies,
+                                   shownNodes, job)
+        finally:
+            with self.trace.span('scene update', job):
+                scene.EndState(scene.BatchProcessState)
+        if shownNodes and (job is None or job.updateViews):
+            with self.trace.span('scene update', job):
+                self.showOutputVolumes(shownNodes)
+
+    def importOutputNodes(self, iodict, outputs, output_volume_files, output_fiduciallist_files, nodeCopies,
+                          shownNodes, job=None):
+        """Read the outputs of a job into their nodes, the volume nodes to show are added to shownNodes"""
+        for item, target in nodeCopies:
+            if iodict[item]["type"] == "volume":
+                with self.trace.span('import', job):
+                    self.volumeExchange.read(outputs[item], target)
+                shownNodes.append(target)
+            else:
+                with self.trace.span('import', job):
+                    _, node = slicer.util.loadMarkupsFiducialList(outputs[item], True)
+                with self.trace.span('scene update', job):
+                    target.Copy(node)
         for output_volume in output_volume_files.keys():
-            result = sitk.ReadImage(output_volume_files[output_volume])
             output_node = outputs[output_volume]
-            output_node_name = output_node.GetName()
-            nodeWriteAddress = sitkUtils.GetSlicerITKReadWriteAddress(output_node_name)
-            sitk.WriteImage(result, nodeWriteAddress)
-            applicationLogic = slicer.app.applicationLogic()
-            selectionNode = applicationLogic.GetSelectionNode()
-
-            outputLabelMap = True
-            if outputLabelMap:
-                selectionNode.SetReferenceActiveLabelVolumeID(output_node.GetID())
-            else:
-                selectionNode.SetReferenceActiveVolumeID(output_node.GetID())
-
-            applicationLogic.PropagateVolumeSelection(0)
-            applicationLogic.FitSliceToAll()
+            # outputs without geometry get that of the first input volume
+            referenceNode = None
+            if job:
+                referenceNode = ([job.inputs[item] for item in iodict if iodict[item]["iotype"] == "input" and
+                                  iodict[item]["type"] == "volume" and not isinstance(job.inputs[item], str)]
+                                 or [None])[0]
+            with self.trace.span('import', job):
+                if job and job.volumePreprocessing:
+                    self.pasteOutput(job.volumePreprocessing, output_volume_files[output_volume], output_node,
+                                     referenceNode, iodict[output_volume].get("voltype") == 'LabelMap')
+                else:
+                    self.volumeExchange.read(output_volume_files[output_volume], output_node, referenceNode)
+            shownNodes.append(output_node)
         for fiduciallist in output_fiduciallist_files.keys():
             # information about loading markups: https://www.slicer.org/wiki/Documentation/Nightly/Modules/Markups
             output_node = outputs[fiduciallist]
-            _, node = slicer.util.loadMarkupsFiducialList(output_fiduciallist_files[fiduciallist], True)
-            output_node.Copy(node)
+            with self.trace.span('import', job):
+                _, node = slicer.util.loadMarkupsFiducialList(output_fiduciallist_files[fiduciallist], True)
+            with self.trace.span('scene update', job):
+                output_node.Copy(node)
             scene = slicer.mrmlScene
             # todo: currently due to a bug in markups module removing the node will create some unexpected behaviors
             # reported bug reference: https://issues.slicer.org/view.php?id=4414
             # scene.RemoveNode(node)
 
 
+    def pasteOutput(self, preprocessing, fileName, outputNode, referenceNode, label=False):
+        """Read an output on the preprocessed grid into the full geometry of the reference input"""
+        array = self.volumeExchange.readArray(fileName)
+        outputNode.SetIJKToRASMatrix(self.volumeExchange.regionIJKToRAS(referenceNode))
+        target = self.volumeExchange.allocate(outputNode, preprocessing.dimensions, array.dtype)
+        preprocessing.invert(array, target, label)
+        slicer.util.arrayFromVolumeModified(outputNode)
+
+    def moveOutputFile(self, fileName, path, copy=False):
+        """Move, or copy, an output of a headless run to its destination, converting volumes to the format of its extension"""
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        if self.fileExtension(path) == self.fileExtension(fileName):
+            if copy:
+                shutil.copy(fileName, path)
+            else:
+                shutil.move(fileName, path)
+        else:
+            import SimpleITK as sitk
+            sitk.WriteImage(sitk.ReadImage(str(fileName)), str(path), True)
+
+    def showOutputVolumes(self, outputNodes):
+        """Show the output volumes in the slice views, label maps as the label layer. The views
+        are updated once for all of them."""
+        applicationLogic = slicer.app.applicationLogic()
+        selectionNode = applicationLogic.GetSelectionNode()
+        for output_node in outputNodes:
+            if output_node.IsA('vtkMRMLLabelMapVolumeNode'):
+                selectionNode.SetReferenceActiveLabelVolumeID(output_node.GetID())
+            else:
+                selectionNode.SetReferenceActiveVolumeID(output_node.GetID())
+
+        applicationLogic.PropagateVolumeSelection(0)
+        applicationLogic.FitSliceToAll()
+
+    def updateTiledOutput(self, job):
+        """The tiles are already blended into the output nodes, show them and write them for the result cache"""
+        outputDict = self.createOutputDict(job.iodict, job.exchangeFormat)
+        missing = [item for item in outputDict if item not in job.tileOutputs]
+        if missing:
+            raise ValueError('No tile of {} was imported'.format(missing[0]))
+        scene = slicer.mrmlScene
+        with self.trace.span('scene update', job):
+            scene.StartState(scene.BatchProcessState)
+            try:
+                for item in outputDict:
+                    slicer.util.arrayFromVolumeModified(job.outputs[item])
+            finally:
+                scene.EndState(scene.BatchProcessState)
+            if job.updateViews:
+                self.showOutputVolumes([job.outputs[item] for item in outputDict])
+        for item in outputDict:
+            output_node = job.outputs[item]
+            if job.cacheKey:
+                with self.trace.span('cache store', job):
+                    self.volumeExchange.write(output_node, os.path.join(job.workDir, outputDict[item]), None,
+                                              job.exchangeFormat)
+
     def run(self, modelParamters):
         """
-        Run the actual algorithm
+        Run the actual algorithm. The inputs are exported on the main thread and
+        the container is run on a worker thread, so this returns immediately.
         """
-        if self.thread.is_alive():
-            import sys
-            sys.stderr.write("ModelLogic is already executing!")
+        self.runBatch([DeepInferJob.fromModelParameters(modelParamters)])
+
+    def runPipeline(self, pipeline, inputs, outputs, params=None, name=None):
+        """Run the stages of a Pipeline, see Pipeline.createJobs. The intermediate files
+        are written to a directory of the scratch root. Returns the jobs."""
+        import uuid
+        workDir = os.path.join(self.scratch.root, 'pipeline-' + uuid.uuid4().hex)
+        jobs = pipeline.createJobs(inputs, outputs, workDir, params, name)
+        self.runBatch(jobs)
+        return jobs
+
+    def runBatch(self, jobs):
+        """
+        Schedule a list of DeepInferJobs. Up to maxConcurrentJobs containers run at
+        once, the next job is exported while others run and finished jobs are
+        imported as soon as they are done. Jobs submitted while a run is in progress
+        are queued as a new group and served round-robin with the earlier groups.
+        """
+        if self.main_queue_running:
+            if self.stopping:
+                import sys
+                sys.stderr.write("ModelLogic is already executing!")
+                return
+            self.jobs.extend(jobs)
+            self.pendingJobs.add(jobs)
+            self.schedule()
             return
         self.abort = False
-        self.thread = threading.Thread(target=self.thread_doit(modelParameters=modelParamters))
+        self.failure = None
+        self.stopping = False
+        self.daemonRunning = None
+        self.jobs = list(jobs)
+        self.pendingJobs = FairJobQueue()
+        self.pendingJobs.add(jobs)
+        self.readyJobs = deque()
+        self.runningJobs = []
+        self.stoppingJobs = []
+        self.batchStartTime = time()
+        self.trace = RunTrace()
+        self.main_queue_start()
+        self.cmdStartEvent()
+        self.schedule()
+
+    def isRunning(self):
+        return self.main_queue_running
+
+    def throughput(self):
+        """Completed jobs per minute of the current batch"""
+        completed = len([job for job in self.jobs if job.status == 'completed'])
+        elapsed = time() - self.batchStartTime
+        if not completed or elapsed <= 0:
+            return 0.0
+        return completed * 60.0 / elapsed
+
+    # job directories, those of pipelines and those of warm sessions in .jobs
+    JOB_DIR_NAME = re.compile(r'^((pipeline-)?[0-9a-f]{32}|deepinfer-warm-[0-9a-f]{12})$')
+
+    @staticmethod
+    def removeStaleJobDirs(roots=None, maxAge=24 * 60 * 60):
+        """Remove the job directories that earlier sessions left behind in the scratch roots,
+        by default those of the default location. Only directories named like a job, that no
+        running session has locked and in which nothing changed for maxAge seconds are removed."""
+        now = time()
+        for root in roots or ScratchSpace().roots():
+            for parent in (root, os.path.join(root, '.jobs')):
+                if not os.path.isdir(parent):
+                    continue
+                for name in os.listdir(parent):
+                    path = os.path.join(parent, name)
+                    if not DeepInferLogic.JOB_DIR_NAME.match(name) or not os.path.isdir(path):
+                        continue
+                    try:
+                        if not ScratchSpace.isLocked(path) and now - ScratchSpace.lastModified(path) > maxAge:
+                            shutil.rmtree(path, ignore_errors=True)
+                    except (IOError, OSError):
+                        pass
+
+    @staticmethod
+    def physicalMemory():
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            return 0
+
+
+#
+# A single model run
+#
+
+class DeepInferJob(object):
+    """ One run of a model on one set of input and output nodes.
+    The model description is copied so that the parameter widgets can change while
+    a batch is running.
+    """
+
+    def __init__(self, iodict, inputs, outputs, params, dockerImageName, modelName=None, dataPath=None,
+                 warmSession=False, name=None, resources=None, digest='', tiling=None, exchangeFormats=None,
+                 preprocessing=None):
+        import uuid
+        self.id = uuid.uuid4().hex
+        self.iodict = iodict
+        self.inputs = dict(inputs)
+        self.outputs = dict(outputs)
+        self.params = dict(params)
+        self.dockerImageName = dockerImageName
+        self.modelName = modelName
+        self.dataPath = dataPath
+        self.warmSession = warmSession
+        self.resources = dict(resources or {})
+        self.digest = digest
+        self.tiling = dict(tiling or {})
+        # the formats the model reads and writes and the one chosen for this job, see VolumeExchange
+        self.exchangeFormats = list(exchangeFormats or ['nrrd'])
+        self.exchangeFormat = 'nrrd'
+        # the crop and spacing the model declares and the VolumePreprocessing of this job
+        self.preprocessing = dict(preprocessing or {})
+        self.volumePreprocessing = None
+        self.name = name or self.id
+        self.status = 'queued'
+        self.progress = 0
+        self.abort = False
+        self.memoryEstimate = 0
+        self.cacheKey = None
+        self.cached = False
+        self.scratchRoot = None
+        self.workDir = None
+        # open while the job directory is in use, see ScratchSpace.lock
+        self.workDirLock = None
+        self.modelArgs = []
+        self.cmd = []
+        self.containerName = None
+        self.session = None
+        self.startTime = None
+        self.endTime = None
+        self.stages = []
+        self.eta = None
+        self.reportsProgress = False
+        self.tileGrid = None
+        # the tile index, directory, input files and container command of each tile
+        self.tiles = []
+        self.tileOutputs = dict()
+        self.tileError = None
+        self.tileWorkers = 1
+        self.timings = dict()
+        self.readyTime = None
+        self.tuneThreads = False
+        # show the outputs in the slice views when they are imported
+        self.updateViews = True
+        # set for the stages of a Pipeline
+        self.dependencies = []
+        self.outputCopies = dict()
+        self.pipelineDir = None
+
+    @classmethod
+    def fromModelParameters(cls, modelParameters, inputs=None, outputs=None, name=None):
+        inputs = inputs if inputs is not None else modelParameters.inputs
+        outputs = outputs if outputs is not None else modelParameters.outputs
+        if name is None:
+            names = [node.GetName() for node in inputs.values() if node]
+            name = ', '.join(names)
+        return cls(modelParameters.iodict, inputs, outputs, modelParameters.params,
+                   modelParameters.dockerImageName, modelParameters.modelName, modelParameters.dataPath,
+                   modelParameters.warmSession, name, modelParameters.resources, modelParameters.digest,
+                   modelParameters.tiling, modelParameters.exchangeFormats, modelParameters.preprocessing)
+
+    @classmethod
+    def fromModelDescription(cls, json_dict, inputs, outputs, params=None, name=None):
+        """A job for a model description without widgets. The parameters default to the
+        defaults of the description."""
+        modelParameters = ModelParameters()
+        modelParameters.load(json_dict)
+        modelParameters.params = dict([(member["name"], member["default"]) for member in json_dict["members"]
+                                       if member.get("iotype") == "parameter" and "default" in member])
+        modelParameters.params.update(params or {})
+        # defaults and values given as text, e.g. on the command line, get the types the widgets store
+        for item in list(modelParameters.params):
+            if item in modelParameters.iodict:
+                modelParameters.params[item] = ModelParameters.parseParameter(modelParameters.iodict[item]["type"],
+                                                                              modelParameters.params[item])
+        missing = [item for item in modelParameters.iodict
+                   if modelParameters.iodict[item]["iotype"] == "parameter" and item not in modelParameters.params]
+        missing += [item for item in modelParameters.iodict
+                    if modelParameters.iodict[item]["iotype"] in ("input", "output")
+                    and item not in (inputs if modelParameters.iodict[item]["iotype"] == "input" else outputs)]
+        if missing:
+            raise ValueError('No value given for {}'.format(', '.join(sorted(missing))))
+        return cls.fromModelParameters(modelParameters, inputs, outputs, name)
+
+    def duration(self):
+        if self.startTime is None:
+            return None
+        return (self.endTime or time()) - self.startTime
+
+    def updateProgress(self, line, now=None):
+        """ Update the progress from a line of container output. Returns True if the line
+        was a progress record. Containers report their progress with lines such as
+
+            DEEPINFER_PROGRESS {"stage": "inference", "fraction": 0.4, "eta": 12}
+
+        where fraction is the part of the whole run that is done and eta the remaining
+        seconds. All fields are optional. The progress of containers that do not report
+        it approaches, but never reaches, 1 with every line of output.
+        """
+        now = now or time()
+        if not line.startswith(PROGRESS_TAG):
+            if not self.reportsProgress:
+                self.progress += (0.95 - self.progress) * 0.1
+            return False
+        try:
+            record = json.loads(line[len(PROGRESS_TAG):])
+        except ValueError:
+            print("Invalid progress record: {}".format(line.rstrip()))
+            return True
+        self.reportsProgress = True
+        stage = record.get('stage')
+        if stage and (not self.stages or self.stages[-1]['name'] != stage):
+            if self.stages:
+                self.stages[-1]['end'] = now
+            self.stages.append({'name': stage, 'start': now, 'end': None})
+        if 'fraction' in record:
+            self.progress = min(max(float(record['fraction']), 0.0), 1.0)
+        if record.get('eta') is not None:
+            self.eta = float(record['eta'])
+        elif self.progress > 0 and self.startTime:
+            # extrapolate from the time spent so far
+            self.eta = (now - self.startTime) * (1 - self.progress) / self.progress
+        return True
+
+    def stage(self):
+        return self.stages[-1]['name'] if self.stages else None
+
+    def stageTimes(self):
+        """Seconds spent in each stage, in order"""
+        end = self.endTime or time()
+        return [(stage['name'], (stage['end'] or end) - stage['start']) for stage in self.stages]
+
+    def cpus(self):
+        return float(self.resources.get('cpus', 1))
+
+    def memory(self):
+        """Memory the job needs in bytes, as declared by the model or estimated from its inputs"""
+        if 'memory' in self.resources:
+            return self.parseMemory(self.resources['memory'])
+        return self.memoryEstimate
+
+    @staticmethod
+    def parseMemory(value):
+        """Parse a docker style memory size such as 512m or 4g"""
+        value = str(value).strip().lower().rstrip('b')
+        units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(float(value))
+
+
+class FairJobQueue(object):
+    """ Round-robin queue over groups of jobs, so that a long batch cannot starve
+    jobs that are submitted after it.
+    """
+
+    def __init__(self):
+        self.groups = deque()
+
+    def __len__(self):
+        return sum([len(group) for group in self.groups])
+
+    def add(self, jobs):
+        if jobs:
+            self.groups.append(deque(jobs))
+
+    def pop(self, accept=None):
+        """Remove and return the next job, or the next one accept returns True for. Returns None
+        if there is no such job."""
+        for group in list(self.groups):
+            for job in group:
+                if accept is None or accept(job):
+                    self.groups.remove(group)
+                    group.remove(job)
+                    if group:
+                        self.groups.append(group)
+                    return job
+        return None
+
+    def remove(self, job):
+        for group in self.groups:
+            if job in group:
+                group.remove(job)
+                return True
+        return False
+
+    def clear(self):
+        """Remove and return all jobs"""
+        jobs = [job for group in self.groups for job in group]
+        self.groups.clear()
+        return jobs
+
+
+#
+# Pipelines
+#
+
+class Pipeline(object):
+    """ Models run back to back, the outputs of one stage feeding the inputs of the next.
+    A pipeline is described in json, for example
+
+        {"name": "Prostate lesions",
+         "stages": [{"name": "gland", "model": "prostate-segmenter.json"},
+                    {"name": "lesions", "model": "lesion-detector.json",
+                     "inputs": {"GlandMask": "gland.OutputLabel"},
+                     "params": {"Threshold": 0.7}}],
+         "outputs": {"Gland": "gland.OutputLabel", "Lesions": "lesions.OutputLabel"}}
+
+    A stage input is wired to an output of another stage, as stage.member, or to an input
+    of the pipeline. Inputs that are not wired are pipeline inputs of the same name. The
+    model is a description, or a file relative to the pipeline or in the downloaded models.
+    The intermediate files never enter the scene, only the pipeline outputs are imported,
+    and stages that do not depend on each other run concurrently.
+    """
+
+    def __init__(self, description, modelDir=None):
+        self.name = description.get("name", "Pipeline")
+        self.stages = OrderedDict()
+        for stage in description.get("stages", []):
+            name = stage["name"]
+            if '.' in name or name in self.stages:
+                raise ValueError('Invalid or duplicate stage name {}'.format(name))
+            model = stage["model"]
+            if not isinstance(model, dict):
+                model = self.loadModel(model, modelDir)
+            self.stages[name] = {'model': model,
+                                 'inputs': dict(stage.get("inputs", {})),
+                                 'params': dict(stage.get("params", {}))}
+        if not self.stages:
+            raise ValueError('{} has no stages'.format(self.name))
+        self.outputs = OrderedDict(description.get("outputs", {}))
+        self.order = self.sortStages()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f, object_pairs_hook=OrderedDict), os.path.dirname(os.path.abspath(path)))
+
+    @staticmethod
+    def isPipeline(json_dict):
+        return "stages" in json_dict
+
+    @staticmethod
+    def loadModel(model, modelDir=None):
+        fileName = model if model.endswith('.json') else model + '.json'
+        for directory in (modelDir, JSON_LOCAL_DIR):
+            path = os.path.join(directory or '', fileName)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    return json.load(f, object_pairs_hook=OrderedDict)
+        raise ValueError('Model {} not found'.format(model))
+
+    def members(self, stageName, iotype):
+        return [member["name"] for member in self.stages[stageName]['model']["members"]
+                if member.get("iotype") == iotype]
+
+    def source(self, stageName, member):
+        """The stage and output that feed an input of a stage, or None and the pipeline input"""
+        stage, separator, output = self.stages[stageName]['inputs'].get(member, member).partition('.')
+        if not separator:
+            return None, stage
+        return stage, output
+
+    def checkOutput(self, stageName, member):
+        if stageName not in self.stages or member not in self.members(stageName, 'output'):
+            raise ValueError('{}.{} is not a stage output of {}'.format(stageName, member, self.name))
+
+    def sortStages(self):
+        """The stage names ordered so that every stage comes after those it reads from"""
+        dependencies = dict()
+        for name, stage in self.stages.items():
+            unknown = [member for member in stage['inputs'] if member not in self.members(name, 'input')]
+            if unknown:
+                raise ValueError('Stage {} has no input {}'.format(name, ', '.join(unknown)))
+            dependencies[name] = set()
+            for member in self.members(name, 'input'):
+                producer, output = self.source(name, member)
+                if producer is not None:
+                    self.checkOutput(producer, output)
+                    dependencies[name].add(producer)
+        for reference in self.outputs.values():
+            stageName, _, member = reference.partition('.')
+            self.checkOutput(stageName, member)
+        order = []
+        while len(order) < len(self.stages):
+            ready = [name for name in self.stages if name not in order and dependencies[name].issubset(order)]
+            if not ready:
+                raise ValueError('The stages of {} depend on each other'.format(self.name))
+            order.extend(ready)
+        return order
+
+    def inputNames(self):
+        names = [self.source(name, member)[1] for name in self.order for member in self.members(name, 'input')
+                 if self.source(name, member)[0] is None]
+        return sorted(set(names))
+
+    def outputExtension(self, stageName, member):
+        types = dict([(item["name"], item.get("type")) for item in self.stages[stageName]['model']["members"]])
+        return '.fcsv' if types[member] == "point_vec" else '.nrrd'
+
+    def createJobs(self, inputs, outputs, workDir, params=None, name=None):
+        """ One job per stage, each depending on the jobs of the stages it reads from.
+        inputs maps the pipeline inputs to nodes or files and outputs the pipeline outputs
+        to keep to nodes or files, those left out are discarded. params overrides stage
+        parameters given as stage.parameter. The intermediate files are written to workDir,
+        which the logic removes once all stages are done.
+        """
+        missing = [item for item in self.inputNames() if item not in inputs]
+        if missing:
+            raise ValueError('No value given for {}'.format(', '.join(missing)))
+        consumed = set([self.source(stageName, member) for stageName in self.order
+                        for member in self.members(stageName, 'input')])
+        jobs = OrderedDict()
+        for stageName in self.order:
+            stageInputs = dict()
+            dependencies = []
+            for member in self.members(stageName, 'input'):
+                producer, output = self.source(stageName, member)
+                if producer is None:
+                    stageInputs[member] = inputs[output]
+                    continue
+                stageInputs[member] = os.path.join(workDir, producer, output + self.outputExtension(producer, output))
+                if jobs[producer] not in dependencies:
+                    dependencies.append(jobs[producer])
+            stageOutputs = dict()
+            outputCopies = dict()
+            for member in self.members(stageName, 'output'):
+                targets = [outputs[item] for item, reference in self.outputs.items()
+                           if reference == stageName + '.' + member and item in outputs]
+                if (stageName, member) in consumed or not targets:
+                    # passed on to later stages, or not needed at all
+                    stageOutputs[member] = os.path.join(workDir, stageName,
+                                                        member + self.outputExtension(stageName, member))
+                else:
+                    stageOutputs[member] = targets.pop(0)
+                if targets:
+                    outputCopies[member] = targets
+            stageParams = dict(self.stages[stageName]['params'])
+            stageParams.update([(key.partition('.')[2], value) for key, value in (params or {}).items()
+                                if key.partition('.')[0] == stageName])
+            job = DeepInferJob.fromModelDescription(self.stages[stageName]['model'], stageInputs, stageOutputs,
+                                                    stageParams, '{}: {}'.format(name or self.name, stageName))
+            job.dependencies = dependencies
+            job.outputCopies = outputCopies
+            job.pipelineDir = workDir
+            jobs[stageName] = job
+        return list(jobs.values())
+
+
+#
+# Class to exchange volumes with containers
+#
+
+class VolumeExchange(object):
+    """ Writes volume nodes to NRRD files directly from the voxel buffer of their
+    vtkImageData and reads container results straight into the output node buffer,
+    without going through an intermediate ITK image.
+
+    Models can declare other exchange formats in their description, for example
+    "exchange_formats": ["npy", "nrrd-gzip", "nrrd"], see FORMATS and chooseFormat.
+    .npy files have their geometry in a <name>.npy.json file next to them.
+    """
+
+    # exchange format -> file extension, fastest first on a local disk
+    FORMATS = OrderedDict([('npy', '.npy'),
+                           ('nrrd', '.nrrd'),
+                           ('nrrd-zstd', '.nrrd'),
+                           ('nrrd-gzip', '.nrrd'),
+                           ('nii', '.nii'),
+                           ('nii.gz', '.nii.gz')])
+    # preferred when the exchange directory is on a slow or network disk
+    COMPRESSED_FORMATS = ('nrrd-zstd', 'nrrd-gzip', 'nii.gz')
+    NRRD_ENCODINGS = {'nrrd': 'raw', 'nrrd-gzip': 'gzip', 'nrrd-zstd': 'zstd'}
+    CHUNK_SIZE = 4 * 1024 ** 2
+
+    # numpy dtype name -> NRRD type
+    NRRD_TYPES = {'int8': 'signed char',
+                  'uint8': 'unsigned char',
+                  'int16': 'short',
+                  'uint16': 'unsigned short',
+                  'int32': 'int',
+                  'uint32': 'unsigned int',
+                  'int64': 'long long',
+                  'uint64': 'unsigned long long',
+                  'float32': 'float',
+                  'float64': 'double'}
+
+    NRRD_TYPE_ALIASES = {'char': 'signed char', 'int8': 'signed char', 'int8_t': 'signed char',
+                         'uchar': 'unsigned char', 'uint8': 'unsigned char', 'uint8_t': 'unsigned char',
+                         'signed short': 'short', 'short int': 'short', 'signed short int': 'short',
+                         'int16': 'short', 'int16_t': 'short',
+                         'ushort': 'unsigned short', 'unsigned short int': 'unsigned short',
+                         'uint16': 'unsigned short', 'uint16_t': 'unsigned short',
+                         'signed int': 'int', 'int32': 'int', 'int32_t': 'int',
+                         'uint': 'unsigned int', 'uint32': 'unsigned int', 'uint32_t': 'unsigned int',
+                         'longlong': 'long long', 'long long int': 'long long', 'signed long long': 'long long',
+                         'signed long long int': 'long long', 'int64': 'long long', 'int64_t': 'long long',
+                         'ulonglong': 'unsigned long long', 'unsigned long long int': 'unsigned long long',
+                         'uint64': 'unsigned long long', 'uint64_t': 'unsigned long long'}
+
+    @staticmethod
+    def availableFormats():
+        """The exchange formats that can be written and read here"""
+        formats = ['npy', 'nrrd', 'nrrd-gzip']
+        try:
+            import zstandard
+            formats.append('nrrd-zstd')
+        except ImportError:
+            pass
+        try:
+            import SimpleITK
+            formats.extend(['nii', 'nii.gz'])
+        except ImportError:
+            pass
+        return formats
+
+    def chooseFormat(self, supported, compress=False, allowed=None):
+        """The fastest format of those a model supports, compressed ones first if compress is set.
+        Falls back to raw NRRD, which every model reads."""
+        order = list(self.FORMATS)
+        if compress:
+            order = ([f for f in order if f in self.COMPRESSED_FORMATS] +
+                     [f for f in order if f not in self.COMPRESSED_FORMATS])
+        available = self.availableFormats()
+        for exchangeFormat in order:
+            if exchangeFormat in supported and exchangeFormat in available and \
+                    (allowed is None or exchangeFormat in allowed):
+                return exchangeFormat
+        return 'nrrd'
+
+    def write(self, volumeNode, path, region=None, exchangeFormat='nrrd'):
+        """Write the voxels of volumeNode, or of a region given as numpy slices in KJI
+        order, to a file in the given exchange format. The default is an attached-header
+        raw NRRD file."""
+        array = slicer.util.arrayFromVolume(volumeNode)
+        offset = (0, 0, 0)
+        if region:
+            array = array[region]
+            offset = [s.start or 0 for s in reversed(region)]
+        self.writeArray(array, self.regionIJKToRAS(volumeNode, offset), path, exchangeFormat, bool(region))
+
+    def writeArray(self, array, ijkToRAS, path, exchangeFormat='nrrd', sliced=False):
+        """Write a KJI array with the geometry of an IJK to RAS vtkMatrix4x4. With sliced set,
+        e.g. for a region of a larger buffer, the array is copied one slice at a time."""
+        import numpy as np
+        if exchangeFormat in ('nii', 'nii.gz'):
+            self.writeWithSimpleITK(ijkToRAS, array, path)
+            return
+        with open(path, 'wb') as f:
+            if exchangeFormat == 'npy':
+                np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(array.dtype),
+                                                         'fortran_order': False, 'shape': array.shape})
+                directions, origin = self.geometry(ijkToRAS)
+                with open(path + '.json', 'w') as sidecar:
+                    json.dump({'space': 'left-posterior-superior', 'space directions': directions,
+                               'space origin': origin}, sidecar)
+                encoding = 'raw'
+            else:
+                encoding = self.NRRD_ENCODINGS[exchangeFormat]
+                f.write(self.createHeader(ijkToRAS, array, encoding).encode('ascii'))
+            # a whole volume is a view of the vtkImageData buffer and is written as is
+            compressor = self.compressor(encoding)
+            for chunk in (array if sliced else [array]):
+                if compressor:
+                    f.write(compressor.compress(np.ascontiguousarray(chunk).reshape(-1).view(np.uint8)))
+                else:
+                    np.ascontiguousarray(chunk).tofile(f)
+            if compressor:
+                f.write(compressor.flush())
+
+    def compressor(self, encoding):
+        import zlib
+        if encoding == 'gzip':
+            # fast compression, exchange files are only read once
+            return zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        if encoding == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(level=3).compressobj()
+        return None
+
+    def decompressor(self, encoding):
+        import zlib
+        if encoding in ('gzip', 'gz'):
+            # gzip or zlib streams
+            return zlib.decompressobj(32 + zlib.MAX_WBITS)
+        if encoding == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj()
+        return None
+
+    def readData(self, f, encoding, buffer):
+        """Read the voxels of an open file into a writable byte buffer, returns the number of bytes read"""
+        decompressor = self.decompressor(encoding)
+        if not decompressor:
+            return f.readinto(buffer)
+        buffer = memoryview(buffer)
+        position = 0
+        while position < len(buffer):
+            data = f.read(self.CHUNK_SIZE)
+            if not data:
+                break
+            data = decompressor.decompress(data)[:len(buffer) - position]
+            buffer[position:position + len(data)] = data
+            position += len(data)
+        return position
+
+    @staticmethod
+    def regionIJKToRAS(volumeNode, offset=(0, 0, 0)):
+        """IJK to RAS vtkMatrix4x4 of a volume node, or of a region starting at offset"""
+        import vtk
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        for row in range(3):
+            ijkToRAS.SetElement(row, 3, ijkToRAS.GetElement(row, 3) +
+                                sum([ijkToRAS.GetElement(row, col) * offset[col] for col in range(3)]))
+        return ijkToRAS
+
+    def geometry(self, ijkToRAS):
+        """Axis directions scaled by the spacing and origin of an IJK to RAS matrix, in LPS"""
+        # RAS -> LPS
+        flip = [-1, -1, 1]
+        directions = [[flip[row] * ijkToRAS.GetElement(row, col) for row in range(3)] for col in range(3)]
+        return directions, [flip[row] * ijkToRAS.GetElement(row, 3) for row in range(3)]
+
+    def createHeader(self, ijkToRAS, array, encoding='raw'):
+        import sys
+        directions, origin = self.geometry(ijkToRAS)
+        directions = ['({0!r},{1!r},{2!r})'.format(*direction) for direction in directions]
+        origin = '({0!r},{1!r},{2!r})'.format(*origin)
+        sizes = [str(s) for s in reversed(array.shape[:3])]
+        kinds = ['domain', 'domain', 'domain']
+        if array.ndim == 4:
+            sizes.insert(0, str(array.shape[3]))
+            directions.insert(0, 'none')
+            kinds.insert(0, 'vector')
+        lines = ['NRRD0004',
+                 '# Complete NRRD file format specification at:',
+                 '# http://teem.sourceforge.net/nrrd/format.html',
+                 'type: {}'.format(self.NRRD_TYPES[array.dtype.name]),
+                 'dimension: {}'.format(len(sizes)),
+                 'space: left-posterior-superior',
+                 'sizes: {}'.format(' '.join(sizes)),
+                 'space directions: {}'.format(' '.join(directions)),
+                 'kinds: {}'.format(' '.join(kinds)),
+                 'endian: {}'.format(sys.byteorder),
+                 'encoding: {}'.format(encoding),
+                 'space origin: {}'.format(origin)]
+        return '\n'.join(lines) + '\n\n'
+
+    def readHeader(self, path):
+        """Return the header fields of a NRRD file and the offset of its data"""
+        fields = dict()
+        with open(path, 'rb') as f:
+            magic = f.readline()
+            if not magic.startswith(b'NRRD'):
+                raise ValueError('{} is not a NRRD file'.format(path))
+            while True:
+                line = f.readline()
+                if not line or not line.strip():
+                    break
+                line = line.decode('ascii', 'replace').rstrip('\r\n')
+                if line.startswith('#') or ':=' in line:
+                    continue
+                key, _, value = line.partition(':')
+                fields[key.strip().lower()] = value.strip()
+            offset = f.tell()
+        return fields, offset
+
+    def parseVectors(self, value):
+        return [[float(x) for x in v.split(',')] for v in re.findall(r'\(([^)]*)\)', value)]
+
+    def isDirectlyReadable(self, fields):
+        nrrdType = self.NRRD_TYPE_ALIASES.get(fields.get('type'), fields.get('type'))
+        space = fields.get('space', 'left-posterior-superior')
+        return (fields.get('encoding') in ('raw', 'gzip', 'gz', 'zstd') and fields.get('dimension') == '3' and
+                nrrdType in self.NRRD_TYPES.values() and
+                space in ('left-posterior-superior', 'right-anterior-superior') and
+                int(fields.get('byte skip', 0)) == 0 and 'line skip' not in fields)
+
+    def readArray(self, path):
+        """Read the voxels of an exchange file into a new numpy array in KJI order"""
+        import sys
+        import numpy as np
+        if path.endswith('.npy'):
+            return np.load(path)
+        if path.endswith(('.nii', '.nii.gz')):
+            import SimpleITK as sitk
+            return sitk.GetArrayFromImage(sitk.ReadImage(str(path)))
+        fields, offset = self.readHeader(path)
+        if not self.isDirectlyReadable(fields):
+            import SimpleITK as sitk
+            return sitk.GetArrayFromImage(sitk.ReadImage(str(path)))
+        dataPath = path
+        if 'data file' in fields or 'datafile' in fields:
+            dataPath = os.path.join(os.path.dirname(path), fields.get('data file', fields.get('datafile')))
+            offset = 0
+        nrrdType = self.NRRD_TYPE_ALIASES.get(fields['type'], fields['type'])
+        dtype = np.dtype(dict((v, k) for k, v in self.NRRD_TYPES.items())[nrrdType])
+        shape = [int(s) for s in reversed(fields['sizes'].split())]
+        array = np.empty(shape, dtype)
+        with open(dataPath, 'rb') as f:
+            f.seek(offset)
+            nbytes = self.readData(f, fields['encoding'], array.reshape(-1).view(np.uint8))
+        if nbytes != array.nbytes:
+            raise IOError('{} is truncated'.format(dataPath))
+        if dtype.itemsize > 1 and fields.get('endian', 'little') != sys.byteorder:
+            array.byteswap(True)
+        return array.reshape(shape)
+
+    def read(self, path, volumeNode, referenceNode=None):
+        """Read an exchange file into volumeNode. Raw and compressed 3D NRRD files are read
+        directly into the vtkImageData buffer of the node, NIfTI and other NRRD files go through
+        SimpleITK. .npy files without geometry get the geometry of referenceNode."""
+        import sys
+        import numpy as np
+        if path.endswith('.npy'):
+            self.readNumpy(path, volumeNode, referenceNode)
+            return
+        if path.endswith(('.nii', '.nii.gz')):
+            self.readNifti(path, volumeNode)
+            return
+        fields, offset = self.readHeader(path)
+        if not self.isDirectlyReadable(fields):
+            self.readWithSimpleITK(path, volumeNode)
+            return
+        nrrdType = self.NRRD_TYPE_ALIASES.get(fields['type'], fields['type'])
+        dtypes = dict((v, k) for k, v in self.NRRD_TYPES.items())
+        space = fields.get('space', 'left-posterior-superior')
+        dataPath = path
+        if 'data file' in fields or 'datafile' in fields:
+            dataPath = os.path.join(os.path.dirname(path), fields.get('data file', fields.get('datafile')))
+            offset = 0
+        dtype = np.dtype(dtypes[nrrdType])
+        dimensions = [int(s) for s in fields['sizes'].split()]
+        directions = self.parseVectors(fields.get('space directions', '(1,0,0) (0,1,0) (0,0,1)'))
+        origin = self.parseVectors(fields.get('space origin', '(0,0,0)'))[0]
+
+        self.setGeometry(volumeNode, directions, origin, space == 'left-posterior-superior')
+        array = self.allocate(volumeNode, dimensions, dtype)
+        with open(dataPath, 'rb') as f:
+            f.seek(offset)
+            nbytes = self.readData(f, fields['encoding'], array.reshape(-1).view(np.uint8))
+        if nbytes != array.nbytes:
+            raise IOError('{} is truncated'.format(dataPath))
+        if dtype.itemsize > 1 and fields.get('endian', 'little') != sys.byteorder:
+            array.byteswap(True)
+        slicer.util.arrayFromVolumeModified(volumeNode)
+
+    def readNumpy(self, path, volumeNode, referenceNode=None):
+        import numpy as np
+        import vtk
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if len(shape) != 3 or fortranOrder or dtype.hasobject:
+            raise ValueError('{} is not a 3D array in C order'.format(path))
+        if os.path.exists(path + '.json'):
+            with open(path + '.json') as f:
+                geometry = json.load(f)
+            self.setGeometry(volumeNode, geometry['space directions'], geometry['space origin'],
+                             geometry.get('space', 'left-posterior-superior') == 'left-posterior-superior')
+        elif referenceNode:
+            ijkToRAS = vtk.vtkMatrix4x4()
+            referenceNode.GetIJKToRASMatrix(ijkToRAS)
+            volumeNode.SetIJKToRASMatrix(ijkToRAS)
+        array = self.allocate(volumeNode, list(reversed(shape)), dtype.newbyteorder('='))
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            nbytes = f.readinto(array.reshape(-1).view(np.uint8))
+        if nbytes != array.nbytes:
+            raise IOError('{} is truncated'.format(path))
+        if not dtype.isnative:
+            array.byteswap(True)
+        slicer.util.arrayFromVolumeModified(volumeNode)
+
+    def setGeometry(self, volumeNode, directions, origin, lps=True):
+        import vtk
+        flip = [-1, -1, 1] if lps else [1, 1, 1]
+        ijkToRAS = vtk.vtkMatrix4x4()
+        for row in range(3):
+            for col in range(3):
+                ijkToRAS.SetElement(row, col, flip[row] * directions[col][row])
+            ijkToRAS.SetElement(row, 3, flip[row] * origin[row])
+        volumeNode.SetIJKToRASMatrix(ijkToRAS)
+
+    def allocate(self, volumeNode, dimensions, dtype):
+        """Make sure the node has an image buffer of the given size and type and return a view of it"""
+        import vtk
+        from vtk.util import numpy_support
+        vtkType = numpy_support.get_vtk_array_type(dtype)
+        imageData = volumeNode.GetImageData()
+        if (imageData is None or list(imageData.GetDimensions()) != list(dimensions) or
+                imageData.GetScalarType() != vtkType or imageData.GetNumberOfScalarComponents() != 1):
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(*dimensions)
+            imageData.AllocateScalars(vtkType, 1)
+            volumeNode.SetAndObserveImageData(imageData)
+        if not volumeNode.GetDisplayNode():
+            volumeNode.CreateDefaultDisplayNodes()
+        return slicer.util.arrayFromVolume(volumeNode)
+
+    def readNifti(self, path, volumeNode):
+        import SimpleITK as sitk
+        image = sitk.ReadImage(str(path))
+        if image.GetDimension() != 3 or image.GetNumberOfComponentsPerPixel() != 1:
+            self.readWithSimpleITK(path, volumeNode)
+            return
+        spacing = image.GetSpacing()
+        direction = image.GetDirection()
+        directions = [[direction[row * 3 + col] * spacing[col] for row in range(3)] for col in range(3)]
+        self.setGeometry(volumeNode, directions, image.GetOrigin())
+        source = sitk.GetArrayViewFromImage(image)
+        array = self.allocate(volumeNode, image.GetSize(), source.dtype)
+        array[:] = source
+        slicer.util.arrayFromVolumeModified(volumeNode)
+
+    def writeWithSimpleITK(self, ijkToRAS, array, path):
+        import numpy as np
+        import SimpleITK as sitk
+        image = sitk.GetImageFromArray(np.ascontiguousarray(array))
+        directions, origin = self.geometry(ijkToRAS)
+        spacing = [float(np.linalg.norm(direction)) for direction in directions]
+        image.SetSpacing(spacing)
+        image.SetOrigin(origin)
+        image.SetDirection([directions[col][row] / spacing[col] for row in range(3) for col in range(3)])
+        sitk.WriteImage(image, str(path), path.endswith('.gz'))
+
+    def readWithSimpleITK(self, path, volumeNode):
+        import SimpleITK as sitk
+        import sitkUtils
+        result = sitk.ReadImage(str(path))
+        nodeWriteAddress = sitkUtils.GetSlicerITKReadWriteAddress(volumeNode.GetName())
+        sitk.WriteImage(result, nodeWriteAddress)
+
+
+#
+# Scratch space
+#
+
+class ScratchSpace(object):
+    """ Where the jobs write their exchange files, each into its own sub directory.
+
+    By default this is TMP_PATH in the home directory. Another location, e.g. a local
+    disk when the home directory is on NFS, can be set with setLocation or the
+    DEEPINFER_SCRATCH environment variable; the jobs then use a deepinfer-<user>
+    directory in it. With useSharedMemory, jobs that fit comfortably are written to
+    /dev/shm instead. Before a job is exported, the free space is checked against the
+    size of its inputs and outputs.
+    """
+
+    SHARED_MEMORY = '/dev/shm'
+    # held while a job directory is in use, see lock
+    LOCK_FILE = '.lock'
+
+    def __init__(self, location=None, useSharedMemory=False, minFree=512 * 1024 ** 2):
+        self.setLocation(location or os.environ.get('DEEPINFER_SCRATCH'))
+        self.useSharedMemory = useSharedMemory
+        # bytes to leave free on the scratch disk
+        self.minFree = minFree
+        # job id -> (root, bytes the job has yet to write)
+        self.reserved = dict()
+
+    def setLocation(self, location):
+        self.root = self.userDirectory(location) if location else TMP_PATH
+
+    @classmethod
+    def lock(cls, directory):
+        """Mark a directory as in use until the returned file is closed. The lock ends with
+        the process, so the directories of crashed sessions are not locked, see isLocked."""
+        f = open(os.path.join(directory, cls.LOCK_FILE), 'w')
+        try:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            pass
+        return f
+
+    @classmethod
+    def isLocked(cls, directory):
+        path = os.path.join(directory, cls.LOCK_FILE)
+        if not os.path.exists(path):
+            return False
+        try:
+            import fcntl
+        except ImportError:
+            # without flock only the age of the files tells
+            return False
+        with open(path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return False
+
+    @staticmethod
+    def lastModified(directory):
+        """The latest modification time of a directory and everything in it"""
+        latest = os.path.getmtime(directory)
+        for parent, directories, files in os.walk(directory):
+            for name in directories + files:
+                try:
+                    latest = max(latest, os.path.getmtime(os.path.join(parent, name)))
+                except OSError:
+                    pass
+        return latest
+
+    @staticmethod
+    def userDirectory(location):
+        import getpass
+        try:
+            user = getpass.getuser()
+        except Exception:
+            user = 'user'
+        return os.path.join(location, 'deepinfer-' + user)
+
+    def roots(self):
+        """Every directory jobs may be written to"""
+        roots = [TMP_PATH, self.root]
+        if platform.system() == 'Linux':
+            roots.append(self.userDirectory(self.SHARED_MEMORY))
+        return sorted(set(roots), key=roots.index)
+
+    @staticmethod
+    def estimate(job):
+        """Bytes of the inputs and outputs of a job written uncompressed. The outputs are
+        assumed to be as large as the largest input. Tiled jobs only need the tiles that are
+        on disk at once."""
+        sizes = []
+        for item, node in job.inputs.items():
+            if isinstance(node, str):
+                sizes.append(os.path.getsize(node) if os.path.isfile(node) else 0)
+            elif node and job.iodict[item]["type"] == "volume" and node.GetImageData():
+                imageData = node.GetImageData()
+                sizes.append(imageData.GetNumberOfPoints() * imageData.GetScalarSize() *
+                             imageData.GetNumberOfScalarComponents())
+        outputs = len([item for item in job.iodict
+                       if job.iodict[item]["iotype"] == "output" and job.iodict[item]["type"] == "volume"])
+        inputBytes, outputBytes = sum(sizes), outputs * max(sizes or [0])
+        if job.tileGrid:
+            # only the tiles that run, and one waiting to be imported, are on disk at once,
+            # each with its overlap
+            import numpy as np
+            tileVoxels = np.prod([s.stop - s.start for s in job.tileGrid.region(0)])
+            fraction = min(1.0, (job.tileWorkers + 1) * tileVoxels / float(np.prod(job.tileGrid.dimensions)))
+            inputBytes, outputBytes = int(inputBytes * fraction), int(outputBytes * fraction)
+        return inputBytes, outputBytes
+
+    def freeSpace(self, root):
+        """Free bytes in root, less what the exported jobs have yet to write there"""
+        return shutil.disk_usage(root).free - sum([size for r, size in self.reserved.values() if r == root])
+
+    def allocate(self, job, allowSharedMemory=True):
+        """Choose the scratch root of a job and reserve space for it. Raises IOError if
+        there is not enough free space. Called on the main thread."""
+        inputBytes, outputBytes = self.estimate(job)
+        required = inputBytes + outputBytes
+        roots = [self.root]
+        if self.useSharedMemory and allowSharedMemory and os.path.isdir(self.SHARED_MEMORY):
+            roots.insert(0, self.userDirectory(self.SHARED_MEMORY))
+        for root in roots:
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            free = self.freeSpace(root)
+            if root != self.root:
+                # shared memory is RAM, a job may use at most half of what is left
+                if required > free / 2:
+                    continue
+            elif required + self.minFree > free:
+                raise IOError('Not enough free space in {} for {}: {:.0f} MB needed, {:.0f} MB free'.format(
+                    root, job.name, (required + self.minFree) / 1024.0 ** 2, free / 1024.0 ** 2))
+            self.reserved[job.id] = (root, outputBytes)
+            return root
+
+    def release(self, job):
+        self.reserved.pop(job.id, None)
+
+
+#
+# Container resources
+#
+
+class ContainerResources(object):
+    """ Resource limits and thread settings of model containers. A model declares them in
+    the resources of its description, for example
+
+        "resources": {"cpus": 4, "memory": "8g", "cpuset": "0-3", "threads": 4}
+
+    cpus and memory are also used by DeepInferLogic.canStartJob. The numeric libraries in
+    the container are told to use threads threads, by default the cpus rounded up. Without
+    it they start a thread per core of the host, and concurrent jobs oversubscribe it.
+    """
+
+    THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                        'TF_NUM_INTRAOP_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+
+    @staticmethod
+    def threads(resources):
+        import math
+        if 'threads' in resources:
+            return max(1, int(resources['threads']))
+        if 'cpus' in resources:
+            return max(1, int(math.ceil(float(resources['cpus']))))
+        return None
+
+    @classmethod
+    def dockerOptions(cls, resources):
+        """docker run options for resources"""
+        options = []
+        if 'cpus' in resources:
+            options.extend(('--cpus', str(resources['cpus'])))
+        if 'memory' in resources:
+            options.extend(('--memory', str(resources['memory'])))
+        if 'cpuset' in resources:
+            options.extend(('--cpuset-cpus', str(resources['cpuset'])))
+        threads = cls.threads(resources)
+        if threads:
+            for variable in cls.THREAD_VARIABLES:
+                options.extend(('-e', '{}={}'.format(variable, threads)))
+        return options
+
+    @classmethod
+    def share(cls, resources, parts):
+        """The resources of each of parts containers that together get resources"""
+        if parts <= 1:
+            return dict(resources)
+        shared = dict(resources)
+        if 'cpus' in resources:
+            shared['cpus'] = float(resources['cpus']) / parts
+        threads = cls.threads(resources)
+        if threads:
+            shared['threads'] = max(1, threads // parts)
+        return shared
+
+
+class ThreadTuner(object):
+    """ Finds the fastest thread count of a model on this host. The first job of a model
+    is run at each candidate count before its actual run, see DeepInferLogic.tuneJobThreads,
+    and the fastest count is stored for later runs, keyed by the host and the model image.
+    """
+
+    def __init__(self, path=TUNING_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = self.load()
+        # models that are being tuned, so that concurrent jobs do not tune them again
+        self.tuning = set()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.results, f, indent=2)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path + '.tmp', self.path)
+
+    @staticmethod
+    def key(job):
+        import multiprocessing
+        return '{} ({} cores) {}@{}'.format(platform.node(), multiprocessing.cpu_count(), job.dockerImageName,
+                                           job.digest)
+
+    @staticmethod
+    def candidates(maxThreads):
+        """Powers of two up to maxThreads, and maxThreads itself"""
+        counts = []
+        threads = 1
+        while threads < maxThreads:
+            counts.append(threads)
+            threads *= 2
+        counts.append(max(1, maxThreads))
+        return counts
+
+    def lookup(self, job):
+        entry = self.results.get(self.key(job))
+        return entry['threads'] if entry else None
+
+    def claim(self, job):
+        """True if the model of job has to be tuned and no other job is tuning it"""
+        key = self.key(job)
+        with self.lock:
+            if key in self.results or key in self.tuning:
+                return False
+            self.tuning.add(key)
+            return True
+
+    def release(self, job):
+        with self.lock:
+            self.tuning.discard(self.key(job))
+
+    def store(self, job, seconds):
+        """Store the run times of the candidate thread counts and return the fastest count"""
+        threads = min(seconds, key=seconds.get)
+        key = self.key(job)
+        with self.lock:
+            self.results[key] = {'threads': threads,
+                                 'seconds': dict([(str(count), value) for count, value in seconds.items()]),
+                                 'time': time()}
+            self.tuning.discard(key)
+            self.save()
+        print("{} runs fastest with {} threads".format(job.dockerImageName, threads))
+        return threads
+
+    def clear(self):
+        with self.lock:
+            self.results = dict()
+            self.save()
+
+
+#
+# Tiled inference
+#
+
+class VolumeTiling(object):
+    """ Splits a volume into overlapping tiles and blends the model outputs of the tiles
+    back into one volume.
+
+    Along each axis the tiles are spread evenly so that neighbours overlap by at least
+    the requested number of voxels. Floating point outputs are blended with linear
+    ramps over the overlaps, normalized so the weights of all tiles sum to one at every
+    voxel. Other outputs, such as label maps, take each voxel from the tile whose
+    center is closest. Sizes are given in IJK order, regions are numpy slices in KJI order.
+    """
+
+    def __init__(self, dimensions, tileSize, overlap=0):
+        import numpy as np
+        if not isinstance(overlap, (list, tuple)):
+            overlap = [overlap] * 3
+        self.dimensions = list(dimensions)
+        self.axes = []
+        for dim, size, margin in zip(dimensions, tileSize, overlap):
+            size = min(int(size), dim)
+            margin = min(int(margin), size // 2)
+            starts = self.axisStarts(dim, size, margin)
+            while True:
+                ramps = self.axisRamps(dim, size, margin, starts)
+                owner = np.argmax(ramps, axis=0)
+                # label outputs are taken from the tile that owns a voxel, a tile that owns
+                # none is dropped, the others still cover the axis
+                owned = [n for n in range(len(starts)) if np.any(owner == n)]
+                if len(owned) == len(starts):
+                    break
+                starts = [starts[n] for n in owned]
+            self.axes.append({'starts': starts, 'size': size,
+                              'weights': ramps / ramps.sum(axis=0),
+                              'cores': [np.nonzero(owner == n)[0] for n in range(len(starts))]})
+        self.tiles = [(i, j, k) for k in range(len(self.axes[2]['starts']))
+                      for j in range(len(self.axes[1]['starts']))
+                      for i in range(len(self.axes[0]['starts']))]
+
+    @staticmethod
+    def axisStarts(dim, size, overlap):
+        if size >= dim:
+            return [0]
+        count = -(-(dim - overlap) // (size - overlap))
+        return [int(round(n * (dim - size) / float(count - 1))) for n in range(count)]
+
+    @staticmethod
+    def axisRamps(dim, size, overlap, starts):
+        """The blending weight of each tile at each voxel of an axis, before normalization"""
+        import numpy as np
+        ramps = np.zeros((len(starts), dim))
+        for n, start in enumerate(starts):
+            x = np.arange(start, start + size) + 0.5
+            ramp = np.ones(size)
+            if overlap and start > 0:
+                ramp = np.minimum(ramp, (x - start) / overlap)
+            if overlap and start + size < dim:
+                ramp = np.minimum(ramp, (start + size - x) / overlap)
+            ramps[n, start:start + size] = ramp
+        return ramps
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def origin(self, index):
+        """IJK index of the first voxel of a tile"""
+        return [axis['starts'][n] for axis, n in zip(self.axes, self.tiles[index])]
+
+    def region(self, index):
+        return tuple(slice(start, start + axis['size'])
+                     for axis, start in reversed(list(zip(self.axes, self.origin(index)))))
+
+    def blend(self, array, tileArray, index):
+        """Add the output of a tile to array, which has to be zero before the first tile"""
+        import numpy as np
+        region = self.region(index)
+        if tileArray.shape[:3] != tuple(s.stop - s.start for s in region):
+            raise ValueError('Tile output has shape {}, expected {}'.format(
+                tileArray.shape[:3], tuple(s.stop - s.start for s in region)))
+        axes = list(zip(self.axes, self.tiles[index]))
+        if array.dtype.kind == 'f':
+            weights = [axis['weights'][n, axis['starts'][n]:axis['starts'][n] + axis['size']] for axis, n in axes]
+            weight = weights[2][:, None, None] * weights[1][None, :, None] * weights[0][None, None, :]
+            if tileArray.ndim == 4:
+                weight = weight[..., None]
+            array[region] += tileArray * weight
+        else:
+            cores = [axis['cores'][n] for axis, n in axes]
+            target = tuple(slice(core[0], core[-1] + 1) for core in reversed(cores))
+            source = tuple(slice(core[0] - axis['starts'][n], core[-1] + 1 - axis['starts'][n])
+                           for core, (axis, n) in reversed(list(zip(cores, axes))))
+            array[target] = tileArray[source]
+
+
+#
+# Preprocessing
+#
+
+class VolumePreprocessing(object):
+    """ Crops the input volumes of a model to a region of interest and resamples them to the
+    spacing the model expects before they are exported. The outputs are resampled back and
+    pasted into the full geometry of the inputs.
+
+    Models declare it in their description, for example
+
+        "preprocessing": {"spacing": [0.5, 0.5, 3.0], "roi": "InputROI", "margin": 10,
+                          "dtype": "float32", "window": [-200, 300]}
+
+    roi is the name of an input of type "roi" (a markups ROI) or "point_vec" (whose points
+    are enclosed in a box), grown by margin mm on every side. dtype and window, the
+    intensity range the voxels are clipped to, only apply to scalar volumes. Label maps are
+    resampled with nearest neighbour interpolation, everything else linearly. The crop is
+    aligned with the voxel axes, regions are numpy slices in KJI order.
+    """
+
+    def __init__(self, settings, dimensions, ijkToRAS, points=None):
+        import numpy as np
+        self.settings = dict(settings)
+        self.dimensions = list(dimensions)
+        self.ijkToRAS = np.array(ijkToRAS, dtype=float)
+        self.spacing = np.linalg.norm(self.ijkToRAS[:3, :3], axis=0)
+        start, end = self.cropExtent(points)
+        self.region = tuple(slice(start[axis], end[axis]) for axis in reversed(range(3)))
+        self.cropShape = tuple(int(end[axis] - start[axis]) for axis in reversed(range(3)))
+        targetSpacing = self.settings.get('spacing')
+        self.resampled = bool(targetSpacing) and not np.allclose(targetSpacing, self.spacing)
+        self.targetSpacing = np.array(targetSpacing if self.resampled else self.spacing, dtype=float)
+        size = np.maximum(1, np.round((end - start) * self.spacing / self.targetSpacing)).astype(int)
+        self.shape = tuple(int(n) for n in reversed(size))
+        # the resampled grid covers the crop, its first voxel center in mm from that of the crop
+        self.localOrigin = (self.targetSpacing - self.spacing) / 2
+        self.outputIJKToRAS = self.ijkToRAS.copy()
+        self.outputIJKToRAS[:3, :3] *= self.targetSpacing / self.spacing
+        self.outputIJKToRAS[:3, 3] = self.ijkToRAS[:3, :3].dot(start + self.localOrigin / self.spacing) + \
+            self.ijkToRAS[:3, 3]
+
+    @staticmethod
+    def roiPoints(node):
+        """RAS corners of a ROI node or the points of a markups fiducial node, as an N x 3 array"""
+        import numpy as np
+        if node.IsA('vtkMRMLMarkupsFiducialNode'):
+            points = []
+            for index in range(node.GetNumberOfFiducials()):
+                position = [0, 0, 0]
+                node.GetNthFiducialPosition(index, position)
+                points.append(position)
+            return np.array(points, dtype=float).reshape(-1, 3)
+        center = [0, 0, 0]
+        radius = [0, 0, 0]
+        node.GetXYZ(center)
+        node.GetRadiusXYZ(radius)
+        signs = np.array([[i, j, k] for i in (-1, 1) for j in (-1, 1) for k in (-1, 1)])
+        return np.array(center) + signs * np.array(radius)
+
+    def cropExtent(self, points=None):
+        """First and past the last voxel index of the crop along I, J and K"""
+        import numpy as np
+        dimensions = np.array(self.dimensions)
+        if points is None:
+            return np.zeros(3, dtype=int), dimensions
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if not len(points):
+            raise ValueError('The region of interest has no points')
+        rasToIJK = np.linalg.inv(self.ijkToRAS)
+        indices = points.dot(rasToIJK[:3, :3].T) + rasToIJK[:3, 3]
+        margin = float(self.settings.get('margin', 0)) / self.spacing
+        start = np.clip(np.floor(indices.min(axis=0) - margin + 0.5), 0, dimensions).astype(int)
+        end = np.clip(np.floor(indices.max(axis=0) + margin + 0.5) + 1, 0, dimensions).astype(int)
+        if np.any(end <= start):
+            raise ValueError('The region of interest is outside of the input volume')
+        return start, end
+
+    def apply(self, array, label=False):
+        """The cropped and resampled voxels of a KJI array, ready for export"""
+        import numpy as np
+        array = array[self.region]
+        if not label and self.settings.get('dtype'):
+            array = array.astype(self.settings['dtype'])
+        if not label and self.settings.get('window'):
+            low, high = [array.dtype.type(x) for x in self.settings['window']]
+            # a converted array is clipped in place, a view of the input node is not
+            array = np.clip(array, low, high, out=array if self.settings.get('dtype') else None)
+        if self.resampled:
+            array = self.resample(array, self.spacing, np.zeros(3), self.shape, self.targetSpacing,
+                                  self.localOrigin, label)
+        return array
+
+    def invert(self, array, target, label=False):
+        """Resample an output on the preprocessed grid back to the crop and paste it into
+        target, a KJI array of the full input size whose voxels outside of the crop are cleared"""
+        import numpy as np
+        if array.shape[:3] != self.shape:
+            raise ValueError('Output of size {} does not match the preprocessed input of size {}'.format(
+                tuple(reversed(array.shape[:3])), tuple(reversed(self.shape))))
+        if self.resampled:
+            array = self.resample(array, self.targetSpacing, self.localOrigin, self.cropShape, self.spacing,
+                                  np.zeros(3), label)
+        target[...] = 0
+        target[self.region] = array
+
+    @staticmethod
+    def resample(array, spacing, origin, shape, outputSpacing, outputOrigin, label=False):
+        """Resample a KJI array between two grids along the same axes, spacing and origin in IJK order"""
+        import numpy as np
+        import SimpleITK as sitk
+        image = sitk.GetImageFromArray(np.ascontiguousarray(array))
+        image.SetSpacing([float(x) for x in spacing])
+        image.SetOrigin([float(x) for x in origin])
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetSize([int(n) for n in reversed(shape)])
+        resampler.SetOutputSpacing([float(x) for x in outputSpacing])
+        resampler.SetOutputOrigin([float(x) for x in outputOrigin])
+        resampler.SetInterpolator(sitk.sitkNearestNeighbor if label else sitk.sitkLinear)
+        resampler.SetDefaultPixelValue(0)
+        return sitk.GetArrayFromImage(resampler.Execute(image))
+
+
+#
+# Run timing
+#
+
+class RunTrace(object):
+    """ Timing spans of the stages of a run: waiting in the queue, cache lookups, input
+    export, the docker daemon check, container startup, model compute, output import and
+    the scene update. The time of each stage is also summed per job in job.timings.
+    Spans can be written as JSON records or in the Chrome trace event format, which can
+    be opened in chrome://tracing or Perfetto.
+    """
+
+    STAGES = ['queued', 'cache lookup', 'export', 'docker check', 'thread tuning', 'container start', 'compute', 'import',
+              'scene update', 'cache store']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.origin = time()
+
+    def add(self, name, start, end, job=None, category='pipeline'):
+        span = {'name': name, 'category': category, 'start': start, 'end': end,
+                'job': job.name if job else None}
+        with self.lock:
+            self.spans.append(span)
+            if job is not None and category == 'pipeline':
+                job.timings[name] = job.timings.get(name, 0) + end - start
+
+    @contextmanager
+    def span(self, name, job=None, category='pipeline'):
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time(), job, category)
+
+    def addModelStages(self, job):
+        """Spans for the stages a container reported through its progress records"""
+        end = job.endTime or time()
+        for stage in job.stages:
+            self.add(stage['name'], stage['start'], stage['end'] or end, job, 'model')
+
+    def summary(self):
+        """Count, total, mean and maximum seconds of every pipeline stage"""
+        durations = dict()
+        with self.lock:
+            for span in self.spans:
+                if span['category'] == 'pipeline':
+                    durations.setdefault(span['name'], []).append(span['end'] - span['start'])
+        return dict([(name, {'count': len(values), 'total_s': sum(values), 'mean_s': sum(values) / len(values),
+                             'max_s': max(values)}) for name, values in durations.items()])
+
+    def toJSON(self):
+        with self.lock:
+            spans = [dict(span, start=span['start'] - self.origin, end=span['end'] - self.origin)
+                     for span in self.spans]
+        return {'origin': self.origin, 'spans': spans, 'summary': self.summary()}
+
+    def toChromeTrace(self):
+        """Complete events in microseconds, one row per job"""
+        events = []
+        lanes = {None: 0}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span['job'] not in lanes:
+                lanes[span['job']] = len(lanes)
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': 1,
+                           'tid': lanes[span['job']],
+                           'ts': int((span['start'] - self.origin) * 1e6),
+                           'dur': int((span['end'] - span['start']) * 1e6)})
+        for job, lane in lanes.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane,
+                           'args': {'name': job or 'DeepInfer'}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def writeJSON(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.toJSON(), f, indent=2)
+
+    def writeChromeTrace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.toChromeTrace(), f)
+
+
+#
+# Model registry mirror
+#
+
+class RegistrySync(object):
+    """ Keeps JSON_CLOUD_DIR in sync with the Model-Registry repository.
+
+    The directory listing is requested with the ETag of the previous listing, so an
+    unchanged registry costs a single 304 response. Files are only downloaded when
+    their git blob sha differs from the local copy, using a bounded pool of
+    concurrent connections. Files removed from the registry are removed locally.
+    """
+
+    REGISTRY_URL = 'https://api.github.com/repos/DeepInfer/Model-Registry/contents/'
+
+    def __init__(self, url=REGISTRY_URL, mirrorDir=JSON_CLOUD_DIR, maxConnections=8, timeout=30):
+        self.url = url
+        self.mirrorDir = mirrorDir
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.statePath = os.path.join(mirrorDir, '.sync.json')
+
+    def loadState(self):
+        state = {'etag': None, 'listing': []}
+        if os.path.isfile(self.statePath):
+            try:
+                with open(self.statePath) as f:
+                    state.update(json.load(f))
+            except ValueError:
+                pass
+        return state
+
+    def saveState(self, state):
+        with open(self.statePath, 'w') as f:
+            json.dump(state, f)
+
+    def open(self, url, headers=None):
+        try:
+            from urllib.request import Request, urlopen
+        except ImportError:
+            from urllib2 import Request, urlopen
+        return urlopen(Request(url, headers=headers or {}), timeout=self.timeout)
+
+    def fetchListing(self, state):
+        try:
+            from urllib.error import HTTPError
+        except ImportError:
+            from urllib2 import HTTPError
+        headers = dict()
+        if state['etag'] and state['listing']:
+            headers['If-None-Match'] = state['etag']
+        try:
+            response = self.open(self.url, headers)
+        except HTTPError as e:
+            if e.code == 304:
+                return state['listing']
+            raise
+        listing = json.loads(response.read().decode('utf-8'))
+        state['etag'] = response.info().get('ETag')
+        state['listing'] = listing
+        return listing
+
+    @staticmethod
+    def blobShaOfContent(content):
+        """The git blob sha of some content, as reported by the GitHub contents API"""
+        import hashlib
+        h = hashlib.sha1()
+        h.update('blob {}\0'.format(len(content)).encode('ascii'))
+        h.update(content)
+        return h.hexdigest()
+
+    @classmethod
+    def blobSha(cls, path):
+        with open(path, 'rb') as f:
+            return cls.blobShaOfContent(f.read())
+
+    def download(self, item):
+        response = self.open(item['download_url'])
+        content = response.read()
+        outputPath = os.path.join(self.mirrorDir, item['name'])
+        with open(outputPath + '.tmp', 'wb') as f:
+            f.write(content)
+        if os.path.exists(outputPath):
+            os.remove(outputPath)
+        os.rename(outputPath + '.tmp', outputPath)
+        return item['name']
+
+    def sync(self):
+        """Bring the mirror up to date. Returns the names of the downloaded, unchanged and removed files."""
+        from multiprocessing.pool import ThreadPool
+        state = self.loadState()
+        listing = self.fetchListing(state)
+        items = [item for item in listing if item['name'].endswith('.json')]
+        changed = []
+        unchanged = []
+        for item in items:
+            path = os.path.join(self.mirrorDir, item['name'])
+            if os.path.isfile(path) and self.blobSha(path) == item.get('sha'):
+                unchanged.append(item['name'])
+            else:
+                changed.append(item)
+        downloaded = []
+        if changed:
+            pool = ThreadPool(min(self.maxConnections, len(changed)))
+            try:
+                downloaded = pool.map(self.download, changed)
+            finally:
+                pool.close()
+                pool.join()
+        names = set([item['name'] for item in items])
+        removed = []
+        for path in glob(os.path.join(self.mirrorDir, '*.json')):
+            if os.path.basename(path) not in names:
+                os.remove(path)
+                removed.append(os.path.basename(path))
+        self.saveState(state)
+        return downloaded, unchanged, removed
+
+
+#
+# Model catalog
+#
+
+class ModelCatalog(object):
+    """ Index of the model descriptions in a json directory.
+
+    The name, organ, task, docker digest and mtime of each model are kept in a single
+    index file next to the descriptions, so only files that changed since the last
+    update are parsed again. Searches are answered from an in-memory index of the
+    sorted tokens of these fields: each search word has to be the prefix of a token.
+    """
+
+    FIELDS = ('name', 'organ', 'task')
+
+    def __init__(self, jsonDir, indexPath=None):
+        self.jsonDir = jsonDir
+        self.indexPath = indexPath or os.path.join(jsonDir, '.index.json')
+        self.entries = dict()
+        self.tokens = []
+        self.tokenKeys = dict()
+        self.loadIndex()
+
+    def loadIndex(self):
+        if os.path.isfile(self.indexPath):
+            try:
+                with open(self.indexPath) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = dict()
+
+    def saveIndex(self):
+        with open(self.indexPath + '.tmp', 'w') as f:
+            json.dump(self.entries, f)
+        if os.path.exists(self.indexPath):
+            os.remove(self.indexPath)
+        os.rename(self.indexPath + '.tmp', self.indexPath)
+
+    @staticmethod
+    def createEntry(path, stat):
+        with open(path) as f:
+            model = json.load(f)
+        entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        for field in ModelCatalog.FIELDS:
+            entry[field] = str(model.get(field, ''))
+        docker = model.get('docker') or dict()
+        entry['repository'] = docker.get('dockerhub_repository', '')
+        entry['digest'] = docker.get('digest', '')
+        return entry
+
+    def update(self):
+        """Parse the new and modified descriptions and drop the removed ones. Returns True if anything changed."""
+        changed = False
+        fileNames = set()
+        for fileName in os.listdir(self.jsonDir):
+            if fileName.startswith('.') or not fileName.endswith('.json'):
+                continue
+            fileNames.add(fileName)
+            path = os.path.join(self.jsonDir, fileName)
+            stat = os.stat(path)
+            entry = self.entries.get(fileName)
+            # entries of older indexes have no repository
+            if entry and entry['mtime'] == stat.st_mtime and entry.get('size') == stat.st_size and 'repository' in entry:
+                continue
+            try:
+                self.entries[fileName] = self.createEntry(path, stat)
+            except (IOError, ValueError) as e:
+                print("Skipping model description {}: {}".format(fileName, e))
+                self.entries.pop(fileName, None)
+            changed = True
+        for fileName in list(self.entries.keys()):
+            if fileName not in fileNames:
+                del self.entries[fileName]
+                changed = True
+        if changed:
+            self.saveIndex()
+        if changed or not self.tokens:
+            self.buildTokenIndex()
+        return changed
+
+    @staticmethod
+    def tokenize(text):
+        return [token for token in re.split(r'[^0-9a-z]+', text.lower()) if token]
+
+    def buildTokenIndex(self):
+        self.tokenKeys = dict()
+        for fileName, entry in self.entries.items():
+            for field in self.FIELDS:
+                for token in self.tokenize(entry[field]):
+                    self.tokenKeys.setdefault(token, set()).add(fileName)
+        self.tokens = sorted(self.tokenKeys.keys())
+
+    def keysWithPrefix(self, prefix):
+        import bisect
+        keys = set()
+        i = bisect.bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            keys.update(self.tokenKeys[self.tokens[i]])
+            i += 1
+        return keys
+
+    def search(self, text=''):
+        """File names of the models matching all words of the text, sorted by model name"""
+        keys = None
+        for word in text.split():
+            # words like "t2-weighted" match when all their parts do
+            for prefix in self.tokenize(word):
+                matches = self.keysWithPrefix(prefix)
+                keys = matches if keys is None else keys & matches
+                if not keys:
+                    return []
+        if keys is None:
+            keys = self.entries.keys()
+        return sorted(keys, key=lambda fileName: (self.entries[fileName]['name'].lower(), fileName))
+
+    def highlight(self, value, text):
+        """Rich text of the value with the words starting with a search word in bold"""
+        prefixes = [prefix for word in text.split() for prefix in self.tokenize(word)]
+
+        def bold(match):
+            word = match.group(0)
+            if any(word.lower().startswith(prefix) for prefix in prefixes):
+                return '<b>{}</b>'.format(word)
+            return word
+        return re.sub(r'[0-9A-Za-z]+', bold, value.replace('&', '&amp;').replace('<', '&lt;'))
+
+    def matchedFields(self, fileName, text):
+        """The fields of a model that contain a search word"""
+        prefixes = [prefix for word in text.split() for prefix in self.tokenize(word)]
+        entry = self.entries[fileName]
+        return [field for field in self.FIELDS
+                if any(token.startswith(prefix) for token in self.tokenize(entry[field]) for prefix in prefixes)]
+
+    def load(self, fileName):
+        """The full description of a model"""
+        with open(os.path.join(self.jsonDir, fileName), "r") as fp:
+            return json.load(fp, object_pairs_hook=OrderedDict)
+
+
+#
+# Result cache
+#
+
+class ResultCache(object):
+    """ Persistent on-disk cache of model outputs. Entries are keyed on the input
+    voxels and geometry, the docker image digest of the model and its parameters.
+    The least recently used entries are evicted once the cache grows beyond maxSize bytes.
+    """
+
+    def __init__(self, cacheDir=CACHE_DIR, maxSize=10 * 1024 ** 3):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.indexPath = os.path.join(cacheDir, 'index.json')
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        self.index = self.loadIndex()
+
+    @property
+    def hits(self):
+        return self.index['hits']
+
+    @property
+    def misses(self):
+        return self.index['misses']
+
+    def size(self):
+        return sum([entry['size'] for entry in self.index['entries'].values()])
+
+    def loadIndex(self):
+        index = {'entries': dict(), 'hits': 0, 'misses': 0}
+        if os.path.isfile(self.indexPath):
+            try:
+                with open(self.indexPath) as f:
+                    index.update(json.load(f))
+            except ValueError as e:
+                print("Ignoring corrupt result cache index: {}".format(e))
+        return index
+
+    def saveIndex(self):
+        with open(self.indexPath + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        if os.path.exists(self.indexPath):
+            os.remove(self.indexPath)
+        os.rename(self.indexPath + '.tmp', self.indexPath)
+
+    def computeKey(self, job):
+        """Hash everything that determines the outputs of a job. Must be called from the main thread."""
+        import hashlib
+        import numpy as np
+        import vtk
+        h = hashlib.blake2b(digest_size=32) if hasattr(hashlib, 'blake2b') else hashlib.sha256()
+
+        def update(value):
+            h.update(repr(value).encode('utf-8'))
+
+        # the cached files are stored in the exchange format of the job
+        update((job.dockerImageName, job.digest, job.modelName, sorted(job.tiling.items()), job.exchangeFormat))
+        if job.preprocessing:
+            update(sorted(job.preprocessing.items()))
+        for item in sorted(job.iodict):
+            entry = job.iodict[item]
+            update((item, entry['iotype'], entry['type']))
+            if entry['iotype'] == 'parameter':
+                update(str(job.params[item]))
+            elif entry['iotype'] == 'input' and isinstance(job.inputs[item], str):
+                with open(job.inputs[item], 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        h.update(chunk)
+            elif entry['iotype'] == 'input' and entry['type'] == 'volume':
+                node = job.inputs[item]
+                array = slicer.util.arrayFromVolume(node)
+                ijkToRAS = vtk.vtkMatrix4x4()
+                node.GetIJKToRASMatrix(ijkToRAS)
+                update([ijkToRAS.GetElement(row, col) for row in range(3) for col in range(4)])
+                update((array.dtype.str, array.shape))
+                # hash the vtkImageData buffer in place
+                h.update(np.ascontiguousarray(array).reshape(-1).view(np.uint8))
+            elif entry['iotype'] == 'input' and entry['type'] == 'point_vec':
+                node = job.inputs[item]
+                for index in range(node.GetNumberOfFiducials()):
+                    position = [0, 0, 0]
+                    node.GetNthFiducialPosition(index, position)
+                    update(position)
+            elif entry['iotype'] == 'input' and entry['type'] == 'roi':
+                update(VolumePreprocessing.roiPoints(job.inputs[item]).tolist())
+        return h.hexdigest()
+
+    def lookup(self, key, workDir, fileNames):
+        """Link the cached outputs into workDir. Returns False on a cache miss."""
+        entry = self.index['entries'].get(key)
+        entryDir = os.path.join(self.cacheDir, key)
+        if entry is None or not all([os.path.isfile(os.path.join(entryDir, name)) for name in fileNames]):
+            self.index['misses'] += 1
+            self.saveIndex()
+            return False
+        for name in fileNames:
+            self.linkOrCopy(os.path.join(entryDir, name), os.path.join(workDir, name))
+        entry['atime'] = time()
+        self.index['hits'] += 1
+        self.saveIndex()
+        return True
+
+    @staticmethod
+    def linkOrCopy(source, target):
+        """Hard link a file, imports only read the outputs. Copies across devices."""
+        try:
+            os.link(source, target)
+        except (OSError, AttributeError):
+            shutil.copyfile(source, target)
+
+    def store(self, key, workDir, fileNames):
+        entryDir = os.path.join(self.cacheDir, key)
+        shutil.rmtree(entryDir, ignore_errors=True)
+        os.makedirs(entryDir)
+        size = 0
+        for name in fileNames:
+            source = os.path.join(workDir, name)
+            target = os.path.join(entryDir, name)
+            # the job directory is removed after import, so a hard link is enough
+            self.linkOrCopy(source, target)
+            size += os.path.getsize(target)
+        self.index['entries'][key] = {'size': size, 'atime': time(), 'files': list(fileNames)}
+        self.evict()
+        self.saveIndex()
+
+    def evict(self):
+        entries = self.index['entries']
+        total = self.size()
+        for key in sorted(entries, key=lambda k: entries[k]['atime']):
+            if total <= self.maxSize:
+                break
+            total -= entries[key]['size']
+            del entries[key]
+            shutil.rmtree(os.path.join(self.cacheDir, key), ignore_errors=True)
+
+    def clear(self):
+        for key in list(self.index['entries']):
+            shutil.rmtree(os.path.join(self.cacheDir, key), ignore_errors=True)
+        self.index = {'entries': dict(), 'hits': 0, 'misses': 0}
+        self.saveIndex()
+
+
+#
+# Docker state
+#
+
+class DockerState(object):
+    """ Cached liveness of the docker daemon and the list of local images.
+
+    The Docker Engine API is queried over its unix socket, the docker executable is
+    only run if the socket is not available. Results are kept for ttl seconds and
+    refresh() updates them on a worker thread, so the GUI never waits for docker.
+    One state is kept per docker executable, see get.
+    """
+
+    states = dict()
+    statesLock = threading.Lock()
+    ttl = 60
+
+    def __init__(self, dockerPath, socketPath=None, timeout=5):
+        self.dockerPath = dockerPath
+        # '' disables the Engine API
+        self.socketPath = self.defaultSocketPath() if socketPath is None else socketPath
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.daemonRunning = None
+        self.daemonTime = 0
+        self.images = None
+        self.imagesTime = 0
+        self.refreshThread = None
+
+    @classmethod
+    def get(cls, dockerPath):
+        with cls.statesLock:
+            if dockerPath not in cls.states:
+                cls.states[dockerPath] = DockerState(dockerPath)
+            return cls.states[dockerPath]
+
+    @staticmethod
+    def defaultSocketPath():
+        host = os.environ.get('DOCKER_HOST', '')
+        if host.startswith('unix://'):
+            return host[len('unix://'):]
+        if host or platform.system() == 'Windows':
+            return ''
+        return '/var/run/docker.sock'
+
+    def engineAvailable(self):
+        import socket
+        return bool(self.socketPath) and hasattr(socket, 'AF_UNIX') and os.path.exists(self.socketPath)
+
+    def connect(self, timeout):
+        import http.client
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        connection = http.client.HTTPConnection('localhost', timeout=timeout)
+        connection.sock = sock
+        return connection, sock
+
+    def request(self, path, method='GET'):
+        """Send a request to the Docker Engine API and return the response body"""
+        connection, sock = self.connect(self.timeout)
+        try:
+            sock.connect(self.socketPath)
+            connection.request(method, path)
+            response = connection.getresponse()
+            body = response.read().decode('utf-8')
+        finally:
+            connection.close()
+            sock.close()
+        if response.status not in (200, 204):
+            raise IOError('Docker Engine API returned {} for {}'.format(response.status, path))
+        return body
+
+    def stream(self, path, method='POST', opened=None, timeout=300):
+        """Send a request to the Docker Engine API and yield the json records it streams back,
+        e.g. the progress of a pull. opened is called with the socket, closing it ends the request."""
+        connection, sock = self.connect(timeout)
+        try:
+            sock.connect(self.socketPath)
+            if opened:
+                opened(sock)
+            connection.request(method, path)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise IOError('Docker Engine API returned {} for {}'.format(response.status, path))
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            connection.close()
+            sock.close()
+
+    def queryDaemon(self):
+        if self.engineAvailable():
+            try:
+                return self.request('/_ping').strip() == 'OK'
+            except (IOError, OSError) as e:
+                print("Docker Engine API is not available: {}".format(e))
+        p = subprocess.Popen([self.dockerPath, 'ps'], stdout=subprocess.PIPE, universal_newlines=True)
+        line = p.stdout.readline()
+        p.communicate()
+        return line[:9] == 'CONTAINER'
+
+    def queryImages(self):
+        """References of the local images, i.e. their repository, repository:tag and repository@digest"""
+        images = set()
+        if self.engineAvailable():
+            try:
+                for image in json.loads(self.request('/images/json')):
+                    for reference in (image.get('RepoTags') or []) + (image.get('RepoDigests') or []):
+                        if not reference.startswith('<none>'):
+                            images.add(reference)
+                            images.add(re.split('@|:(?=[^/]*$)', reference)[0])
+                return images
+            except (IOError, OSError, ValueError) as e:
+                print("Docker Engine API is not available: {}".format(e))
+        cmd = [self.dockerPath, 'images', '--digests', '--format', '{{.Repository}}\t{{.Tag}}\t{{.Digest}}']
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise IOError('{} images failed with exit code {}'.format(self.dockerPath, p.returncode))
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if len(fields) != 3 or fields[0] == '<none>':
+                continue
+            repository, tag, digest = fields
+            images.add(repository)
+            if tag != '<none>':
+                images.add(repository + ':' + tag)
+            if digest != '<none>':
+                images.add(repository + '@' + digest)
+        return images
+
+    def isDaemonRunning(self):
+        """Query the daemon unless it was seen running within ttl seconds. A stopped
+        daemon is not cached, so that starting docker takes effect at once."""
+        with self.lock:
+            if self.daemonRunning and time() - self.daemonTime < self.ttl:
+                return True
+        try:
+            running = self.queryDaemon()
+        except (IOError, OSError) as e:
+            print("Exception while checking the docker daemon: {}".format(e))
+            running = False
+        with self.lock:
+            self.daemonRunning = running
+            self.daemonTime = time()
+        return running
+
+    def updateImages(self):
+        images = self.queryImages()
+        with self.lock:
+            self.images = images
+            self.imagesTime = self.daemonTime = time()
+            self.daemonRunning = True
+
+    def hasImage(self, repository, digest=''):
+        """True or False, or None while the images are not known. Starts a refresh if they are stale."""
+        with self.lock:
+            images = self.images
+            stale = time() - self.imagesTime >= self.ttl
+        if stale:
+            self.refresh()
+        if images is None or not repository:
+            return None
+        if digest:
+            return repository + '@' + digest in images
+        return repository in images
+
+    def refresh(self):
+        """Update the daemon state and the images on a worker thread. Returns the thread."""
+        with self.lock:
+            if self.refreshThread and self.refreshThread.is_alive():
+                return self.refreshThread
+            self.refreshThread = threading.Thread(target=self.refreshWorker)
+            self.refreshThread.daemon = True
+            self.refreshThread.start()
+            return self.refreshThread
+
+    def refreshWorker(self):
+        try:
+            self.updateImages()
+        except Exception as e:
+            print("Could not list the docker images: {}".format(e))
+            with self.lock:
+                self.imagesTime = time()
+            self.isDaemonRunning()
+
+    def killContainer(self, containerName, timeout=10):
+        """Kill a container by name. Returns False if it could not be killed within timeout seconds,
+        e.g. because it does not exist (anymore)."""
+        if self.engineAvailable():
+            try:
+                self.request('/containers/{}/kill'.format(containerName), 'POST')
+                return True
+            except (IOError, OSError) as e:
+                print("Could not kill {} through the Docker Engine API: {}".format(containerName, e))
+        p = subprocess.Popen([self.dockerPath, 'kill', containerName], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        try:
+            p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            return False
+        return p.returncode == 0
+
+    def invalidate(self):
+        """Forget the cached state, e.g. after a container failed to start or an image was pulled"""
+        with self.lock:
+            self.daemonRunning = None
+            self.imagesTime = self.daemonTime = 0
+
+
+#
+# Image pulls
+#
+
+class PullTask(object):
+    """ The pull of the docker image of one model and the progress of each of its layers """
+
+    def __init__(self, modelPath):
+        with open(modelPath) as f:
+            self.model = json.load(f, object_pairs_hook=OrderedDict)
+        self.modelPath = modelPath
+        self.name = self.model.get('name', os.path.basename(modelPath))
+        self.repository = self.model['docker']['dockerhub_repository']
+        self.digest = self.model['docker'].get('digest', '')
+        self.status = 'queued'
+        self.layers = OrderedDict()
+        self.error = None
+        self.startTime = None
+        self.endTime = None
+        self.cancelled = False
+        # the socket or docker process of the pull, closed to cancel it
+        self.connection = None
+
+    def reference(self):
+        return self.repository + ('@' + self.digest if self.digest else ':latest')
+
+    def update(self, record):
+        """Update the layers from a progress record of the Engine API, such as
+
+            {"id": "a3ed95caeb02", "status": "Downloading", "progressDetail": {"current": 1024, "total": 4096}}
+        """
+        if record.get('error'):
+            raise IOError(record['error'])
+        layer = record.get('id')
+        status = record.get('status', '')
+        if not layer or status.startswith('Pulling from'):
+            return
+        entry = self.layers.setdefault(layer, {'status': '', 'current': 0, 'total': 0, 'done': False})
+        entry['status'] = status
+        detail = record.get('progressDetail') or {}
+        if status == 'Downloading' and detail.get('total'):
+            entry['current'] = detail.get('current', 0)
+            entry['total'] = detail['total']
+        elif status in ('Download complete', 'Pull complete', 'Already exists'):
+            entry['current'] = entry['total']
+            entry['done'] = status != 'Download complete'
+
+    def progress(self):
+        """Mean fraction of the layers that is done, downloading layers count by their bytes"""
+        if self.status == 'completed':
+            return 1.0
+        fractions = []
+        for entry in list(self.layers.values()):
+            if entry['done']:
+                fractions.append(1.0)
+            elif entry['total']:
+                fractions.append(min(float(entry['current']) / entry['total'], 0.99))
+            else:
+                fractions.append(0.0)
+        return sum(fractions) / len(fractions) if fractions else 0.0
+
+    def downloadedBytes(self):
+        return sum([entry['current'] for entry in list(self.layers.values())])
+
+    def cancel(self):
+        self.cancelled = True
+        connection = self.connection
+        try:
+            if isinstance(connection, subprocess.Popen):
+                connection.terminate()
+            elif connection is not None:
+                import socket
+                connection.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+
+
+class PullManager(object):
+    """ Pulls the images of models in the background, at most maxConcurrentPulls at once,
+    through the Docker Engine API or the docker executable. A model is registered, i.e.
+    its description copied to localDir, only once its image is present with the digest
+    of the description.
+
+    The docker daemon downloads the layers and cannot be throttled per pull, so
+    bandwidthLimit, in bytes per second, is kept by admission: a queued pull only starts
+    while the download rate of the running pulls is below it.
+    """
+
+    rateWindow = 3
+
+    def __init__(self, dockerState, maxConcurrentPulls=2, bandwidthLimit=0, localDir=JSON_LOCAL_DIR):
+        self.dockerState = dockerState
+        self.maxConcurrentPulls = maxConcurrentPulls
+        self.bandwidthLimit = bandwidthLimit
+        self.localDir = localDir
+        self.lock = threading.RLock()
+        self.tasks = []
+        # download rate samples of the last rateWindow seconds
+        self.samples = deque()
+        self.lastStart = 0
+
+    def pull(self, modelPath):
+        """Queue the pull of the image of a model, unless it is queued or running already.
+        Returns its PullTask."""
+        task = PullTask(modelPath)
+        with self.lock:
+            for other in self.tasks:
+                if other.reference() == task.reference() and other.status in ('queued', 'pulling'):
+                    return other
+            self.tasks.append(task)
+        self.schedule()
+        return task
+
+    def active(self):
+        with self.lock:
+            return [task for task in self.tasks if task.status in ('queued', 'pulling')]
+
+    def progress(self):
+        """Mean progress of the queued and running pulls"""
+        tasks = self.active()
+        return sum([task.progress() for task in tasks]) / len(tasks) if tasks else 1.0
+
+    def rate(self):
+        """Download rate of all pulls in bytes per second over the last rateWindow seconds"""
+        now = time()
+        with self.lock:
+            self.samples.append((now, sum([task.downloadedBytes() for task in self.tasks])))
+            while self.samples[0][0] < now - self.rateWindow:
+                self.samples.popleft()
+            (start, startBytes), (end, endBytes) = self.samples[0], self.samples[-1]
+        return (endBytes - startBytes) / (end - start) if end > start else 0.0
+
+    def canStartPull(self):
+        with self.lock:
+            running = len([task for task in self.tasks if task.status == 'pulling'])
+            if running >= self.maxConcurrentPulls:
+                return False
+            if self.bandwidthLimit and running:
+                # the rate of the last pull that was started is not known yet
+                if time() - self.lastStart < self.rateWindow or self.rate() >= self.bandwidthLimit:
+                    return False
+            return True
+
+    def schedule(self):
+        """Start queued pulls while the limits allow. Called from any thread."""
+        while True:
+            with self.lock:
+                queued = [task for task in self.tasks if task.status == 'queued']
+                if not queued or not self.canStartPull():
+                    return
+                task = queued[0]
+                task.status = 'pulling'
+                task.startTime = self.lastStart = time()
+            thread = threading.Thread(target=self.pullWorker, args=(task,))
+            thread.daemon = True
+            thread.start()
+
+    def cancel(self, task):
+        with self.lock:
+            if task.status == 'queued':
+                task.status = 'cancelled'
+                return
+        task.cancel()
+
+    def wait(self, timeout=None):
+        """Wait until all pulls have finished. Returns False on timeout."""
+        start = time()
+        while self.active():
+            if timeout is not None and time() - start > timeout:
+                return False
+            self.schedule()
+            sleep(0.1)
+        return True
+
+    def pullWorker(self, task):
+        try:
+            if not self.pullWithEngine(task):
+                self.pullWithExecutable(task)
+            if task.cancelled:
+                raise IOError('cancelled')
+            self.register(task)
+            task.status = 'completed'
+        except Exception as e:
+            task.error = str(e)
+            task.status = 'cancelled' if task.cancelled else 'failed'
+            print("Pull of {} {}: {}".format(task.reference(), task.status, e))
+        task.connection = None
+        task.endTime = time()
+        self.schedule()
+
+    def onRecord(self, task, record):
+        task.update(record)
+        self.rate()
+        self.schedule()
+
+    def pullWithEngine(self, task):
+        """Pull through the Docker Engine API. Returns False if it is not available."""
+        from urllib.parse import quote
+        if not self.dockerState.engineAvailable():
+            return False
+        path = '/images/create?fromImage={}&tag={}'.format(quote(task.repository, safe=''),
+                                                           quote(task.digest or 'latest', safe=''))
+        try:
+            for record in self.dockerState.stream(path, 'POST', lambda sock: setattr(task, 'connection', sock)):
+                self.onRecord(task, record)
+        except (IOError, OSError) as e:
+            if task.layers or task.cancelled:
+                raise
+            print("Docker Engine API is not available: {}".format(e))
+            return False
+        return True
+
+    def pullWithExecutable(self, task):
+        p = subprocess.Popen([self.dockerState.dockerPath, 'pull', task.reference()], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True)
+        task.connection = p
+        lastLine = ''
+        while True:
+            line = p.stdout.readline()
+            if not line:
+                break
+            lastLine = line.strip() or lastLine
+            # without a terminal only the status changes of the layers are printed
+            match = re.match(r'([0-9a-f]{12}): (.+)$', line.strip())
+            if match:
+                self.onRecord(task, {'id': match.group(1), 'status': match.group(2)})
+        p.wait()
+        if p.returncode and not task.cancelled:
+            raise IOError('docker pull exited with code {}: {}'.format(p.returncode, lastLine))
+
+    def register(self, task):
+        """Copy the description of a pulled model to localDir, if its image is present"""
+        self.dockerState.invalidate()
+        self.dockerState.updateImages()
+        if not self.dockerState.hasImage(task.repository, task.digest):
+            raise IOError('{} is not present after the pull'.format(task.reference()))
+        path = os.path.join(self.localDir, os.path.basename(task.modelPath))
+        shutil.copy(task.modelPath, path + '.tmp')
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+
+class SitePrePull(object):
+    """ Pulls the images of all models of a site list during off-hours, so that new
+    workstations are provisioned without manual pulls. A site list is a json file
+
+        {"models": ["prostate-segmenter.json", "/shared/models/lesion-detector.json"],
+         "off_hours": [22, 6]}
+
+    The models are file names in the registry mirror or paths of model descriptions,
+    off_hours the local hours at which pulls start and end, by default 22 to 6.
+    """
+
+    def __init__(self, path, pullManager, cloudDir=JSON_CLOUD_DIR):
+        with open(path) as f:
+            siteList = json.load(f)
+        self.pullManager = pullManager
+        self.offHours = siteList.get('off_hours', [22, 6])
+        self.modelPaths = []
+        for model in siteList.get('models', []):
+            fileName = model if model.endswith('.json') else model + '.json'
+            candidates = [os.path.join(os.path.dirname(os.path.abspath(path)), fileName),
+                          os.path.join(cloudDir, fileName)]
+            found = [candidate for candidate in candidates if os.path.isfile(candidate)]
+            if not found:
+                print("Model {} of the site list {} not found".format(model, path))
+                continue
+            self.modelPaths.append(found[0])
+
+    def isOffHours(self, now=None):
+        import datetime
+        hour = (now or datetime.datetime.now()).hour
+        start, end = self.offHours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def missing(self):
+        """The models that are not registered or whose image is not known to be present"""
+        missing = []
+        for path in self.modelPaths:
+            task = PullTask(path)
+            registered = os.path.isfile(os.path.join(self.pullManager.localDir, os.path.basename(path)))
+            if not registered or not self.pullManager.dockerState.hasImage(task.repository, task.digest):
+                missing.append(path)
+        return missing
+
+    def check(self, now=None, anyTime=False):
+        """Queue the pulls of the missing models during off-hours. Returns the tasks."""
+        if not anyTime and not self.isOffHours(now):
+            return []
+        return [self.pullManager.pull(path) for path in self.missing()]
+
+
+#
+# Warm session containers
+#
+
+class WarmSession(object):
+    """ A long-lived model container that keeps its weights loaded between runs.
+
+    The container is started with --WarmJobDir pointing at a job directory in
+    the scratch root. A job is a <id>.json file holding the model arguments. The
+    container appends the job output to <id>.log and writes the exit code to
+    <id>.done when the job has finished. An empty <id>.cancel file asks the
+    container to drop a job, the container is killed as well so that a job that
+    does not stop cannot hold the session.
+    """
+
+    # polls between checks that the container is still running
+    livenessPolls = 10
+
+    def __init__(self, dockerPath, dockerName, dataPath, idleTimeout=600, scratchRoot=TMP_PATH, resources=None):
+        import uuid
+        self.dockerPath = dockerPath
+        self.dockerName = dockerName
+        self.dataPath = dataPath
+        self.idleTimeout = idleTimeout
+        self.scratchRoot = scratchRoot
+        self.resources = dict(resources or {})
+        self.containerName = 'deepinfer-warm-' + uuid.uuid4().hex[:12]
+        self.jobDir = os.path.join(scratchRoot, '.jobs', self.containerName)
+        self.jobDirLock = None
+        self.lock = threading.Lock()
+        self.idleTimer = None
+        self.started = False
+
+    def start(self):
+        if not os.path.isdir(self.jobDir):
+            os.makedirs(self.jobDir)
+        if not self.jobDirLock:
+            self.jobDirLock = ScratchSpace.lock(self.jobDir)
+        cmd = [self.dockerPath, 'run', '-d', '--rm', '--name', self.containerName]
+        cmd.extend(ContainerResources.dockerOptions(self.resources))
+        cmd.extend(['-v', self.scratchRoot + ':' + self.dataPath, self.dockerName,
+                    '--WarmJobDir', self.dataPath + '/.jobs/' + self.containerName])
+        print(cmd)
+        subprocess.check_call(cmd)
+        self.started = True
+
+    def isRunning(self):
+        if not self.started:
+            return False
+        cmd = [self.dockerPath, 'inspect', '-f', '{{.State.Running}}', self.containerName]
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        out, _ = p.communicate()
+        return out.strip() == 'true'
+
+    def submit(self, modelArgs, lineCallback, abortCallback, pollInterval=0.1):
+        """Run one job in the container and return its exit code, -1 if the container
+        died or None if aborted. Blocks until the job is done and must be called from
+        a worker thread."""
+        import uuid
+        with self.lock:
+            self.cancelIdleTimer()
+            try:
+                if not self.isRunning():
+                    self.start()
+                jobId = uuid.uuid4().hex
+                jobFile = os.path.join(self.jobDir, jobId + '.json')
+                logFile = os.path.join(self.jobDir, jobId + '.log')
+                doneFile = os.path.join(self.jobDir, jobId + '.done')
+                # write to a temporary name first so the container never sees a partial job
+                with open(jobFile + '.tmp', 'w') as f:
+                    json.dump({'args': modelArgs}, f)
+                os.rename(jobFile + '.tmp', jobFile)
+
+                position = 0
+                polls = 0
+                while True:
+                    done = os.path.exists(doneFile)
+                    position = self.readLog(logFile, position, lineCallback)
+                    if done:
+                        break
+                    if abortCallback():
+                        open(os.path.join(self.jobDir, jobId + '.cancel'), 'w').close()
+                        self.stop()
+                        return None
+                    polls += 1
+                    if polls % self.livenessPolls == 0 and not self.isRunning() and not os.path.exists(doneFile):
+                        print('Warm session {} stopped before the job was done'.format(self.containerName))
+                        self.stop()
+                        return -1
+                    sleep(pollInterval)
+                with open(doneFile) as f:
+                    returnCode = int(f.read().strip() or 0)
+                for path in (logFile, doneFile):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return returnCode
+            finally:
+                if self.started:
+                    self.startIdleTimer()
+
+    def readLog(self, logFile, position, lineCallback):
+        if not os.path.exists(logFile):
+            return position
+        with open(logFile) as f:
+            f.seek(position)
+            while True:
+                line = f.readline()
+                # only forward complete lines
+                if not line.endswith('\n'):
+                    break
+                position = f.tell()
+                lineCallback(line)
+        return position
+
+    def startIdleTimer(self):
+        if self.idleTimeout:
+            self.idleTimer = threading.Timer(self.idleTimeout, self.onIdleTimeout)
+            self.idleTimer.daemon = True
+            self.idleTimer.start()
+
+    def cancelIdleTimer(self):
+        if self.idleTimer:
+            self.idleTimer.cancel()
+            self.idleTimer = None
+
+    def onIdleTimeout(self):
+        print('Stopping idle warm session {}'.format(self.containerName))
+        WarmSessionManager.remove(self)
+        self.stop()
+
+    def stop(self):
+        self.cancelIdleTimer()
+        if self.started:
+            cmd = [self.dockerPath, 'kill', self.containerName]
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p.communicate()
+            self.started = False
+        if self.jobDirLock:
+            self.jobDirLock.close()
+            self.jobDirLock = None
+        shutil.rmtree(self.jobDir, ignore_errors=True)
+
+
+class WarmSessionManager(object):
+    """ Keeps one warm session per model image. Sessions outlive the DeepInferLogic
+    instances and are stopped on module cleanup or when they have been idle.
+    """
+
+    sessions = dict()
+    lock = threading.Lock()
+    idleTimeout = 600
+
+    @classmethod
+    def get(cls, dockerPath, dockerName, dataPath, scratchRoot=TMP_PATH, resources=None):
+        # the limits and thread settings are fixed when the container starts
+        key = (dockerPath, dockerName, dataPath, scratchRoot, json.dumps(resources or {}, sort_keys=True))
+        with cls.lock:
+            if key not in cls.sessions:
+                cls.sessions[key] = WarmSession(dockerPath, dockerName, dataPath, cls.idleTimeout, scratchRoot,
+                                                resources)
+            cls.sessions[key].idleTimeout = cls.idleTimeout
+            return cls.sessions[key]
+
+    @classmethod
+    def remove(cls, session):
+        with cls.lock:
+            for key, value in list(cls.sessions.items()):
+                if value is session:
+                    del cls.sessions[key]
+
+    @classmethod
+    def stopAll(cls):
+        with cls.lock:
+            sessions = list(cls.sessions.values())
+            cls.sessions.clear()
+        for session in sessions:
+            session.stop()
+
+
+#
+# Headless runs
+#
+
+def runHeadless(modelPath, inputs, outputDir, params=None, workers=1, dockerPath=None, reportPath=None,
+                useCache=False, tracePath=None, compressExchange=False, scratchDir=None, sharedMemory=False,
+                resources=None, tuneThreads=False):
+    """ Run a model on files, without widgets, scene nodes or an event loop.
+
+    inputs maps the model inputs to files. One input may be a directory, then the model
+    is run on every file in it and the outputs of each case are written to a sub
+    directory of outputDir named after the file. Returns the run report, which is also
+    written to reportPath, by default report.json in outputDir. The stage timings can also
+    be written to tracePath in the Chrome trace event format. compressExchange prefers
+    compressed exchange formats, see VolumeExchange. scratchDir and sharedMemory choose
+    where the exchange files are written, see ScratchSpace. resources replaces the resources
+    of the model and tuneThreads finds its fastest thread count, see ContainerResources and
+    ThreadTuner. modelPath may also describe a Pipeline, then params are given as stage.parameter.
+    """
+    import uuid
+    with open(modelPath) as f:
+        json_dict = json.load(f, object_pairs_hook=OrderedDict)
+    pipeline = None
+    if Pipeline.isPipeline(json_dict):
+        pipeline = Pipeline(json_dict, os.path.dirname(os.path.abspath(modelPath)))
+    directories = [item for item in inputs if os.path.isdir(inputs[item])]
+    if len(directories) > 1:
+        raise ValueError('Only one input can be a directory, got {}'.format(', '.join(directories)))
+    cases = [(None, dict(inputs))]
+    if directories:
+        item = directories[0]
+        cases = []
+        for fileName in sorted(os.listdir(inputs[item])):
+            path = os.path.join(inputs[item], fileName)
+            if fileName.startswith('.') or not os.path.isfile(path):
+                continue
+            caseInputs = dict(inputs)
+            caseInputs[item] = path
+            cases.append((fileName[:-len(DeepInferLogic.fileExtension(fileName))], caseInputs))
+
+    logic = DeepInferLogic()
+    logic.headless = True
+    logic.maxConcurrentJobs = workers
+    if dockerPath:
+        logic.setDockerPath(dockerPath)
+    logic.resultCache = ResultCache() if useCache else None
+    logic.compressExchange = compressExchange
+    logic.scratch = ScratchSpace(scratchDir, sharedMemory)
+    logic.resourceOverrides = dict(resources or {})
+    logic.threadTuner = ThreadTuner() if tuneThreads else None
+    jobs = []
+    for caseName, caseInputs in cases:
+        caseDir = os.path.join(outputDir, caseName) if caseName else outputDir
+        if pipeline:
+            outputs = dict([(item, os.path.join(caseDir, item + pipeline.outputExtension(*reference.split('.', 1))))
+                            for item, reference in pipeline.outputs.items()])
+            workDir = os.path.join(logic.scratch.root, 'pipeline-' + uuid.uuid4().hex)
+            jobs.extend(pipeline.createJobs(caseInputs, outputs, workDir, params, caseName or pipeline.name))
+            continue
+        outputs = dict()
+        for member in json_dict["members"]:
+            if member.get("iotype") == "output":
+                extension = '.fcsv' if member.get("type") == "point_vec" else '.nrrd'
+                outputs[member["name"]] = os.path.join(caseDir, member["name"] + extension)
+        jobs.append(DeepInferJob.fromModelDescription(json_dict, caseInputs, outputs, params,
+                                                      caseName or json_dict.get("name")))
+    logic.runBatch(jobs)
+    try:
+        logic.wait()
+    except KeyboardInterrupt:
+        logic.abort = True
+        logic.wait()
+
+    report = {'model': json_dict.get('name'),
+              'docker': logic.dockerPath,
+              'workers': workers,
+              'wall_time_s': time() - logic.batchStartTime,
+              'jobs_per_minute': logic.throughput(),
+              'jobs': [{'name': job.name,
+                        'status': job.status,
+                        'cached': job.cached,
+                        'exchange_format': job.exchangeFormat,
+                        'scratch': job.scratchRoot,
+                        'resources': job.resources,
+                        'inputs': job.inputs,
+                        'outputs': job.outputs,
+                        'params': dict([(key, str(value)) for key, value in job.params.items()]),
+                        'duration_s': job.duration(),
+                        'timings_s': job.timings,
+                        'stage_times_s': job.stageTimes()} for job in jobs],
+              'timing_summary': logic.trace.summary()}
+    reportPath = reportPath or os.path.join(outputDir, 'report.json')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(reportPath))):
+        os.makedirs(os.path.dirname(os.path.abspath(reportPath)))
+    with open(reportPath, 'w') as f:
+        json.dump(report, f, indent=2)
+    if tracePath:
+        logic.trace.writeChromeTrace(tracePath)
+    return report
+
+
+def main(argv):
+    """Command line entry point, for example
+
+        Slicer --no-main-window --python-script DeepInfer.py --model model.json \\
+            --input InputVolume=cases/ --output-dir results --workers 4
+
+    or, to provision a workstation with the models of a site list, see SitePrePull,
+
+        Slicer --no-main-window --python-script DeepInfer.py --pull-site-list site.json
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a DeepInfer model on files')
+    parser.add_argument('--model', help='model or pipeline description, a json file or the name of a downloaded model')
+    parser.add_argument('--input', action='append', default=[], metavar='NAME=PATH',
+                        help='file or directory for a model input, repeat for every input')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a model parameter, stage.NAME=VALUE for pipelines')
+    parser.add_argument('--output-dir')
+    parser.add_argument('--workers', type=int, default=1, help='number of containers to run at once')
+    parser.add_argument('--docker', help='docker executable')
+    parser.add_argument('--report', help='where to write the json run report')
+    parser.add_argument('--cache', action='store_true', help='reuse and store results in the result cache')
+    parser.add_argument('--trace', help='write the stage timings in the Chrome trace event format')
+    parser.add_argument('--compress-exchange', action='store_true',
+                        help='prefer compressed exchange files, for slow or network disks')
+    parser.add_argument('--scratch', help='directory for the exchange files, e.g. on a local disk')
+    parser.add_argument('--shared-memory', action='store_true',
+                        help='write the exchange files of jobs that fit into memory to /dev/shm')
+    parser.add_argument('--cpus', type=float, help='CPU cores of each container, replaces the model setting')
+    parser.add_argument('--memory', help='memory limit of each container, e.g. 8g')
+    parser.add_argument('--threads', type=int, help='threads of the numeric libraries in each container')
+    parser.add_argument('--tune-threads', action='store_true',
+                        help='find the fastest thread count of the model on this host and use it')
+    parser.add_argument('--pull-site-list', metavar='PATH',
+                        help='instead of running a model, pull the missing models of a site list, e.g. from cron')
+    parser.add_argument('--pulls', type=int, default=2, help='number of images pulled at once')
+    parser.add_argument('--pull-bandwidth', type=float, default=0, help='bandwidth limit of the pulls in MB/s')
+    args = parser.parse_args(argv)
+
+    if args.pull_site_list:
+        pullManager = PullManager(DockerState.get(args.docker or DeepInferLogic().dockerPath), args.pulls,
+                                  int(args.pull_bandwidth * 1024 ** 2))
+        tasks = SitePrePull(args.pull_site_list, pullManager).check(anyTime=True)
+        pullManager.wait()
+        failed = [task.reference() for task in tasks if task.status != 'completed']
+        print("{} of {} models pulled".format(len(tasks) - len(failed), len(tasks)))
+        if failed:
+            print("Failed: {}".format(', '.join(failed)))
+        return 1 if failed else 0
+    if not args.model or not args.output_dir:
+        parser.error('--model and --output-dir are required')
+
+    modelPath = args.model
+    if not os.path.isfile(modelPath):
+        modelPath = os.path.join(JSON_LOCAL_DIR, args.model if args.model.endswith('.json') else args.model + '.json')
+
+    def pairs(values):
+        result = dict()
+        for value in values:
+            name, separator, value = value.partition('=')
+            if not separator:
+                parser.error('expected NAME=VALUE, got {}'.format(name))
+            result[name] = value
+        return result
+
+    resources = dict([(name, value) for name, value in (('cpus', args.cpus), ('memory', args.memory),
+                                                        ('threads', args.threads)) if value])
+    report = runHeadless(modelPath, pairs(args.input), args.output_dir, pairs(args.param), args.workers,
+                         args.docker, args.report, args.cache, args.trace, args.compress_exchange, args.scratch,
+                         args.shared_memory, resources, args.tune_threads)
+    failed = [job['name'] for job in report['jobs'] if job['status'] != 'completed']
+    print("{} of {} cases completed in {:.1f} s".format(len(report['jobs']) - len(failed), len(report['jobs']),
+                                                      report['wall_time_s']))
+    if failed:
+        print("Failed: {}".format(', '.join(failed)))
+    return 1 if failed else 0
 
 
 #
@@ -930,6 +4748,14 @@ class ModelParameters(object):
         self.dockerImageName = ''
         self.modelName = None
         self.dataPath = None
+        self.warmSession = False
+        self.resources = dict()
+        self.digest = ''
+        self.tiling = dict()
+        self.exchangeFormats = ['nrrd']
+        self.preprocessing = dict()
+        # node ID -> (node MTime, RAS to IJK matrix), see rasToIJK
+        self.rasToIJKCache = dict()
 
         self.outputSelector = None
         self.outputLabelMapBox = None
@@ -957,14 +4783,49 @@ class ModelParameters(object):
 
                 else:
                     iodict[member["name"]] = {"type": member["type"], "iotype": member["iotype"]}
+                    if "voltype" in member:
+                        iodict[member["name"]]["voltype"] = member["voltype"]
         return iodict
 
+    @staticmethod
+    def parseParameter(memberType, value):
+        """A parameter value as the widgets store it: bools as 0 or 1, numbers as int or float"""
+        if memberType == 'bool':
+            text = str(value).lower()
+            if text in ('1', 'true', 'yes', 'on'):
+                return 1
+            if text in ('0', 'false', 'no', 'off'):
+                return 0
+            raise ValueError('{} is not a boolean'.format(value))
+        if not isinstance(value, str):
+            return value
+        if memberType in ("uint8_t", "int8_t", "uint16_t", "int16_t", "uint32_t", "int32_t",
+                          "uint64_t", "int64_t", "unsigned int", "int"):
+            return int(value)
+        if memberType in ("double", "float"):
+            return float(value)
+        return value
+
     def create_model_info(self, json_dict):
         dockerImageName = json_dict['docker']['dockerhub_repository']
         modelName = json_dict.get('model_name')
         dataPath = json_dict.get('data_path')
         return dockerImageName, modelName, dataPath
 
+    def load(self, json_dict):
+        """Read the model information that does not need widgets"""
+        self.iodict = self.create_iodict(json_dict)
+        self.dockerImageName, self.modelName, self.dataPath = self.create_model_info(json_dict)
+        self.warmSession = bool(json_dict['docker'].get('warm_session', False))
+        self.resources = dict(json_dict.get('resources', {}))
+        self.digest = json_dict['docker'].get('digest', '')
+        # e.g. {"tile_size": [128, 128, 64], "overlap": 16, "parallel": 2}, see VolumeTiling
+        self.tiling = dict(json_dict.get('tiling', {}))
+        # e.g. ["npy", "nrrd-gzip", "nrrd"], see VolumeExchange.FORMATS
+        self.exchangeFormats = list(json_dict.get('exchange_formats', ['nrrd']))
+        # e.g. {"spacing": [0.5, 0.5, 3.0], "roi": "InputROI", "margin": 10}, see VolumePreprocessing
+        self.preprocessing = dict(json_dict.get('preprocessing', {}))
+
     def create(self, json_dict):
         if not self.parent:
             raise "no parent"
@@ -973,8 +4834,7 @@ class ModelParameters(object):
         # You can't use exec in a function that has a subfunction, unless you specify a context.
         # exec ('self.model = sitk.{0}()'.format(json["name"])) in globals(), locals()
 
-        self.iodict = self.create_iodict(json_dict)
-        self.dockerImageName, self.modelName, self.dataPath = self.create_model_info(json_dict)
+        self.load(json_dict)
 
         self.prerun_callbacks = []
         self.inputs = dict()
@@ -1075,6 +4935,25 @@ class ModelParameters(object):
                              member["iotype"]))
                 w = fiducialSelector
 
+            elif t == "roi":
+                # region the inputs are cropped to, see VolumePreprocessing
+                roiSelector = slicer.qMRMLNodeComboBox()
+                self.widgets.append(roiSelector)
+                roiSelector.nodeTypes = ("vtkMRMLMarkupsROINode", "vtkMRMLAnnotationROINode")
+                roiSelector.selectNodeUponCreation = True
+                roiSelector.addEnabled = True
+                roiSelector.removeEnabled = False
+                roiSelector.renameEnabled = True
+                roiSelector.noneEnabled = False
+                roiSelector.showHidden = False
+                roiSelector.showChildNodeTypes = False
+                roiSelector.setMRMLScene(slicer.mrmlScene)
+                roiSelector.setToolTip("Pick the ROI the inputs are cropped to.")
+                roiSelector.connect("currentNodeChanged(vtkMRMLNode*)",
+                                    lambda node, name=member["name"]: self.onVolumeSelect(node, name, "input"))
+                self.inputs[member["name"]] = roiSelector.currentNode()
+                w = roiSelector
+
             elif "enum" in member:
                 w = self.createEnumWidget(member["name"], member["enum"])
 
@@ -1340,15 +5219,42 @@ class ModelParameters(object):
         else:
             annotationFiducialNode.GetFiducialCoordinates(coord)
 
-        # HACK transform from RAS to LPS
-        coord = [-coord[0], -coord[1], coord[2]]
-
-        # FIXME: we should not need to copy the image
-        if not isPoint and len(self.inputs) and self.inputs[0]:
-            imgNodeName = self.inputs[0].GetName()
-            img = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(imgNodeName))
-            coord = img.TransformPhysicalPointToIndex(coord)
+        referenceNode = self.referenceVolume()
+        if not isPoint and referenceNode:
+            # only the geometry of the image is needed, not its voxels
+            coord = tuple(self.pointsToIndex(referenceNode, [coord])[0])
             # exec ('self.model.Set{0}(coord)'.format(name))
+        else:
+            # HACK transform from RAS to LPS
+            coord = [-coord[0], -coord[1], coord[2]]
+
+    def referenceVolume(self):
+        """The first input volume, whose voxel grid point parameters refer to"""
+        for node in self.inputs.values():
+            if node and not isinstance(node, str) and node.IsA('vtkMRMLVolumeNode'):
+                return node
+        return None
+
+    def rasToIJK(self, volumeNode):
+        """RAS to IJK matrix of a volume node as a numpy array, cached until the node is modified"""
+        import numpy as np
+        import vtk
+        cached = self.rasToIJKCache.get(volumeNode.GetID())
+        if cached and cached[0] == volumeNode.GetMTime():
+            return cached[1]
+        rasToIJK = vtk.vtkMatrix4x4()
+        volumeNode.GetRASToIJKMatrix(rasToIJK)
+        matrix = np.array([[rasToIJK.GetElement(row, col) for col in range(4)] for row in range(4)])
+        self.rasToIJKCache[volumeNode.GetID()] = (volumeNode.GetMTime(), matrix)
+        return matrix
+
+    def pointsToIndex(self, volumeNode, points):
+        """Nearest voxel indices (i, j, k) of a list of RAS points, as an N x 3 integer array"""
+        import numpy as np
+        matrix = self.rasToIJK(volumeNode)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        # rounded like itk::Image::TransformPhysicalPointToIndex
+        return np.floor(points.dot(matrix[:3, :3].T) + matrix[:3, 3] + 0.5).astype(int)
 
     def onFiducialListNode(self, name, mrmlNode, io):
         self.params[name] = mrmlNode
@@ -1386,14 +5292,8 @@ class ModelParameters(object):
                 annotation.GetFiducialCoordinates(coord)
                 coords.append(coord)
 
-        if self.inputs[0]:
-            imgNodeName = self.inputs[0].GetName()
-            img = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(imgNodeName))
-
-            # HACK transform from RAS to LPS
-            coords = [[-pt[0], -pt[1], pt[2]] for pt in coords]
-
-            idx_coords = [img.TransformPhysicalPointToIndex(pt) for pt in coords]
+        if self.referenceVolume():
+            idx_coords = self.pointsToIndex(self.referenceVolume(), coords)
 
             # exec ('self.model.Set{0}(idx_coords)'.format(name))
         '''
@@ -1428,8 +5328,1353 @@ class ModelParameters(object):
         self.iodict = dict()
         self.inputs = dict()
         self.outputs = dict()
+        self.rasToIJKCache = dict()
         for w in self.widgets:
             # self.parent.layout().removeWidget(w)
             w.deleteLater()
             w.setParent(None)
         self.widgets = []
+
+
+#
+# DeepInferTest
+#
+
+class DeepInferTest(unittest.TestCase):
+    """
+    Headless tests for DeepInferLogic. A fake docker executable stands in
+    for the docker client, so no docker installation is needed.
+    """
+
+    # The fake client understands "ps", "run", "inspect" and "kill". For "run"
+    # it resolves the bind mounts, prints a few lines and copies the first
+    # existing input to every output argument. With "-d" it starts a stand-in
+    # warm session container that serves jobs from its job directory.
+    FAKE_DOCKER = r'''
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+VALUE_OPTIONS = ['-v', '-e', '--name', '--cpus', '--memory', '--cpuset-cpus']
+STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'containers')
+
+
+def parse_run(args):
+    mounts = []
+    options = dict()
+    i = 0
+    while args[i].startswith('-'):
+        if args[i] in VALUE_OPTIONS:
+            if args[i] == '-v':
+                host, container = args[i + 1].rsplit(':', 1)
+                mounts.append((container, host))
+            elif args[i] == '-e':
+                name, _, value = args[i + 1].partition('=')
+                os.environ[name] = value
+            options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            options[args[i]] = True
+            i += 1
+    return mounts, options, args[i], args[i + 1:]
+
+
+def to_host(path, mounts):
+    for container, host in mounts:
+        if path.startswith(container + '/'):
+            return host + path[len(container):]
+    return path
+
+
+def run_model(model_args, mounts, out):
+    pairs = list(zip(model_args[::2], model_args[1::2]))
+    paths = [to_host(value, mounts) for key, value in pairs]
+    inputs = [path for path in paths if os.path.isfile(path)]
+    delay = float(os.environ.get('FAKE_DOCKER_DELAY', '0.5'))
+    if 'FAKE_DOCKER_BEST_THREADS' in os.environ:
+        # slower the further the thread count is from the best one
+        delay *= 1 + abs(int(os.environ.get('OMP_NUM_THREADS', 0)) - int(os.environ['FAKE_DOCKER_BEST_THREADS']))
+    for step in range(5):
+        out.write('step {} of {}\n'.format(step + 1, 5))
+        stage = 'preprocessing' if step == 0 else 'inference'
+        out.write('DEEPINFER_PROGRESS {}\n'.format(json.dumps({'stage': stage, 'fraction': step / 5.0})))
+        out.flush()
+        time.sleep(delay / 5)
+    for path in paths:
+        if path not in inputs and os.path.isdir(os.path.dirname(path)):
+            if os.environ.get('FAKE_DOCKER_OUTPUT') == 'label':
+                write_label(inputs[0], path)
+            else:
+                shutil.copy(inputs[0], path)
+    return 0
+
+
+def write_label(source, path):
+    # synthetic segmentation: the voxels of the input above zero
+    import numpy as np
+    with open(source, 'rb') as f:
+        header, _, data = f.read().partition(b'\n\n')
+    fields = dict(line.split(b': ', 1) for line in header.split(b'\n')[1:] if b': ' in line)
+    dtypes = {b'short': 'i2', b'unsigned short': 'u2', b'signed char': 'i1', b'unsigned char': 'u1',
+              b'int': 'i4', b'float': 'f4', b'double': 'f8'}
+    endian = '<' if fields.get(b'endian', b'little') == b'little' else '>'
+    label = (np.frombuffer(data, endian + dtypes[fields[b'type']]) > 0).astype(np.uint8)
+    lines = [line for line in header.split(b'\n') if not line.startswith((b'type:', b'endian:'))]
+    lines.insert(1, b'type: unsigned char')
+    with open(path, 'wb') as f:
+        f.write(b'\n'.join(lines) + b'\n\n')
+        f.write(label.tobytes())
+
+
+def serve(job_dir, mounts):
+    # stand-in for a warm session container
+    while os.path.isdir(job_dir) and not os.path.exists(os.path.join(job_dir, 'stop')):
+        for name in sorted(os.listdir(job_dir)):
+            if not name.endswith('.json'):
+                continue
+            job_id = name[:-len('.json')]
+            with open(os.path.join(job_dir, name)) as f:
+                job = json.load(f)
+            os.remove(os.path.join(job_dir, name))
+            with open(os.path.join(job_dir, job_id + '.log'), 'w') as out:
+                code = run_model(job['args'], mounts, out)
+            if not os.path.isdir(job_dir):
+                # killed while the job ran
+                break
+            with open(os.path.join(job_dir, job_id + '.done'), 'w') as f:
+                f.write(str(code))
+        time.sleep(0.05)
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def main(args):
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    if args[0] == 'ps':
+        print('CONTAINER ID        IMAGE')
+        return 0
+    if args[0] == 'images':
+        images = os.environ.get('FAKE_DOCKER_IMAGES', 'deepinfer/fake:latest@<none>').split(',')
+        if os.path.exists(os.path.join(STATE_DIR, 'images')):
+            with open(os.path.join(STATE_DIR, 'images')) as f:
+                images.extend(f.read().split())
+        for image in images:
+            repository, tag, digest = re.split('[:@]', image, 2)
+            print('\t'.join((repository, tag, digest)))
+        return 0
+    if args[0] == 'pull':
+        # layer status lines as printed without a terminal
+        repository, _, digest = args[-1].partition('@')
+        print('{}: Pulling from {}'.format(digest or 'latest', repository))
+        layers = ['{:012x}'.format(index) for index in range(3)]
+        for status in ('Pulling fs layer', 'Download complete', 'Pull complete'):
+            for layer in layers:
+                print('{}: {}'.format(layer, status))
+                sys.stdout.flush()
+                time.sleep(float(os.environ.get('FAKE_DOCKER_PULL_DELAY', '0.05')))
+        print('Digest: {}'.format(digest))
+        with open(os.path.join(STATE_DIR, 'images'), 'a') as f:
+            f.write('{}:latest@{}\n'.format(repository, digest or '<none>'))
+        return 0
+    if args[0] == 'serve':
+        serve(args[1], json.loads(args[2]))
+        return 0
+    if args[0] == 'inspect':
+        if os.path.exists(os.path.join(STATE_DIR, args[-1])):
+            print('true')
+            return 0
+        return 1
+    if args[0] == 'kill':
+        state = os.path.join(STATE_DIR, args[-1])
+        if not os.path.exists(state):
+            return 1
+        with open(state) as f:
+            job_dir = f.read()
+        os.remove(state)
+        with open(os.path.join(STATE_DIR, 'killed'), 'a') as f:
+            f.write(args[-1] + '\n')
+        if job_dir.startswith('pid:'):
+            # a container started by run, the fake client is the container
+            os.kill(int(job_dir[len('pid:'):]), signal.SIGTERM)
+            return 0
+        if job_dir and os.path.isdir(job_dir):
+            open(os.path.join(job_dir, 'stop'), 'w').close()
+        return 0
+    if args[0] == 'run':
+        mounts, options, image, model_args = parse_run(args[1:])
+        if '-d' in options:
+            job_dir = to_host(model_args[model_args.index('--WarmJobDir') + 1], mounts)
+            with open(os.path.join(STATE_DIR, options['--name']), 'w') as f:
+                f.write(job_dir)
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', job_dir, json.dumps(mounts)])
+            print(options['--name'])
+            return 0
+        if '--name' in options:
+            with open(os.path.join(STATE_DIR, options['--name']), 'w') as f:
+                f.write('pid:{}'.format(os.getpid()))
+            with open(os.path.join(STATE_DIR, 'runs'), 'a') as f:
+                f.write('{} {}\n'.format(options['--name'], os.environ.get('OMP_NUM_THREADS', '-')))
+        try:
+            return run_model(model_args, mounts, sys.stdout)
+        finally:
+            if '--name' in options and os.path.exists(os.path.join(STATE_DIR, options['--name'])):
+                os.remove(os.path.join(STATE_DIR, options['--name']))
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+'''
+
+    def setUp(self):
+        slicer.mrmlScene.Clear(0)
+
+    def runTest(self):
+        self.setUp()
+        self.test_AsyncRun()
+        self.setUp()
+        self.test_WarmSession()
+        self.setUp()
+        self.test_Batch()
+        self.setUp()
+        self.test_ConcurrentJobs()
+        self.setUp()
+        self.test_ResultCache()
+        self.test_RegistrySync()
+        self.test_ModelCatalog()
+        self.setUp()
+        self.test_ProgressRecords()
+        self.test_MainQueueWakeup()
+        self.setUp()
+        self.test_TiledInference()
+        self.setUp()
+        self.test_Headless()
+        self.setUp()
+        self.test_RunTrace()
+        self.test_DockerState()
+        self.setUp()
+        self.test_FiducialIndex()
+        self.setUp()
+        self.test_ExchangeFormats()
+        self.setUp()
+        self.test_ScratchSpace()
+        self.setUp()
+        self.test_CancelJobs()
+        self.setUp()
+        self.test_DaemonFailure()
+        self.setUp()
+        self.test_Pipeline()
+        self.setUp()
+        self.test_ContainerResources()
+        self.test_PullManager()
+        self.setUp()
+        self.test_Preprocessing()
+        self.setUp()
+        self.test_SceneUpdates()
+
+    def writeFakeDocker(self):
+        import sys
+        import tempfile
+        tempDir = tempfile.mkdtemp()
+        scriptPath = os.path.join(tempDir, 'fake_docker.py')
+        with open(scriptPath, 'w') as f:
+            f.write(self.FAKE_DOCKER)
+        dockerPath = os.path.join(tempDir, 'docker')
+        with open(dockerPath, 'w') as f:
+            f.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable, scriptPath))
+        os.chmod(dockerPath, 0o755)
+        return dockerPath
+
+    def createVolume(self, name, dimensions=(32, 32, 16)):
+        import vtk
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(*dimensions)
+        imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+        imageData.GetPointData().GetScalars().Fill(7)
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+        volumeNode.SetAndObserveImageData(imageData)
+        volumeNode.SetSpacing(0.5, 0.5, 2.0)
+        volumeNode.CreateDefaultDisplayNodes()
+        return volumeNode
+
+    def createModelParameters(self, inputNode, outputNode):
+        modelParameters = ModelParameters()
+        modelParameters.iodict = {'InputVolume': {'type': 'volume', 'iotype': 'input'},
+                                  'OutputLabel': {'type': 'volume', 'iotype': 'output'}}
+        modelParameters.inputs = {'InputVolume': inputNode}
+        modelParameters.outputs = {'OutputLabel': outputNode}
+        modelParameters.params = dict()
+        modelParameters.dockerImageName = 'deepinfer/fake'
+        return modelParameters
+
+    def waitForLogic(self, logic, timeout=30):
+        import time
+        frameTimes = []
+        start = time.time()
+        while logic.main_queue_running:
+            self.assertLess(time.time() - start, timeout, "Timed out waiting for the model to finish")
+            running = bool(logic.runningJobs)
+            frameStart = time.time()
+            slicer.app.processEvents()
+            if running:
+                frameTimes.append(time.time() - frameStart)
+        return frameTimes
+
+    def test_AsyncRun(self):
+        """Run a model with the fake client and check that the main thread is not blocked"""
+        inputNode = self.createVolume('Input')
+        outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.run(self.createModelParameters(inputNode, outputNode))
+        # run returns while the container is still executing
+        self.assertTrue(logic.runningJobs)
+        self.assertTrue(logic.isRunning())
+        frameTimes = self.waitForLogic(logic)
+        self.assertFalse(logic.abort)
+        # the 16 ms frame budget, the 95th percentile leaves room for scheduling jitter
+        # of the host and for the frames that export and import the volumes
+        frameTimes = sorted(frameTimes)
+        self.assertLess(frameTimes[int(0.95 * (len(frameTimes) - 1))], 0.016)
+        # the container runs for 0.5 s, a main thread waiting for it would show one long frame
+        self.assertLess(frameTimes[-1], 0.25)
+        self.assertEqual(outputNode.GetImageData().GetDimensions(), inputNode.GetImageData().GetDimensions())
+
+    def test_WarmSession(self):
+        """Run two jobs through one warm session container and stop it"""
+        inputNode = self.createVolume('Input')
+        dockerPath = self.writeFakeDocker()
+        containerNames = set()
+        for run in range(2):
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output{}'.format(run))
+            modelParameters = self.createModelParameters(inputNode, outputNode)
+            modelParameters.warmSession = True
+            logic = DeepInferLogic()
+            logic.setDockerPath(dockerPath)
+            logic.useWarmSession = True
+            logic.run(modelParameters)
+            self.waitForLogic(logic)
+            self.assertFalse(logic.abort)
+            self.assertEqual(outputNode.GetImageData().GetDimensions(), inputNode.GetImageData().GetDimensions())
+            session = WarmSessionManager.get(dockerPath, modelParameters.dockerImageName, '/home/deepinfer/data')
+            self.assertTrue(session.isRunning())
+            containerNames.add(session.containerName)
+        # both runs were served by the same container
+        self.assertEqual(len(containerNames), 1)
+        WarmSessionManager.stopAll()
+        self.assertFalse(session.isRunning())
+        # a job neither waits for a container that died nor keeps one that was aborted running
+        import tempfile
+        scratchRoot = tempfile.mkdtemp()
+        session = WarmSession(dockerPath, modelParameters.dockerImageName, '/home/deepinfer/data', 0, scratchRoot)
+        os.environ['FAKE_DOCKER_DELAY'] = '5'
+        try:
+            start = time()
+            killer = threading.Timer(0.5, lambda: subprocess.call([dockerPath, 'kill', session.containerName]))
+            killer.start()
+            self.assertEqual(session.submit([], lambda line: None, lambda: False), -1)
+            self.assertFalse(session.isRunning())
+            self.assertEqual(session.submit([], lambda line: None, lambda: time() - start > 3), None)
+            self.assertFalse(session.isRunning())
+            self.assertLess(time() - start, 5)
+        finally:
+            del os.environ['FAKE_DOCKER_DELAY']
+            session.stop()
+            shutil.rmtree(scratchRoot, ignore_errors=True)
+
+    def test_Batch(self):
+        """Run one model over several volumes in a single batch"""
+        modelParameters = self.createModelParameters(None, None)
+        jobs = []
+        for index in range(3):
+            inputNode = self.createVolume('Input{}'.format(index), (16 + index, 16, 8))
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output{}'.format(index))
+            jobs.append(DeepInferJob.fromModelParameters(modelParameters, {'InputVolume': inputNode},
+                                                         {'OutputLabel': outputNode}))
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.runBatch(jobs)
+        self.waitForLogic(logic)
+        self.assertEqual([job.status for job in jobs], ['completed'] * 3)
+        for job in jobs:
+            self.assertEqual(job.outputs['OutputLabel'].GetImageData().GetDimensions(),
+                             job.inputs['InputVolume'].GetImageData().GetDimensions())
+            # job directories are removed once the results are imported
+            self.assertFalse(os.path.exists(job.workDir))
+        self.assertGreater(logic.throughput(), 0)
+
+    def createJobs(self, count):
+        modelParameters = self.createModelParameters(None, None)
+        jobs = []
+        for index in range(count):
+            inputNode = self.createVolume('Input{}'.format(index))
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output{}'.format(index))
+            jobs.append(DeepInferJob.fromModelParameters(modelParameters, {'InputVolume': inputNode},
+                                                         {'OutputLabel': outputNode}))
+        return jobs
+
+    def test_ConcurrentJobs(self):
+        """Run jobs two at a time in separate directories and cancel one of them"""
+        jobs = self.createJobs(5)
+        for job in jobs:
+            job.resources['cpus'] = 0.5
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.maxConcurrentJobs = 2
+        logic.runBatch(jobs)
+        logic.cancelJob(jobs[-1])
+        self.waitForLogic(logic)
+        self.assertEqual([job.status for job in jobs], ['completed'] * 4 + ['aborted'])
+        self.assertEqual(len(set([job.workDir for job in jobs[:4]])), 4)
+        # the first two jobs ran at the same time
+        self.assertLess(jobs[1].startTime, jobs[0].endTime)
+
+    def test_ResultCache(self):
+        """A second run on the same inputs is served from the cache without starting a container"""
+        import tempfile
+        cache = ResultCache(tempfile.mkdtemp())
+        inputNode = self.createVolume('Input')
+        modelParameters = self.createModelParameters(inputNode, None)
+        modelParameters.digest = 'sha256:0123'
+        jobs = []
+        for dockerPath in (self.writeFakeDocker(), '/nonexistent/docker'):
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+            job = DeepInferJob.fromModelParameters(modelParameters, outputs={'OutputLabel': outputNode})
+            logic = DeepInferLogic()
+            logic.setDockerPath(dockerPath)
+            logic.resultCache = cache
+            logic.runBatch([job])
+            self.waitForLogic(logic)
+            self.assertEqual(job.status, 'completed')
+            self.assertEqual(outputNode.GetImageData().GetDimensions(), inputNode.GetImageData().GetDimensions())
+            jobs.append(job)
+        self.assertFalse(jobs[0].cached)
+        self.assertTrue(jobs[1].cached)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # hits link the outputs instead of copying them
+        workDir = tempfile.mkdtemp()
+        fileNames = cache.index['entries'][jobs[1].cacheKey]['files']
+        self.assertTrue(cache.lookup(jobs[1].cacheKey, workDir, fileNames))
+        for name in fileNames:
+            self.assertTrue(os.path.samefile(os.path.join(workDir, name),
+                                             os.path.join(cache.cacheDir, jobs[1].cacheKey, name)))
+        shutil.rmtree(workDir)
+        # changing a voxel changes the key
+        slicer.util.arrayFromVolume(inputNode)[0, 0, 0] += 1
+        self.assertNotEqual(cache.computeKey(jobs[0]), jobs[0].cacheKey)
+        cache.maxSize = 0
+        cache.evict()
+        self.assertEqual(cache.size(), 0)
+
+    def startRegistryServer(self, files):
+        """Serve a GitHub contents style listing of files from a local HTTP server"""
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                requests.append(self.path)
+                port = self.server.server_address[1]
+                if self.path == '/contents/':
+                    listing = [{'name': name, 'sha': RegistrySync.blobShaOfContent(content),
+                                'download_url': 'http://127.0.0.1:{}/raw/{}'.format(port, name)}
+                               for name, content in sorted(files.items())]
+                    body = json.dumps(listing).encode('utf-8')
+                    etag = '"{}"'.format(RegistrySync.blobShaOfContent(body))
+                    if self.headers.get('If-None-Match') == etag:
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header('ETag', etag)
+                else:
+                    body = files[self.path[len('/raw/'):]]
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{}/contents/'.format(server.server_address[1]), requests
+
+    def test_RegistrySync(self):
+        """Only changed registry files are downloaded again"""
+        import tempfile
+        files = {'a.json': b'{"name": "a"}', 'b.json': b'{"name": "b"}'}
+        url, requests = self.startRegistryServer(files)
+        sync = RegistrySync(url, tempfile.mkdtemp())
+        downloaded, unchanged, removed = sync.sync()
+        self.assertEqual(sorted(downloaded), ['a.json', 'b.json'])
+        # unchanged registry: one conditional listing request and no downloads
+        del requests[:]
+        self.assertEqual(sync.sync(), ([], ['a.json', 'b.json'], []))
+        self.assertEqual(requests, ['/contents/'])
+        files['b.json'] = b'{"name": "b", "task": "Segmentation"}'
+        del files['a.json']
+        downloaded, unchanged, removed = sync.sync()
+        self.assertEqual((downloaded, unchanged, removed), (['b.json'], [], ['a.json']))
+        with open(os.path.join(sync.mirrorDir, 'b.json'), 'rb') as f:
+            self.assertEqual(f.read(), files['b.json'])
+
+    def test_ModelCatalog(self):
+        """The catalog parses only changed descriptions and searches names, organs and tasks"""
+        import tempfile
+        jsonDir = tempfile.mkdtemp()
+
+        def writeModel(fileName, name, organ, task):
+            with open(os.path.join(jsonDir, fileName), 'w') as f:
+                json.dump({'name': name, 'organ': organ, 'task': task,
+                           'docker': {'digest': 'sha256:' + fileName}}, f)
+        writeModel('prostate.json', 'Prostate Segmenter', 'Prostate', 'Segmentation')
+        writeModel('brain.json', 'Brain Extraction', 'Brain', 'Segmentation')
+        writeModel('needle.json', 'Needle Finder', 'Prostate', 'Detection')
+        parsed = []
+
+        class CountingCatalog(ModelCatalog):
+            @staticmethod
+            def createEntry(path, stat):
+                parsed.append(os.path.basename(path))
+                return ModelCatalog.createEntry(path, stat)
+
+        catalog = CountingCatalog(jsonDir)
+        self.assertTrue(catalog.update())
+        self.assertEqual(sorted(parsed), ['brain.json', 'needle.json', 'prostate.json'])
+        self.assertEqual(catalog.search(), ['brain.json', 'needle.json', 'prostate.json'])
+        self.assertEqual(catalog.search('pros'), ['needle.json', 'prostate.json'])
+        self.assertEqual(catalog.search('PROS seg'), ['prostate.json'])
+        self.assertEqual(catalog.search('liver'), [])
+        self.assertEqual(catalog.matchedFields('needle.json', 'pros'), ['organ'])
+        self.assertEqual(catalog.highlight('Needle Finder', 'fin'), 'Needle <b>Finder</b>')
+        self.assertEqual(catalog.entries['brain.json']['digest'], 'sha256:brain.json')
+        # a new instance reads the index instead of the descriptions
+        del parsed[:]
+        catalog = CountingCatalog(jsonDir)
+        self.assertFalse(catalog.update())
+        self.assertEqual(parsed, [])
+        self.assertEqual(catalog.search('brain'), ['brain.json'])
+        writeModel('brain.json', 'Brain Extraction', 'Brain', 'Skull Stripping')
+        os.remove(os.path.join(jsonDir, 'needle.json'))
+        self.assertTrue(catalog.update())
+        self.assertEqual(parsed, ['brain.json'])
+        self.assertEqual(catalog.search('skull'), ['brain.json'])
+        self.assertEqual(catalog.search('pros'), ['prostate.json'])
+        self.assertEqual(catalog.load('brain.json')['task'], 'Skull Stripping')
+
+    def test_ProgressRecords(self):
+        """Progress records set the stage, fraction and ETA of a job"""
+        job = DeepInferJob({}, {}, {}, {}, 'deepinfer/fake')
+        job.startTime = 100.0
+        self.assertFalse(job.updateProgress('loading model\n', now=101.0))
+        self.assertTrue(0 < job.progress < 0.95)
+        self.assertTrue(job.updateProgress('DEEPINFER_PROGRESS {"stage": "preprocessing", "fraction": 0.1}\n', now=102.0))
+        self.assertEqual(job.stage(), 'preprocessing')
+        self.assertAlmostEqual(job.progress, 0.1)
+        self.assertAlmostEqual(job.eta, 18.0)
+        # output lines no longer move the bar once the container reports progress
+        job.updateProgress('resampling\n', now=103.0)
+        self.assertAlmostEqual(job.progress, 0.1)
+        job.updateProgress('DEEPINFER_PROGRESS {"stage": "inference", "fraction": 0.5, "eta": 7}\n', now=105.0)
+        self.assertEqual(job.eta, 7.0)
+        job.endTime = 110.0
+        self.assertEqual(job.stageTimes(), [('preprocessing', 3.0), ('inference', 5.0)])
+        self.assertTrue(job.updateProgress('DEEPINFER_PROGRESS not json\n'))
+
+        # the fake model reports its stages
+        inputNode = self.createVolume('Input')
+        outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.run(self.createModelParameters(inputNode, outputNode))
+        job = logic.jobs[0]
+        self.waitForLogic(logic)
+        self.assertEqual([name for name, seconds in job.stageTimes()], ['preprocessing', 'inference'])
+        self.assertAlmostEqual(job.progress, 0.8)
+
+    def test_MainQueueWakeup(self):
+        """The main thread only runs the queue when a worker posts to it"""
+        logic = DeepInferLogic()
+        logic.main_queue_start()
+        slicer.app.processEvents()
+        calls = []
+        process = logic.main_queue_process
+
+        def countingProcess():
+            calls.append(1)
+            process()
+        logic.main_queue_process = countingProcess
+        for i in range(20):
+            slicer.app.processEvents()
+        self.assertEqual(calls, [])
+
+        results = []
+
+        def post():
+            for i in range(250):
+                logic.main_queue_post(lambda i=i: results.append(i))
+        worker = threading.Thread(target=post)
+        worker.start()
+        worker.join()
+        for i in range(100):
+            if len(results) == 250:
+                break
+            slicer.app.processEvents()
+        self.assertEqual(results, list(range(250)))
+        # one wakeup per batch instead of one per callable
+        self.assertLess(len(calls), 10)
+        # the callables queued after a failing one still run without another post
+        del results[:]
+        logic.main_queue_post(lambda: 1 / 0)
+        for i in range(3):
+            logic.main_queue_post(lambda i=i: results.append(i))
+        for i in range(100):
+            if len(results) == 3:
+                break
+            slicer.app.processEvents()
+        self.assertEqual(results, [0, 1, 2])
+        logic.main_queue_stop()
+
+    def test_TiledInference(self):
+        """Tiles of an identity model are stitched back into the input volume"""
+        delay = os.environ.get('FAKE_DOCKER_DELAY')
+        os.environ['FAKE_DOCKER_DELAY'] = '0.05'
+        try:
+            self.runTiledInference()
+        finally:
+            if delay is None:
+                os.environ.pop('FAKE_DOCKER_DELAY')
+            else:
+                os.environ['FAKE_DOCKER_DELAY'] = delay
+        # tiles that would not own a voxel are dropped, so label maps are stitched from all tiles
+        import numpy as np
+
+        class RedundantTiling(VolumeTiling):
+            axisStarts = staticmethod(lambda dim, size, overlap: [0, 0, dim - size] if size < dim else [0])
+        tiling = RedundantTiling((20, 4, 4), (10, 4, 4), 5)
+        self.assertEqual(len(tiling), 2)
+        labels = np.random.randint(0, 5, (4, 4, 20)).astype(np.uint8)
+        stitched = np.zeros_like(labels)
+        for index in range(len(tiling)):
+            tiling.blend(stitched, labels[tiling.region(index)], index)
+        np.testing.assert_array_equal(stitched, labels)
+        # a tile worker waiting for its export is released when main_queue stops
+        logic = DeepInferLogic()
+        job = self.createJobs(1)[0]
+        tile = {'index': 0, 'dir': os.path.join(TMP_PATH, 'tile0'), 'inputs': {}}
+        result = []
+        worker = threading.Thread(target=lambda: result.append(logic.requestTileExport(job, tile)))
+        worker.start()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(result, [False])
+        self.assertFalse(os.path.exists(tile['dir']))
+
+    def runTiledInference(self):
+        import numpy as np
+        import vtk
+        for scalarType in (vtk.VTK_SHORT, vtk.VTK_FLOAT):
+            inputNode = self.createVolume('Input', (40, 36, 20))
+            inputNode.GetImageData().AllocateScalars(scalarType, 1)
+            inputArray = slicer.util.arrayFromVolume(inputNode)
+            inputArray[:] = np.random.RandomState(0).randint(0, 1000, inputArray.shape)
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+            modelParameters = self.createModelParameters(inputNode, outputNode)
+            modelParameters.tiling = {'tile_size': [16, 16, 8], 'overlap': [4, 4, 2], 'parallel': 2}
+            logic = DeepInferLogic()
+            logic.setDockerPath(self.writeFakeDocker())
+            # tiles are written when a worker is free, the tiles of other workers are on disk at most
+            exportTile = logic.exportTile
+            tilesOnDisk = []
+
+            def countingExportTile(job, tile):
+                tilesOnDisk.append(len([name for name in os.listdir(job.workDir) if name.startswith('tile')]))
+                exportTile(job, tile)
+            logic.exportTile = countingExportTile
+            logic.run(modelParameters)
+            job = logic.jobs[0]
+            self.waitForLogic(logic)
+            self.assertEqual(job.status, 'completed')
+            self.assertEqual(len(job.tiles), 3 * 3 * 3)
+            self.assertEqual(len(tilesOnDisk), len(job.tiles))
+            self.assertLess(max(tilesOnDisk), job.tileWorkers)
+            # the scratch space is reserved for those tiles only
+            self.assertLess(sum(ScratchSpace.estimate(job)), inputArray.nbytes)
+            # only one tile per worker has to fit into memory
+            self.assertLess(job.memoryEstimate, 4 * 2 * inputArray.nbytes)
+            outputArray = slicer.util.arrayFromVolume(outputNode)
+            self.assertEqual(outputArray.dtype, inputArray.dtype)
+            if scalarType == vtk.VTK_FLOAT:
+                np.testing.assert_allclose(outputArray, inputArray, rtol=1e-5)
+            else:
+                np.testing.assert_array_equal(outputArray, inputArray)
+            slicer.mrmlScene.Clear(0)
+
+
+    def test_Headless(self):
+        """Run a model description on a directory of files without nodes or an event loop"""
+        import tempfile
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir, True)
+        modelPath = os.path.join(tempDir, 'model.json')
+        with open(modelPath, 'w') as f:
+            json.dump({'name': 'Fake Model', 'docker': {'dockerhub_repository': 'deepinfer/fake'},
+                       'members': [{'name': 'InputVolume', 'type': 'volume', 'iotype': 'input',
+                                    'voltype': 'ScalarVolume'},
+                                   {'name': 'OutputLabel', 'type': 'volume', 'iotype': 'output',
+                                    'voltype': 'LabelMap'},
+                                   {'name': 'Threshold', 'type': 'float', 'iotype': 'parameter',
+                                    'default': 0.5},
+                                   {'name': 'Smooth', 'type': 'bool', 'iotype': 'parameter',
+                                    'default': 'true'}]}, f)
+        inputDir = os.path.join(tempDir, 'cases')
+        os.mkdir(inputDir)
+        exchange = VolumeExchange()
+        for index in range(3):
+            exchange.write(self.createVolume('Case{}'.format(index)), os.path.join(inputDir, 'case{}.nrrd'.format(index)))
+        slicer.mrmlScene.Clear(0)
+        outputDir = os.path.join(tempDir, 'results')
+        with self.assertRaises(ValueError):
+            runHeadless(modelPath, {}, outputDir, dockerPath=self.writeFakeDocker())
+        report = runHeadless(modelPath, {'InputVolume': inputDir}, outputDir, {'Threshold': '0.7'}, workers=2,
+                             dockerPath=self.writeFakeDocker())
+        self.assertEqual([job['status'] for job in report['jobs']], ['completed'] * 3)
+        self.assertEqual([job['params'] for job in report['jobs']], [{'Threshold': '0.7', 'Smooth': '1'}] * 3)
+        for index in range(3):
+            with open(os.path.join(inputDir, 'case{}.nrrd'.format(index)), 'rb') as f:
+                expected = f.read()
+            with open(os.path.join(outputDir, 'case{}'.format(index), 'OutputLabel.nrrd'), 'rb') as f:
+                self.assertEqual(f.read(), expected)
+        with open(os.path.join(outputDir, 'report.json')) as f:
+            self.assertEqual(len(json.load(f)['jobs']), 3)
+        # nothing was added to the scene
+        self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLScalarVolumeNode'), 0)
+
+        # bool flags can be turned off from the command line
+        cliDir = os.path.join(tempDir, 'cli')
+        self.assertEqual(main(['--model', modelPath, '--input', 'InputVolume=' + inputDir, '--output-dir', cliDir,
+                               '--param', 'Smooth=false', '--docker', self.writeFakeDocker()]), 0)
+        with open(os.path.join(cliDir, 'report.json')) as f:
+            self.assertEqual([job['params']['Smooth'] for job in json.load(f)['jobs']], ['0'] * 3)
+        with open(modelPath) as f:
+            modelDescription = json.load(f)
+        logic = DeepInferLogic()
+        for value, flagged in (('false', False), ('0', False), ('true', True), (True, True)):
+            job = DeepInferJob.fromModelDescription(modelDescription, {'InputVolume': 'in.nrrd'},
+                                                    {'OutputLabel': 'out.nrrd'}, {'Smooth': value}, 'case')
+            args = logic.createModelArguments(None, '/data', job.iodict, {}, {},
+                                              dict([(key, str(value)) for key, value in job.params.items()]))
+            self.assertEqual('--Smooth' in args, flagged)
+        with self.assertRaises(ValueError):
+            DeepInferJob.fromModelDescription(modelDescription, {'InputVolume': 'in.nrrd'},
+                                              {'OutputLabel': 'out.nrrd'}, {'Smooth': 'maybe'}, 'case')
+
+    def test_RunTrace(self):
+        """Every stage of a run is timed and can be exported as a Chrome trace"""
+        import tempfile
+        inputNode = self.createVolume('Input')
+        outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.run(self.createModelParameters(inputNode, outputNode))
+        job = logic.jobs[0]
+        self.waitForLogic(logic)
+        self.assertEqual(job.status, 'completed')
+        for stage in ('queued', 'export', 'container start', 'compute', 'import', 'scene update'):
+            self.assertIn(stage, job.timings)
+        self.assertGreater(job.timings['compute'], 0)
+        summary = logic.trace.summary()
+        self.assertEqual(summary['docker check']['count'], 1)
+        self.assertAlmostEqual(summary['export']['total_s'], job.timings['export'])
+
+        path = os.path.join(tempfile.mkdtemp(), 'run.trace.json')
+        logic.trace.writeChromeTrace(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        lanes = dict([(event['args']['name'], event['tid']) for event in events if event['ph'] == 'M'])
+        self.assertEqual(sorted(lanes.keys()), ['DeepInfer', job.name])
+        compute = [event for event in events if event['name'] == 'compute'][0]
+        self.assertEqual(compute['tid'], lanes[job.name])
+        self.assertEqual(compute['ph'], 'X')
+        # the stages reported by the model are traced as well
+        self.assertEqual(len([event for event in events if event.get('cat') == 'model']), 2)
+
+    def test_FiducialIndex(self):
+        """Points are converted to voxel indices from the geometry of the volume alone"""
+        import numpy as np
+        import vtk
+        inputNode = self.createVolume('Input')
+        inputNode.SetOrigin(10, -20, 5)
+        modelParameters = ModelParameters()
+        modelParameters.inputs = {'InputVolume': inputNode}
+        self.assertIs(modelParameters.referenceVolume(), inputNode)
+        points = np.random.uniform(-50, 50, (100, 3))
+        indices = modelParameters.pointsToIndex(inputNode, points)
+        rasToIJK = vtk.vtkMatrix4x4()
+        inputNode.GetRASToIJKMatrix(rasToIJK)
+        for point, index in zip(points, indices):
+            ijk = rasToIJK.MultiplyPoint(list(point) + [1])[:3]
+            self.assertEqual(list(index), [int(np.floor(x + 0.5)) for x in ijk])
+        # cached until the node is modified
+        self.assertIs(modelParameters.rasToIJK(inputNode), modelParameters.rasToIJK(inputNode))
+        inputNode.SetSpacing(1.0, 1.0, 1.0)
+        self.assertEqual(list(modelParameters.pointsToIndex(inputNode, [12.4, -17.6, 8])[0]), [2, 2, 3])
+
+    def test_ExchangeFormats(self):
+        """Volumes round-trip through every exchange format and jobs use the fastest one the model supports"""
+        import tempfile
+        import numpy as np
+        import vtk
+        exchange = VolumeExchange()
+        self.assertEqual(exchange.chooseFormat(['nrrd', 'nrrd-gzip', 'npy']), 'npy')
+        self.assertEqual(exchange.chooseFormat(['nrrd', 'nrrd-gzip', 'npy'], compress=True), 'nrrd-gzip')
+        self.assertEqual(exchange.chooseFormat(['nrrd', 'npy'], allowed=('nrrd', 'nii')), 'nrrd')
+        self.assertEqual(exchange.chooseFormat(['unknown']), 'nrrd')
+
+        inputNode = self.createVolume('Input')
+        inputNode.SetOrigin(10, -20, 5)
+        array = slicer.util.arrayFromVolume(inputNode)
+        array[:] = np.arange(array.size).reshape(array.shape) % 7
+        slicer.util.arrayFromVolumeModified(inputNode)
+        expected = vtk.vtkMatrix4x4()
+        inputNode.GetIJKToRASMatrix(expected)
+        workDir = tempfile.mkdtemp()
+        for exchangeFormat in exchange.availableFormats():
+            path = os.path.join(workDir, 'volume' + VolumeExchange.FORMATS[exchangeFormat])
+            exchange.write(inputNode, path, None, exchangeFormat)
+            np.testing.assert_array_equal(exchange.readArray(path), array)
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', exchangeFormat)
+            exchange.read(path, outputNode)
+            np.testing.assert_array_equal(slicer.util.arrayFromVolume(outputNode), array)
+            ijkToRAS = vtk.vtkMatrix4x4()
+            outputNode.GetIJKToRASMatrix(ijkToRAS)
+            for row in range(3):
+                for col in range(4):
+                    self.assertAlmostEqual(ijkToRAS.GetElement(row, col), expected.GetElement(row, col), 5)
+            # regions keep their position
+            exchange.write(inputNode, path, np.s_[1:3, :, 2:], exchangeFormat)
+            np.testing.assert_array_equal(exchange.readArray(path), array[1:3, :, 2:])
+            os.remove(path)
+        shutil.rmtree(workDir)
+
+        for exchangeFormats, compress, chosen in ((['npy', 'nrrd'], False, 'npy'),
+                                                  (['nrrd', 'nrrd-gzip'], True, 'nrrd-gzip')):
+            modelParameters = self.createModelParameters(inputNode, None)
+            modelParameters.exchangeFormats = exchangeFormats
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+            job = DeepInferJob.fromModelParameters(modelParameters, outputs={'OutputLabel': outputNode})
+            logic = DeepInferLogic()
+            logic.setDockerPath(self.writeFakeDocker())
+            logic.compressExchange = compress
+            logic.runBatch([job])
+            self.waitForLogic(logic)
+            self.assertEqual(job.status, 'completed')
+            self.assertEqual(job.exchangeFormat, chosen)
+            np.testing.assert_array_equal(slicer.util.arrayFromVolume(outputNode), array)
+
+    def test_ScratchSpace(self):
+        """Jobs are written to the configured scratch directory and fail early without space"""
+        import tempfile
+        location = tempfile.mkdtemp()
+        inputNode = self.createVolume('Input')
+        modelParameters = self.createModelParameters(inputNode, None)
+        jobs = []
+        for minFree in (0, 1024 ** 5):
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+            job = DeepInferJob.fromModelParameters(modelParameters, outputs={'OutputLabel': outputNode})
+            logic = DeepInferLogic()
+            logic.setDockerPath(self.writeFakeDocker())
+            logic.scratch = ScratchSpace(location)
+            logic.scratch.minFree = minFree
+            logic.runBatch([job])
+            self.waitForLogic(logic)
+            self.assertEqual(logic.scratch.reserved, dict())
+            jobs.append(job)
+        self.assertEqual(jobs[0].status, 'completed')
+        self.assertEqual(os.path.dirname(jobs[0].scratchRoot), location)
+        self.assertFalse(os.path.exists(jobs[0].workDir))
+        # a petabyte is not free
+        self.assertEqual(jobs[1].status, 'failed')
+        self.assertIsNone(jobs[1].workDir)
+        self.assertEqual(ScratchSpace.estimate(jobs[0]), (32 * 32 * 16 * 2, 32 * 32 * 16 * 2))
+        if os.path.isdir(ScratchSpace.SHARED_MEMORY):
+            scratch = ScratchSpace(location, useSharedMemory=True)
+            self.assertEqual(os.path.dirname(scratch.allocate(jobs[0])), ScratchSpace.SHARED_MEMORY)
+            self.assertEqual(scratch.allocate(jobs[0], allowSharedMemory=False), scratch.root)
+        # only unused job directories of earlier sessions are removed from the configured location
+        root = ScratchSpace(location).root
+        old = time() - 2 * 24 * 60 * 60
+        stale, other, locked, busy = [os.path.join(root, name) for name in
+                                      ('a' * 32, 'results', 'pipeline-' + 'b' * 32, 'c' * 32)]
+        for path in (stale, other, locked, os.path.join(busy, 'output')):
+            os.makedirs(path)
+        lock = ScratchSpace.lock(locked)
+        open(os.path.join(busy, 'output', 'log.txt'), 'w').close()
+        for path in (stale, other, locked, busy):
+            os.utime(path, (old, old))
+        DeepInferLogic.removeStaleJobDirs([root])
+        self.assertEqual([os.path.exists(path) for path in (stale, other, locked, busy)],
+                         [False, True, True, True])
+        lock.close()
+        DeepInferLogic.removeStaleJobDirs([root], maxAge=0)
+        self.assertEqual([os.path.exists(path) for path in (other, locked, busy)], [True, False, False])
+        shutil.rmtree(location)
+
+    def test_CancelJobs(self):
+        """Cancelling kills the containers by name, frees the slot at once and removes the job files"""
+        import time
+        jobs = self.createJobs(3)
+        dockerPath = self.writeFakeDocker()
+        stateDir = os.path.join(os.path.dirname(dockerPath), 'containers')
+        logic = DeepInferLogic()
+        logic.setDockerPath(dockerPath)
+        os.environ['FAKE_DOCKER_DELAY'] = '60'
+        try:
+            start = time.time()
+            logic.runBatch(jobs)
+
+            def waitForContainer(job):
+                while not (job.containerName and os.path.exists(os.path.join(stateDir, job.containerName))):
+                    self.assertLess(time.time() - start, 10, "Timed out waiting for the container to start")
+                    slicer.app.processEvents()
+
+            waitForContainer(jobs[0])
+            logic.cancelJob(jobs[0])
+            self.assertEqual(jobs[0].status, 'aborted')
+            self.assertNotIn(jobs[0], logic.runningJobs)
+            # the next job starts while the first container is stopped
+            waitForContainer(jobs[1])
+            logic.abort = True
+            self.waitForLogic(logic, timeout=10)
+        finally:
+            del os.environ['FAKE_DOCKER_DELAY']
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual([job.status for job in jobs], ['aborted'] * 3)
+        with open(os.path.join(stateDir, 'killed')) as f:
+            self.assertEqual(f.read().split(), [jobs[0].containerName, jobs[1].containerName])
+        for job in jobs[:2]:
+            self.assertFalse(os.path.exists(os.path.join(stateDir, job.containerName)))
+            self.assertFalse(os.path.exists(job.workDir))
+
+    def test_DaemonFailure(self):
+        """Without a docker daemon the jobs fail with a reason instead of being aborted"""
+        jobs = self.createJobs(3)
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.checkDockerDaemon = lambda: False
+        logic.runBatch(jobs)
+        self.waitForLogic(logic, timeout=10)
+        self.assertEqual([job.status for job in jobs], ['failed'] * 3)
+        self.assertFalse(logic.abort)
+        self.assertEqual(logic.failure, 'the docker daemon is not running')
+        # the next run checks again
+        logic.checkDockerDaemon = lambda: True
+        jobs = self.createJobs(1)
+        logic.runBatch(jobs)
+        self.waitForLogic(logic)
+        self.assertEqual(jobs[0].status, 'completed')
+        self.assertIsNone(logic.failure)
+
+    def test_Pipeline(self):
+        """Stages pass their outputs as files, independent stages run concurrently and
+        only the pipeline outputs are imported"""
+        import tempfile
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir, True)
+
+        def model(*inputs):
+            return {'name': 'Fake Model', 'docker': {'dockerhub_repository': 'deepinfer/fake'},
+                    'resources': {'cpus': 0.5},
+                    'members': [{'name': name, 'type': 'volume', 'iotype': 'input'} for name in inputs] +
+                               [{'name': 'OutputLabel', 'type': 'volume', 'iotype': 'output'}]}
+
+        with open(os.path.join(tempDir, 'segmenter.json'), 'w') as f:
+            json.dump(model('InputVolume'), f)
+        description = {'name': 'Fake Pipeline',
+                       'stages': [{'name': 'join', 'model': model('A', 'B'),
+                                   'inputs': {'A': 'left.OutputLabel', 'B': 'right.OutputLabel'}},
+                                  {'name': 'segment', 'model': 'segmenter'},
+                                  {'name': 'left', 'model': model('InputVolume'),
+                                   'inputs': {'InputVolume': 'segment.OutputLabel'}},
+                                  {'name': 'right', 'model': model('InputVolume'),
+                                   'inputs': {'InputVolume': 'segment.OutputLabel'}}],
+                       'outputs': {'Mask': 'segment.OutputLabel', 'Result': 'join.OutputLabel'}}
+        pipelinePath = os.path.join(tempDir, 'pipeline.json')
+        with open(pipelinePath, 'w') as f:
+            json.dump(description, f)
+        pipeline = Pipeline.load(pipelinePath)
+        self.assertEqual(pipeline.order, ['segment', 'left', 'right', 'join'])
+        self.assertEqual(pipeline.inputNames(), ['InputVolume'])
+        for stages in ([{'name': 'a', 'model': model('InputVolume'), 'inputs': {'InputVolume': 'b.OutputLabel'}},
+                        {'name': 'b', 'model': model('InputVolume'), 'inputs': {'InputVolume': 'a.OutputLabel'}}],
+                       [{'name': 'a', 'model': model('InputVolume'), 'inputs': {'InputVolume': 'c.OutputLabel'}}]):
+            with self.assertRaises(ValueError):
+                Pipeline({'stages': stages})
+
+        inputNode = self.createVolume('Input')
+        maskNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Mask')
+        resultNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Result')
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.maxConcurrentJobs = 2
+        jobs = logic.runPipeline(pipeline, {'InputVolume': inputNode}, {'Mask': maskNode, 'Result': resultNode})
+        segment, left, right, join = jobs
+        self.assertEqual(join.dependencies, [left, right])
+        self.waitForLogic(logic)
+        self.assertEqual([job.status for job in jobs], ['completed'] * 4)
+        # the branches overlapped and the last stage waited for both
+        self.assertLess(left.startTime, right.endTime)
+        self.assertLess(right.startTime, left.endTime)
+        self.assertGreaterEqual(join.startTime, max(left.endTime, right.endTime))
+        for outputNode in (maskNode, resultNode):
+            self.assertEqual(outputNode.GetImageData().GetDimensions(), inputNode.GetImageData().GetDimensions())
+        # the intermediate volumes never became nodes and their files are gone
+        self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLLabelMapVolumeNode'), 2)
+        self.assertEqual(slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLScalarVolumeNode'), 1)
+        self.assertFalse(os.path.exists(segment.pipelineDir))
+
+        # stages that depend on a cancelled one are not run
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        jobs = logic.runPipeline(pipeline, {'InputVolume': inputNode}, {'Result': resultNode})
+        logic.cancelJob(jobs[0])
+        self.waitForLogic(logic)
+        self.assertEqual([job.status for job in jobs], ['aborted'] * 4)
+        self.assertFalse(os.path.exists(jobs[0].pipelineDir))
+
+        # headless runs write the pipeline outputs only
+        outputDir = os.path.join(tempDir, 'results')
+        exchange = VolumeExchange()
+        exchange.write(inputNode, os.path.join(tempDir, 'input.nrrd'))
+        report = runHeadless(pipelinePath, {'InputVolume': os.path.join(tempDir, 'input.nrrd')}, outputDir,
+                             workers=2, dockerPath=self.writeFakeDocker())
+        self.assertEqual([job['status'] for job in report['jobs']], ['completed'] * 4)
+        self.assertEqual(sorted(os.listdir(outputDir)), ['Mask.nrrd', 'Result.nrrd', 'report.json'])
+
+    def test_ContainerResources(self):
+        """Resource limits and thread counts are passed to the containers and the fastest
+        thread count of a model is found once and reused"""
+        import multiprocessing
+        import tempfile
+        options = ContainerResources.dockerOptions({'cpus': 1.5, 'memory': '2g', 'cpuset': '0-1'})
+        self.assertEqual(options[:6], ['--cpus', '1.5', '--memory', '2g', '--cpuset-cpus', '0-1'])
+        self.assertIn('OMP_NUM_THREADS=2', options)
+        self.assertEqual(ContainerResources.dockerOptions({}), [])
+        self.assertEqual(ContainerResources.share({'cpus': 4}, 2), {'cpus': 2.0, 'threads': 2})
+        self.assertEqual(ThreadTuner.candidates(6), [1, 2, 4, 6])
+
+        jobs = self.createJobs(2)
+        logic = DeepInferLogic()
+        logic.resourceOverrides = {'memory': '1g'}
+        jobs[0].resources = {'cpus': 2}
+        self.assertEqual(logic.jobResources(jobs[0]), {'cpus': 2, 'memory': '1g'})
+        logic.maxConcurrentJobs = 2
+        self.assertEqual(logic.jobResources(jobs[1])['threads'], max(1, multiprocessing.cpu_count() // 2))
+
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir, True)
+        dockerPath = self.writeFakeDocker()
+        runsPath = os.path.join(os.path.dirname(dockerPath), 'containers', 'runs')
+        tuner = ThreadTuner(os.path.join(tempDir, 'tuning.json'))
+        jobs = self.createJobs(2)
+        for job in jobs:
+            job.resources = {'cpus': 4}
+        logic = DeepInferLogic()
+        logic.setDockerPath(dockerPath)
+        logic.threadTuner = tuner
+        os.environ['FAKE_DOCKER_DELAY'] = '0.2'
+        os.environ['FAKE_DOCKER_BEST_THREADS'] = '2'
+        try:
+            logic.runBatch(jobs)
+            self.waitForLogic(logic)
+        finally:
+            del os.environ['FAKE_DOCKER_DELAY']
+            del os.environ['FAKE_DOCKER_BEST_THREADS']
+        self.assertEqual([job.status for job in jobs], ['completed'] * 2)
+        with open(runsPath) as f:
+            runs = [line.split() for line in f]
+        # the first job ran at 1, 2 and 4 threads before its actual run, the second job was not tuned
+        self.assertEqual([threads for name, threads in runs], ['1', '2', '4', '2', '2'])
+        self.assertEqual(runs[3][0], jobs[0].containerName)
+        self.assertIn('thread tuning', jobs[0].timings)
+        self.assertNotIn('thread tuning', jobs[1].timings)
+        self.assertEqual(ThreadTuner(tuner.path).lookup(jobs[1]), 2)
+
+    def test_PullManager(self):
+        """Images are pulled in the background with layer progress, against a stand-in of the
+        Engine API and with the docker executable, and only registered with their digest"""
+        import datetime
+        import socketserver
+        import tempfile
+        import time
+        from http.server import BaseHTTPRequestHandler
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir, True)
+        localDir = os.path.join(tempDir, 'local')
+        os.mkdir(localDir)
+        modelPaths = dict()
+        for name, digest in (('fake', 'sha256:0123'), ('other', 'sha256:4567'), ('broken', 'sha256:9999')):
+            modelPaths[name] = os.path.join(tempDir, name + '.json')
+            with open(modelPaths[name], 'w') as f:
+                json.dump({'name': name, 'docker': {'dockerhub_repository': 'deepinfer/' + name,
+                                                    'digest': digest}}, f)
+        pulled = []
+
+        class RegistryHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                # streams the layer progress of /images/create like the docker daemon
+                from urllib.parse import parse_qs, urlparse
+                query = parse_qs(urlparse(self.path).query)
+                reference = query['fromImage'][0] + '@' + query['tag'][0]
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                records = [{'status': 'Pulling from ' + query['fromImage'][0], 'id': query['tag'][0]}]
+                for layer in ('aaaaaaaaaaaa', 'bbbbbbbbbbbb'):
+                    records.append({'status': 'Pulling fs layer', 'id': layer})
+                    for current in (1024, 2048, 4096):
+                        records.append({'status': 'Downloading', 'id': layer,
+                                        'progressDetail': {'current': current, 'total': 4096}})
+                    records.append({'status': 'Pull complete', 'id': layer})
+                records.append({'status': 'Digest: ' + query['tag'][0]})
+                for record in records:
+                    data = (json.dumps(record) + '\r\n').encode('utf-8')
+                    self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+                    self.wfile.flush()
+                    time.sleep(0.02)
+                self.wfile.write(b'0\r\n\r\n')
+                # the broken model is pulled under another digest
+                if 'broken' not in reference:
+                    pulled.append(reference)
+
+            def do_GET(self):
+                body = json.dumps([{'RepoTags': [], 'RepoDigests': list(pulled)}])
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        socketPath = os.path.join(tempDir, 'docker.sock')
+        server = socketserver.ThreadingUnixStreamServer(socketPath, RegistryHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            pullManager = PullManager(DockerState('/nonexistent/docker', socketPath=socketPath), 1,
+                                      localDir=localDir)
+            tasks = [pullManager.pull(modelPaths[name]) for name in ('fake', 'other', 'broken')]
+            # a model that is being pulled is not queued twice
+            self.assertIs(pullManager.pull(modelPaths['fake']), tasks[0])
+            progress = []
+            while pullManager.active():
+                progress.append(tasks[0].progress())
+                time.sleep(0.01)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([task.status for task in tasks], ['completed', 'completed', 'failed'])
+        self.assertTrue(any([0 < value < 1 for value in progress]))
+        self.assertEqual(list(tasks[0].layers), ['aaaaaaaaaaaa', 'bbbbbbbbbbbb'])
+        # one pull at a time
+        self.assertGreaterEqual(tasks[1].startTime, tasks[0].endTime)
+        self.assertEqual(sorted(os.listdir(localDir)), ['fake.json', 'other.json'])
+
+        # the docker executable, when the Engine API is not available
+        shutil.rmtree(localDir)
+        os.mkdir(localDir)
+        dockerState = DockerState(self.writeFakeDocker(), socketPath='')
+        pullManager = PullManager(dockerState, 2, localDir=localDir)
+        task = pullManager.pull(modelPaths['fake'])
+        self.assertTrue(pullManager.wait(30))
+        self.assertEqual(task.status, 'completed')
+        self.assertEqual(len(task.layers), 3)
+        self.assertEqual(os.listdir(localDir), ['fake.json'])
+
+        # further pulls wait while the running ones use up the bandwidth
+        pullManager.bandwidthLimit = 1000
+        pullManager.tasks = [PullTask(modelPaths['fake']), PullTask(modelPaths['other'])]
+        pullManager.tasks[0].status = 'pulling'
+        pullManager.tasks[0].layers['aaaaaaaaaaaa'] = {'status': '', 'current': 0, 'total': 10000, 'done': False}
+        pullManager.rate()
+        time.sleep(0.1)
+        pullManager.tasks[0].layers['aaaaaaaaaaaa']['current'] = 5000
+        self.assertGreater(pullManager.rate(), 1000)
+        self.assertFalse(pullManager.canStartPull())
+        pullManager.bandwidthLimit = 0
+        self.assertTrue(pullManager.canStartPull())
+
+        # the models of a site list are pulled during off-hours only
+        siteListPath = os.path.join(tempDir, 'site.json')
+        with open(siteListPath, 'w') as f:
+            json.dump({'models': ['fake', 'other.json', 'unknown'], 'off_hours': [22, 6]}, f)
+        pullManager = PullManager(dockerState, 2, localDir=localDir)
+        prePull = SitePrePull(siteListPath, pullManager)
+        self.assertEqual(prePull.modelPaths, [modelPaths['fake'], modelPaths['other']])
+        self.assertFalse(prePull.isOffHours(datetime.datetime(2020, 1, 1, 12)))
+        self.assertTrue(prePull.isOffHours(datetime.datetime(2020, 1, 1, 23)))
+        self.assertEqual(prePull.check(datetime.datetime(2020, 1, 1, 12)), [])
+        dockerState.refresh().join()
+        tasks = prePull.check(datetime.datetime(2020, 1, 1, 2))
+        self.assertEqual([task.name for task in tasks], ['other'])
+        self.assertTrue(pullManager.wait(30))
+        self.assertEqual(tasks[0].status, 'completed')
+        self.assertEqual(sorted(os.listdir(localDir)), ['fake.json', 'other.json'])
+
+    def test_Preprocessing(self):
+        """Inputs are cropped to a ROI and resampled before export, outputs are pasted back"""
+        import numpy as np
+        inputNode = self.createVolume('Input', (40, 36, 20))
+        inputNode.SetOrigin(10, -20, 5)
+        inputArray = slicer.util.arrayFromVolume(inputNode)
+        # labels constant over 2 x 2 voxel blocks survive resampling to twice the spacing and back
+        k, j, i = np.indices(inputArray.shape)
+        inputArray[:] = (i // 2 + 3 * (j // 2) + 5 * k) % 11 + 1
+        roiNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsROINode', 'ROI')
+        # voxels 4-23, 6-19 and 2-11
+        roiNode.SetXYZ(16.75, -13.75, 18)
+        roiNode.SetRadiusXYZ(4.75, 3.25, 9)
+        outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+        modelParameters = self.createModelParameters(inputNode, outputNode)
+        modelParameters.iodict['InputVolume']['voltype'] = 'LabelMap'
+        modelParameters.iodict['OutputLabel']['voltype'] = 'LabelMap'
+        modelParameters.iodict['InputROI'] = {'type': 'roi', 'iotype': 'input'}
+        modelParameters.inputs['InputROI'] = roiNode
+        modelParameters.preprocessing = {'spacing': [1.0, 1.0, 2.0], 'roi': 'InputROI'}
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        logic.run(modelParameters)
+        job = logic.jobs[0]
+        self.waitForLogic(logic)
+        self.assertEqual(job.status, 'completed')
+        preprocessing = job.volumePreprocessing
+        self.assertEqual(preprocessing.region, np.s_[2:12, 6:20, 4:24])
+        self.assertEqual(preprocessing.shape, (10, 7, 10))
+        np.testing.assert_allclose(preprocessing.outputIJKToRAS[:3, :3], np.diag([1.0, 1.0, 2.0]))
+        np.testing.assert_allclose(preprocessing.outputIJKToRAS[:3, 3], [12.25, -16.75, 9])
+        # the identity model output is pasted into the full input geometry
+        outputArray = slicer.util.arrayFromVolume(outputNode)
+        self.assertEqual(outputArray.shape, inputArray.shape)
+        expected = np.zeros_like(inputArray)
+        expected[preprocessing.region] = inputArray[preprocessing.region]
+        np.testing.assert_array_equal(outputArray, expected)
+        self.assertEqual(VolumeExchange().geometry(VolumeExchange.regionIJKToRAS(outputNode)),
+                         VolumeExchange().geometry(VolumeExchange.regionIJKToRAS(inputNode)))
+
+        # scalar volumes are converted and clipped without touching the input node
+        preprocessing = VolumePreprocessing({'dtype': 'float32', 'window': [3, 8]}, (40, 36, 20),
+                                            preprocessing.ijkToRAS)
+        array = preprocessing.apply(inputArray)
+        self.assertEqual(array.dtype, np.float32)
+        np.testing.assert_array_equal(array, np.clip(inputArray, 3, 8))
+        self.assertEqual(inputArray.max(), 11)
+        with self.assertRaises(ValueError):
+            VolumePreprocessing({}, (40, 36, 20), preprocessing.ijkToRAS, [[-100, -100, -100]])
+
+    def test_SceneUpdates(self):
+        """The views are updated once for all outputs of a job, and not at all if it is turned off"""
+        inputNode = self.createVolume('Input')
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.writeFakeDocker())
+        shown = []
+        logic.showOutputVolumes = lambda nodes: shown.append(list(nodes))
+        jobs = []
+        for updateViews in (True, False):
+            outputNodes = [slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output{}'.format(n))
+                           for n in range(2)]
+            modelParameters = self.createModelParameters(inputNode, outputNodes[0])
+            modelParameters.iodict['OutputProbability'] = {'type': 'volume', 'iotype': 'output'}
+            modelParameters.outputs['OutputProbability'] = outputNodes[1]
+            job = DeepInferJob.fromModelParameters(modelParameters)
+            job.updateViews = updateViews
+            jobs.append((job, outputNodes))
+        logic.runBatch([job for job, _ in jobs])
+        self.waitForLogic(logic)
+        self.assertEqual([job.status for job, _ in jobs], ['completed', 'completed'])
+        self.assertEqual(len(shown), 1)
+        self.assertEqual(sorted([node.GetID() for node in shown[0]]),
+                         sorted([node.GetID() for node in jobs[0][1]]))
+        # the outputs of the second job were imported without being shown
+        for node in jobs[1][1]:
+            self.assertEqual(node.GetImageData().GetDimensions(), inputNode.GetImageData().GetDimensions())
+
+    def test_DockerState(self):
+        """Daemon state and images are cached, from the Engine API or the docker executable"""
+        import tempfile
+        os.environ['FAKE_DOCKER_IMAGES'] = 'deepinfer/fake:latest@sha256:0123,deepinfer/other:1.0@<none>'
+        try:
+            state = DockerState(self.writeFakeDocker(), socketPath='')
+            self.assertIsNone(state.hasImage('deepinfer/fake'))
+            state.refresh().join()
+            self.assertTrue(state.hasImage('deepinfer/fake', 'sha256:0123'))
+            self.assertFalse(state.hasImage('deepinfer/fake', 'sha256:4567'))
+            self.assertTrue(state.hasImage('deepinfer/other'))
+            self.assertFalse(state.hasImage('deepinfer/missing'))
+        finally:
+            del os.environ['FAKE_DOCKER_IMAGES']
+        # the daemon is not asked again until the state is invalidated
+        state.dockerPath = '/nonexistent/docker'
+        self.assertTrue(state.isDaemonRunning())
+        state.invalidate()
+        self.assertFalse(state.isDaemonRunning())
+
+        import socketserver
+        from http.server import BaseHTTPRequestHandler
+        requests = []
+
+        class EngineHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                body = 'OK' if self.path == '/_ping' else json.dumps(
+                    [{'RepoTags': ['deepinfer/fake:latest'], 'RepoDigests': ['deepinfer/fake@sha256:0123']},
+                     {'RepoTags': ['<none>:<none>'], 'RepoDigests': None}])
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        socketPath = os.path.join(tempfile.mkdtemp(), 'docker.sock')
+        server = socketserver.UnixStreamServer(socketPath, EngineHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            state = DockerState('/nonexistent/docker', socketPath=socketPath)
+            self.assertTrue(state.isDaemonRunning())
+            state.refresh().join()
+            self.assertTrue(state.hasImage('deepinfer/fake', 'sha256:0123'))
+            self.assertFalse(state.hasImage('<none>'))
+            self.assertTrue(state.isDaemonRunning())
+            self.assertEqual(requests, ['/_ping', '/images/json'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    import sys
+    returnCode = main(sys.argv[1:])
+    if slicer and slicer.app.commandOptions().noMainWindow:
+        slicer.util.exit(returnCode)
+    elif not slicer:
+        sys.exit(returnCode)
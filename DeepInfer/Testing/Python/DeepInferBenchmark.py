@@ -0,0 +1,398 @@
+"""
+Benchmarks for the DeepInfer execution pipeline.
+
+The docker executable is replaced by the fake runtime of DeepInferTest, which prints
+progress records, sleeps for FAKE_DOCKER_DELAY seconds and writes a synthetic label map,
+so the numbers only depend on DeepInfer and the machine. Run inside Slicer, for example:
+
+    Slicer --no-main-window --python-script DeepInferBenchmark.py --output results.json
+
+Results are printed and optionally written as JSON. With --baseline the results are
+compared to an earlier run and the script exits with 1 if any of them regressed by more
+than --tolerance. ctest runs it with --quick, and with --baseline if a
+DeepInferBenchmarkBaseline.json recorded with --quick on the test machine is next to
+this script.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import slicer
+
+
+def currentRSS():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class PeakMemorySampler(object):
+    """Samples the RSS on a background thread and keeps the peak above the starting value"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def __enter__(self):
+        self.baseline = self.peak = currentRSS()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, currentRSS())
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, currentRSS())
+            time.sleep(self.interval)
+
+    @property
+    def peakIncrease(self):
+        return self.peak - self.baseline
+
+
+class FakeRuntime(object):
+    """The fake docker executable of DeepInferTest with a fixed model delay"""
+
+    def __init__(self, delay):
+        from DeepInfer import DeepInferTest
+        self.test = DeepInferTest()
+        self.delay = delay
+        self.dockerPath = self.test.writeFakeDocker()
+        self.environment = dict()
+
+    def __enter__(self):
+        for key, value in (('FAKE_DOCKER_DELAY', str(self.delay)), ('FAKE_DOCKER_OUTPUT', 'label')):
+            self.environment[key] = os.environ.get(key)
+            os.environ[key] = value
+        return self
+
+    def __exit__(self, *args):
+        for key, value in self.environment.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(os.path.dirname(self.dockerPath), ignore_errors=True)
+
+    def createLogic(self, concurrency=1):
+        from DeepInfer import DeepInferLogic
+        logic = DeepInferLogic()
+        logic.setDockerPath(self.dockerPath)
+        logic.maxConcurrentJobs = concurrency
+        return logic
+
+
+def createVolume(name, dimensions):
+    import numpy as np
+    import vtk
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(*dimensions)
+    imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    volumeNode.SetAndObserveImageData(imageData)
+    volumeNode.SetSpacing(0.7, 0.7, 1.25)
+    array = slicer.util.arrayFromVolume(volumeNode)
+    array[:] = np.random.randint(-1000, 2000, size=array.shape, dtype=np.int16)
+    slicer.util.arrayFromVolumeModified(volumeNode)
+    return volumeNode
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))] if values else 0
+
+
+def measure(function, repeat):
+    times = []
+    peaks = []
+    for _ in range(repeat):
+        with PeakMemorySampler() as sampler:
+            start = time.time()
+            function()
+            times.append(time.time() - start)
+        peaks.append(sampler.peakIncrease)
+    return {'wall_time_s': min(times), 'peak_rss_increase_bytes': max(peaks)}
+
+
+def waitForLogic(logic, timeout=3600):
+    """Process events until the logic is done and return the frame times"""
+    frameTimes = []
+    start = time.time()
+    while logic.isRunning():
+        if time.time() - start > timeout:
+            raise RuntimeError('Timed out waiting for the model to finish')
+        frameStart = time.time()
+        slicer.app.processEvents()
+        frameTimes.append(time.time() - frameStart)
+    return frameTimes
+
+
+def benchmarkVolumeExchange(dimensions, repeat=3):
+    """Compare the SimpleITK NRRD round-trip with the direct voxel buffer exchange"""
+    import SimpleITK as sitk
+    import sitkUtils
+    from DeepInfer import VolumeExchange
+
+    workDir = tempfile.mkdtemp()
+    inputNode = createVolume('BenchmarkInput', dimensions)
+    outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'BenchmarkOutput')
+    path = os.path.join(workDir, 'volume.nrrd')
+    exchange = VolumeExchange()
+
+    def sitkExport():
+        img = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(inputNode.GetName()))
+        sitk.WriteImage(img, str(path))
+
+    def sitkImport():
+        result = sitk.ReadImage(str(path))
+        sitk.WriteImage(result, sitkUtils.GetSlicerITKReadWriteAddress(outputNode.GetName()))
+
+    results = dict()
+    try:
+        # the direct path runs first so that the sitk buffers do not hide its peak
+        results['direct_export'] = measure(lambda: exchange.write(inputNode, path), repeat)
+        results['direct_import'] = measure(lambda: exchange.read(path, outputNode), repeat)
+        results['sitk_export'] = measure(sitkExport, repeat)
+        results['sitk_import'] = measure(sitkImport, repeat)
+    finally:
+        shutil.rmtree(workDir)
+        slicer.mrmlScene.RemoveNode(inputNode)
+        slicer.mrmlScene.RemoveNode(outputNode)
+    return results
+
+
+def benchmarkExchangeFormats(dimensions, repeat=3):
+    """Write and read time and file size of every exchange format, for an image and a label map"""
+    import numpy as np
+    from DeepInfer import VolumeExchange
+
+    workDir = tempfile.mkdtemp()
+    exchange = VolumeExchange()
+    imageNode = createVolume('BenchmarkImage', dimensions)
+    labelNode = createVolume('BenchmarkLabel', dimensions)
+    # a few blobs, compressible like a segmentation
+    label = slicer.util.arrayFromVolume(labelNode)
+    grid = np.indices(label.shape, sparse=True)
+    label[:] = sum([((g - s // 2) * 4 // s) ** 2 for g, s in zip(grid, label.shape)]) < 3
+    slicer.util.arrayFromVolumeModified(labelNode)
+    outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'BenchmarkOutput')
+    results = dict()
+    try:
+        for name, volumeNode in (('image', imageNode), ('label', labelNode)):
+            for exchangeFormat in exchange.availableFormats():
+                path = os.path.join(workDir, 'volume' + VolumeExchange.FORMATS[exchangeFormat])
+                write = measure(lambda: exchange.write(volumeNode, path, None, exchangeFormat), repeat)
+                read = measure(lambda: exchange.read(path, outputNode, volumeNode), repeat)
+                results['{}_{}'.format(name, exchangeFormat)] = {
+                    'write_s': write['wall_time_s'],
+                    'read_s': read['wall_time_s'],
+                    'file_bytes': os.path.getsize(path)}
+    finally:
+        shutil.rmtree(workDir)
+        for node in (imageNode, labelNode, outputNode):
+            slicer.mrmlScene.RemoveNode(node)
+    return results
+
+
+def benchmarkLatency(dimensions, repeat, delay):
+    """End-to-end time of single runs, from run() until the output is in the scene, and the
+    time of each pipeline stage"""
+    from DeepInfer import DeepInferTest
+    with FakeRuntime(delay) as runtime:
+        times = []
+        timings = []
+        for _ in range(repeat):
+            slicer.mrmlScene.Clear(0)
+            inputNode = createVolume('Input', dimensions)
+            outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Output')
+            logic = runtime.createLogic()
+            start = time.time()
+            logic.run(DeepInferTest().createModelParameters(inputNode, outputNode))
+            waitForLogic(logic)
+            times.append(time.time() - start)
+            if logic.jobs[0].status != 'completed':
+                raise RuntimeError('The benchmark model failed')
+            timings.append(logic.jobs[0].timings)
+        stages = sorted(set([stage for timing in timings for stage in timing]))
+        results = {'wall_time_s': min(times),
+                   # time not spent in the model itself
+                   'overhead_s': min([t - delay for t in times]),
+                   'stages': dict([(stage.replace(' ', '_') + '_s', min([timing.get(stage, 0) for timing in timings]))
+                                   for stage in stages])}
+    slicer.mrmlScene.Clear(0)
+    return results
+
+
+def benchmarkScheduler(concurrencies, jobCount, delay):
+    """Throughput of the job scheduler running a fake model image at several concurrency levels"""
+    results = dict()
+    with FakeRuntime(delay) as runtime:
+        for concurrency in concurrencies:
+            slicer.mrmlScene.Clear(0)
+            jobs = runtime.test.createJobs(jobCount)
+            # the fake model only sleeps, so only the concurrency setting limits it
+            for job in jobs:
+                job.resources['cpus'] = 0
+            logic = runtime.createLogic(concurrency)
+            start = time.time()
+            logic.runBatch(jobs)
+            waitForLogic(logic)
+            elapsed = time.time() - start
+            completed = len([job for job in jobs if job.status == 'completed'])
+            results[str(concurrency)] = {'wall_time_s': elapsed,
+                                         'completed': completed,
+                                         'jobs_per_minute': completed * 60.0 / elapsed}
+    slicer.mrmlScene.Clear(0)
+    return results
+
+
+def benchmarkMainThread(delay):
+    """Frame times and main thread wakeups while a single long fake job runs"""
+    with FakeRuntime(delay) as runtime:
+        slicer.mrmlScene.Clear(0)
+        job = runtime.test.createJobs(1)[0]
+        logic = runtime.createLogic()
+        wakeups = []
+        process = logic.main_queue_process
+
+        def countingProcess():
+            wakeups.append(time.time())
+            process()
+        logic.main_queue_process = countingProcess
+        start = time.time()
+        cpuStart = time.process_time()
+        logic.runBatch([job])
+        frameTimes = waitForLogic(logic)
+        elapsed = time.time() - start
+        cpu = time.process_time() - cpuStart
+    slicer.mrmlScene.Clear(0)
+    return {'wall_time_s': elapsed,
+            'cpu_time_s': cpu,
+            'wakeups_per_s': len(wakeups) / elapsed,
+            'frame_time_p95_s': percentile(frameTimes, 0.95),
+            'frame_time_max_s': max(frameTimes) if frameTimes else 0}
+
+
+def benchmarkStartup(repeat=3):
+    """Time to import the module and to set up its panel"""
+    importTimes = []
+    setupTimes = []
+    for _ in range(repeat):
+        start = time.time()
+        module = slicer.util.reloadScriptedModule('DeepInfer')
+        importTimes.append(time.time() - start)
+        start = time.time()
+        widget = module.DeepInferWidget()
+        widget.setup()
+        slicer.app.processEvents()
+        setupTimes.append(time.time() - start)
+        widget.cleanup()
+        widget.parent.close()
+    return {'import_s': min(importTimes), 'widget_setup_s': min(setupTimes)}
+
+
+def environment():
+    import multiprocessing
+    return {'platform': platform.platform(),
+            'python': platform.python_version(),
+            'slicer': slicer.app.applicationVersion,
+            'cpu_count': multiprocessing.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline, tolerance, path=''):
+    """Regressions of results against baseline. Times and memory must not grow and
+    throughput must not drop by more than the tolerance."""
+    regressions = []
+    for key, value in results.items():
+        name = path + '/' + key if path else key
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            regressions.extend(compare(value, baseline[key], tolerance, name))
+        elif isinstance(value, (int, float)) and isinstance(baseline[key], (int, float)) and baseline[key] > 0:
+            ratio = value / float(baseline[key])
+            if key.endswith('_s') or key.endswith('_bytes'):
+                if ratio > 1 + tolerance:
+                    regressions.append('{}: {:.4g} vs {:.4g}'.format(name, value, baseline[key]))
+            elif key.endswith('per_minute') and ratio < 1 - tolerance:
+                regressions.append('{}: {:.4g} vs {:.4g}'.format(name, value, baseline[key]))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='DeepInfer pipeline benchmarks')
+    parser.add_argument('--sizes', default='64,128,256,512',
+                        help='edge lengths of the cubic volumes for the exchange benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--concurrency', default='1,2,4,8',
+                        help='concurrency levels for the scheduler benchmark')
+    parser.add_argument('--jobs', type=int, default=16, help='number of jobs for the scheduler benchmark')
+    parser.add_argument('--job-delay', type=float, default=2.0,
+                        help='seconds the fake model takes per job')
+    parser.add_argument('--quick', action='store_true',
+                        help='small sizes and short delays, to check that the benchmarks run')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression against the baseline')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.sizes, args.repeat, args.concurrency, args.jobs, args.job_delay = '32,64', 1, '1,2', 4, 0.2
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    concurrencies = [int(s) for s in args.concurrency.split(',')]
+    results = {'environment': environment(),
+               'startup': benchmarkStartup(args.repeat),
+               'latency': benchmarkLatency([sizes[0]] * 3, args.repeat, args.job_delay),
+               'main_thread': benchmarkMainThread(args.job_delay * 5),
+               'volume_exchange': dict([(str(size), benchmarkVolumeExchange([size] * 3, args.repeat))
+                                        for size in sizes]),
+               'exchange_formats': dict([(str(size), benchmarkExchangeFormats([size] * 3, args.repeat))
+                                         for size in sizes]),
+               'scheduler': {'jobs': args.jobs,
+                             'job_delay_s': args.job_delay,
+                             'results': benchmarkScheduler(concurrencies, args.jobs, args.job_delay)}}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # settings, not measurements
+        baseline.pop('environment', None)
+        baseline.get('scheduler', {}).pop('job_delay_s', None)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    returnCode = main(sys.argv[1:])
+    if slicer.app.commandOptions().noMainWindow:
+        slicer.util.exit(returnCode)